@@ -26,9 +26,12 @@ import time
 import threading
 import atexit
 import os
+import hashlib
+import re
 
 # LBAE modules
 from modules.tools.misc import logmem
+from config import image_route, image_cache_version, max_concurrent_image_renders
 logging.info("Memory use before any LBAE import" + logmem())
 
 from modules.maldi_data import MaldiData
@@ -62,6 +65,7 @@ from modules.launch import Launch
 logging.info("Memory use after Launch import" + logmem())
 
 from modules.storage import Storage
+from modules.render_quality import RenderLoadTracker, RenderQualityPolicy
 logging.info("Memory use after Storage import" + logmem())
 
 # --- Generate documentation files at startup ---
@@ -201,11 +205,13 @@ program_figures = Figures(
     maldi_data=program_data,
     storage=storage,
     atlas=atlas,
+    dataset="program",
 )
 peak_figures = Figures(
     maldi_data=peak_data,
     storage=storage,
     atlas=atlas,
+    dataset="peak",
 )
 # stream_figures = Figures(
 #     maldi_data=stream_data,
@@ -242,13 +248,17 @@ server.secret_key = 'e54f725a15888eab4eb35f95ec35b59dfa1fef344328d03b'
 MAX_ACTIVE_USERS = 25 
 INACTIVITY_TIMEOUT_SECONDS = 60
 QUEUE_TIMEOUT_SECONDS = 15 * 60 # (15 minutes)
-long_callback_limiter = threading.Semaphore(4) 
 
 # --- Connect to Redis ---
 # Assumes Redis is running on localhost:6379. decode_responses=True is important.
 redis_client = redis.Redis(decode_responses=True)
 logging.info("Connected to Redis for session management.")
 
+# Semaphore around the renders of the long callbacks (only shared by the threads of a process),
+# which also records the load of the app to adapt the render quality
+long_callback_limiter = RenderLoadTracker(threading.Semaphore(4), redis_client)
+render_quality_policy = RenderQualityPolicy(redis_client)
+
 # --- The "Gatekeeper" Logic (Foundation) ---
 # In app.py, replace your @server.before_request function with this one:
 
@@ -417,6 +427,134 @@ def serve_pdf(lipizone_name):
     return flask.send_from_directory(ID_CARDS_PATH, pdf_filename)
 
 
+# Bound the number of images rendered concurrently by the image routes in this process, such that a
+# page requesting many images at once does not starve the other requests
+image_render_semaphore = threading.BoundedSemaphore(max_concurrent_image_renders)
+
+
+def make_cached_image_response(cache_key, compute_image_bytes):
+    """Build the response of an image route, caching the encoded image and its ETag in the Flask
+    cache. compute_image_bytes is only called on a cache miss (holding image_render_semaphore), and
+    may return None if the image does not exist."""
+    cached = cache_flask.get(cache_key)
+
+    # Revalidation: answer from the cached ETag without rendering or sending the image
+    if cached is not None and cached[1] in request.if_none_match:
+        response = flask.Response(status=304)
+        response.set_etag(cached[1])
+    else:
+        if cached is None:
+            with image_render_semaphore:
+                # The image may have been rendered by another request while waiting
+                cached = cache_flask.get(cache_key)
+                if cached is None:
+                    image_bytes = compute_image_bytes()
+                    if image_bytes is None:
+                        flask.abort(404)
+                    cached = (image_bytes, hashlib.md5(image_bytes).hexdigest())
+                    cache_flask.set(cache_key, cached)
+        response = flask.Response(cached[0], mimetype="image/png")
+        response.set_etag(cached[1])
+        response = response.make_conditional(request)
+
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+# Add the route to serve the section images. The URL (built by Figures.get_image_url) fully
+# describes the image, including the data version, so that responses can be cached as immutable
+# by the browser and revalidated with an ETag without being recomputed.
+@app.server.route(image_route + '<dataset>/<slice_index>.png')
+def serve_image(dataset, slice_index):
+    """Serve the PNG image of the requested features in the requested section."""
+    dic_figures = {"lipid": figures, "peak": peak_figures, "program": program_figures}
+    if dataset not in dic_figures:
+        flask.abort(404)
+    try:
+        slice_index = float(slice_index)
+    except ValueError:
+        flask.abort(404)
+
+    l_names = [name if name != "" else None for name in request.args.getlist("features")]
+    colormap_type = request.args.get("colormap", "viridis")
+    overlay_color = request.args.get("overlay") or None
+    if len(l_names) == 0 or all(name is None for name in l_names):
+        flask.abort(404)
+
+    cache_key = "image-" + hashlib.md5(
+        str((dataset, slice_index, l_names, colormap_type, overlay_color, request.args.get("v"))).encode()
+    ).hexdigest()
+    return make_cached_image_response(
+        cache_key,
+        lambda: dic_figures[dataset].compute_image_bytes(
+            slice_index, l_names, colormap_type=colormap_type, overlay_color=overlay_color
+        ),
+    )
+
+
+# Add the route to serve the layers displayed above the section images (see
+# Figures.get_layer_url). Layers are stacked client-side, such that toggling the annotations or
+# adding a region mask only fetches the corresponding layer.
+@app.server.route(image_route + 'layers/<dataset>/<kind>/<slice_index>.png')
+def serve_layer(dataset, kind, slice_index):
+    """Serve the PNG layer of the requested kind in the requested section."""
+    dic_figures = {"lipid": figures, "peak": peak_figures, "program": program_figures}
+    if dataset not in dic_figures or kind not in ["contours", "mask"]:
+        flask.abort(404)
+    try:
+        slice_index = float(slice_index)
+    except ValueError:
+        flask.abort(404)
+
+    params = {key: value for key, value in request.args.items() if key != "v"}
+    cache_key = "layer-" + hashlib.md5(
+        str((dataset, kind, slice_index, sorted(params.items()), request.args.get("v"))).encode()
+    ).hexdigest()
+    return make_cached_image_response(
+        cache_key,
+        lambda: dic_figures[dataset].compute_layer_bytes(kind, slice_index, **params),
+    )
+
+
+# Add the route to serve the tiles of the mosaics displayed in "all sections" mode (see
+# Figures.build_tiled_heatmap). As for the section images, the URL fully describes the tile.
+@app.server.route(image_route + 'tiles/<kind>/<int:level>/<int:row>_<int:col>.png')
+def serve_tile(kind, level, row, col):
+    """Serve the PNG tile of the requested mosaic at the requested level, row and column. The
+    mosaic is identified by its whitelisted parameters only, rebuilt into the same key as in
+    Figures.build_tiled_heatmap, such that arbitrary query strings never build new pyramids."""
+    args = request.args.to_dict()
+    if args.pop("v", None) != str(image_cache_version):
+        flask.abort(404)
+
+    if kind == "grid" and set(args) == {"lipid", "sample"}:
+        compute_image = lambda: grid_data.retrieve_grid_image(
+            lipid=args["lipid"], sample=args["sample"]
+        )
+        type_image = None
+    elif kind == "lipizones" and set(args) in [{"brain_id"}, {"brain_id", "colors"}]:
+        hex_colors_to_highlight = None
+        if "colors" in args:
+            hex_colors_to_highlight = ["#" + color for color in args["colors"].split(",")]
+            if not all(re.fullmatch("#[0-9a-fA-F]{6}", color) for color in hex_colors_to_highlight):
+                flask.abort(404)
+        compute_image = lambda: figures.all_sections_lipizones_image(
+            hex_colors_to_highlight=hex_colors_to_highlight, brain_id=args["brain_id"]
+        )
+        type_image = "RGB"
+    else:
+        flask.abort(404)
+
+    tiles_key = figures.get_tiles_key(kind, **args)
+    cache_key = "tile-" + hashlib.md5(str((tiles_key, level, row, col)).encode()).hexdigest()
+    return make_cached_image_response(
+        cache_key,
+        lambda: figures.compute_tile_bytes(
+            tiles_key, level, row, col, compute_image, type_image=type_image
+        ),
+    )
+
+
 @server.route('/check-status')
 def check_status():
     user_id = session.get('user_id')
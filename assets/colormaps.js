@@ -0,0 +1,142 @@
+// Copyright (c) 2022, Colas Droin. All rights reserved.
+// Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+// Client-side colormapping and RGB compositing of section images. The server sends figures whose
+// image is left empty, and whose layout metadata references 8-bit index images (see
+// Figures.build_lipid_heatmap_client_colormap and Figures.build_lipid_heatmap_client_rgb). The
+// index images are fetched (from the browser cache if possible), and each index is either mapped
+// to the palette of the requested colormap (see get_lut_palettes in modules/tools/image.py), or
+// used as the intensity of one RGB channel. Changing the colormap therefore only re-runs the
+// mapping in the browser, and changing one RGB channel only fetches the image of that channel.
+// The atlas contours are a separate layer (see assets/layers.js), toggled without re-mapping.
+
+// Number of colormap levels, must match modules/tools/image.py
+const LUT_N_COLORS = 254;
+
+// Decoded index images, by URL, such that the unchanged channels are not decoded again
+const LUT_MAX_DECODED_IMAGES = 12;
+const lutDecodedImages = new Map();
+
+async function lutDecodeIndexImage(url) {
+    if (lutDecodedImages.has(url)) {
+        return lutDecodedImages.get(url);
+    }
+    const response = await fetch(url);
+    const bitmap = await createImageBitmap(await response.blob(), {
+        colorSpaceConversion: "none",
+        premultiplyAlpha: "none",
+    });
+    const canvas = document.createElement("canvas");
+    canvas.width = bitmap.width;
+    canvas.height = bitmap.height;
+    const ctx = canvas.getContext("2d");
+    ctx.drawImage(bitmap, 0, 0);
+    const image = ctx.getImageData(0, 0, canvas.width, canvas.height);
+
+    // Evict the oldest decoded image (Map preserves insertion order)
+    if (lutDecodedImages.size >= LUT_MAX_DECODED_IMAGES) {
+        lutDecodedImages.delete(lutDecodedImages.keys().next().value);
+    }
+    lutDecodedImages.set(url, image);
+    return image;
+}
+
+function lutToDataURL(width, height, pixels) {
+    const canvas = document.createElement("canvas");
+    canvas.width = width;
+    canvas.height = height;
+    canvas.getContext("2d").putImageData(new ImageData(pixels, width, height), 0, 0);
+    return canvas.toDataURL("image/png");
+}
+
+async function lutColormap(meta, colormap_type, palettes) {
+    const image = await lutDecodeIndexImage(meta.lut_source);
+    const palette = palettes[colormap_type || meta.colormap] || palettes[meta.colormap];
+    const pixels = new Uint8ClampedArray(image.data);
+    for (let i = 0; i < pixels.length; i += 4) {
+        // Transparent pixels are NaN in the original image
+        if (pixels[i + 3] === 0) {
+            continue;
+        }
+        const color = palette[pixels[i]];
+        pixels[i] = color[0];
+        pixels[i + 1] = color[1];
+        pixels[i + 2] = color[2];
+        pixels[i + 3] = 255;
+    }
+    return lutToDataURL(image.width, image.height, pixels);
+}
+
+async function lutCompositeRGB(meta) {
+    const images = await Promise.all(
+        meta.rgb_sources.map((url) => (url ? lutDecodeIndexImage(url) : null))
+    );
+    const reference = images.find((image) => image !== null);
+    if (!reference) {
+        return "";
+    }
+    const pixels = new Uint8ClampedArray(reference.data.length);
+    for (let i = 0; i < pixels.length; i += 4) {
+        let visible = false;
+        for (let c = 0; c < 3; c++) {
+            const image = images[c];
+            // Transparent pixels are NaN in the original image, and have zero intensity
+            if (image === null || image.data[i + 3] === 0) {
+                continue;
+            }
+            pixels[i + c] = Math.round((image.data[i] * 255) / (LUT_N_COLORS - 1));
+            visible = true;
+        }
+        pixels[i + 3] = visible ? 255 : 0;
+    }
+    return lutToDataURL(reference.width, reference.height, pixels);
+}
+
+// Last image produced, such that toggling the annotations does not map the image again
+let lutLastImage = { key: null, source: null };
+
+async function lutImageSource(meta, colormap_type, palettes) {
+    const key = JSON.stringify([meta.lut_source || meta.rgb_sources, colormap_type]);
+    if (lutLastImage.key !== key) {
+        const source = meta.lut_source
+            ? await lutColormap(meta, colormap_type, palettes)
+            : await lutCompositeRGB(meta);
+        lutLastImage = { key: key, source: source };
+    }
+    return lutLastImage.source;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    lut: {
+        apply_colormap: async function (
+            figure,
+            colormap_type,
+            relayout_data,
+            annotations_checked,
+            palettes
+        ) {
+            const meta = figure && figure.layout && figure.layout.meta;
+            if (meta && meta.tiles) {
+                // Tiled mosaic, see assets/tiles.js
+                return lbaeWithTemplate(tilesRender(figure, relayout_data));
+            }
+            if (tilesTriggeredByRelayout()) {
+                // Zooming does not change a single image
+                return window.dash_clientside.no_update;
+            }
+
+            if (!meta || !(meta.lut_source || meta.rgb_sources)) {
+                // Figure already rendered server-side
+                return lbaeWithTemplate(figure);
+            }
+
+            const source = await lutImageSource(meta, colormap_type, palettes);
+            const data = figure.data.slice();
+            data[0] = Object.assign({}, data[0], { source: source });
+            const layers = [annotations_checked ? meta.overlay_source : null];
+            return lbaeWithTemplate(
+                layersStack(Object.assign({}, figure, { data: data }), layers)
+            );
+        },
+    },
+});
@@ -0,0 +1,57 @@
+// Copyright (c) 2022, Colas Droin. All rights reserved.
+// Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+// Client-side stacking of the layers displayed above the section images: the Allen Brain Atlas
+// contours, and the brain regions selected on the region analysis page. Each layer is a small
+// transparent image served under its own URL (see Figures.get_layer_url), referenced by the
+// figure metadata or by the stores of the page. Toggling the annotations or adding a region
+// therefore only fetches the corresponding layer (once, then from the browser cache), instead of
+// re-sending the whole figure.
+
+function layersImageTrace(source) {
+    return { type: "image", visible: true, source: source, hoverinfo: "skip" };
+}
+
+function layersStack(figure, sources) {
+    const layers = sources.filter((source) => source).map(layersImageTrace);
+    if (layers.length === 0) {
+        return figure;
+    }
+    return Object.assign({}, figure, { data: figure.data.concat(layers) });
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    layers: {
+        // Region analysis page: the annotations, then the selected regions (masks) as layers, and
+        // the drawn regions as shapes. l_shapes_and_masks holds [kind, name, layer URL or shape,
+        // color index] entries (see page_3_plot_heatmap_long in pages/region_analysis.py).
+        compose_region: function (figure, annotations_checked, l_shapes_and_masks) {
+            if (!figure || !figure.layout) {
+                return window.dash_clientside.no_update;
+            }
+            const meta = figure.layout.meta || {};
+            const entries = l_shapes_and_masks || [];
+            const sources = [annotations_checked ? meta.overlay_source : null].concat(
+                entries.filter((entry) => entry[0] === "mask").map((entry) => entry[2])
+            );
+            const shapes = entries.filter((entry) => entry[0] === "shape").map((entry) => entry[2]);
+
+            // Color of the next region, and at most 10 regions can be selected
+            const colors = meta.shape_colors || [];
+            const newshape = Object.assign({}, figure.layout.newshape);
+            if (colors.length > 0) {
+                newshape.fillcolor = colors[entries.length % colors.length];
+            }
+            const composed = layersStack(figure, sources);
+            return lbaeWithTemplate(
+                Object.assign({}, composed, {
+                    layout: Object.assign({}, figure.layout, {
+                        shapes: shapes,
+                        newshape: newshape,
+                        dragmode: entries.length > 10 ? false : "drawclosedpath",
+                    }),
+                })
+            );
+        },
+    },
+});
@@ -0,0 +1,53 @@
+// Copyright (c) 2022, Colas Droin. All rights reserved.
+// Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+// Dark template of the image figures, registered once client-side. The lightweight figures built
+// server-side (see build_image_figure_dict in modules/figures.py) do not embed the template, which
+// is added by the clientside callbacks displaying them (see assets/colormaps.js and
+// assets/tiles.js). This is the subset of the plotly_dark template that applies to 2D images.
+
+const LBAE_DARK_TEMPLATE = {
+    layout: {
+        autotypenumbers: "strict",
+        colorway: [
+            "#636efa", "#EF553B", "#00cc96", "#ab63fa", "#FFA15A",
+            "#19d3f3", "#FF6692", "#B6E880", "#FF97FF", "#FECB52",
+        ],
+        font: { color: "#f2f5fa" },
+        hovermode: "closest",
+        hoverlabel: { align: "left" },
+        paper_bgcolor: "rgb(17,17,17)",
+        plot_bgcolor: "rgb(17,17,17)",
+        xaxis: {
+            gridcolor: "#283442",
+            linecolor: "#506784",
+            ticks: "",
+            title: { standoff: 15 },
+            zerolinecolor: "#283442",
+            automargin: true,
+            zerolinewidth: 2,
+        },
+        yaxis: {
+            gridcolor: "#283442",
+            linecolor: "#506784",
+            ticks: "",
+            title: { standoff: 15 },
+            zerolinecolor: "#283442",
+            automargin: true,
+            zerolinewidth: 2,
+        },
+        shapedefaults: { line: { color: "#f2f5fa" } },
+        annotationdefaults: { arrowcolor: "#f2f5fa", arrowhead: 0, arrowwidth: 1 },
+        updatemenudefaults: { bgcolor: "#506784", borderwidth: 0 },
+        title: { x: 0.05 },
+    },
+};
+
+function lbaeWithTemplate(figure) {
+    if (!figure || !figure.layout || figure.layout.template) {
+        return figure;
+    }
+    return Object.assign({}, figure, {
+        layout: Object.assign({}, figure.layout, { template: LBAE_DARK_TEMPLATE }),
+    });
+}
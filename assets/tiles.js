@@ -0,0 +1,123 @@
+// Copyright (c) 2022, Colas Droin. All rights reserved.
+// Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+// Tiled display of the large mosaics shown in "all sections" mode. The server sends figures whose
+// layout metadata references the URL template of a pyramid of tiles (see
+// Figures.build_tiled_heatmap). The tiles are added as layout images, and only those visible in
+// the current view are requested, at the level of the pyramid matching the zoom: the first paint
+// only loads the few tiles of the coarsest level, and zooming in loads full-resolution detail on
+// demand. Tiles are served as immutable, so panning back and forth hits the browser cache.
+
+// Last view of each mosaic, by URL template, since relayout events may only carry one axis
+const tilesViews = new Map();
+
+function tilesUpdateView(meta, relayout_data) {
+    const view = tilesViews.get(meta.url) || {
+        x: [-0.5, meta.width - 0.5],
+        y: [-0.5, meta.height - 0.5],
+    };
+    if (relayout_data) {
+        if (relayout_data["xaxis.autorange"] || relayout_data["yaxis.autorange"]) {
+            view.x = [-0.5, meta.width - 0.5];
+            view.y = [-0.5, meta.height - 0.5];
+        }
+        if ("xaxis.range[0]" in relayout_data) {
+            view.x = [relayout_data["xaxis.range[0]"], relayout_data["xaxis.range[1]"]];
+        }
+        if ("yaxis.range[0]" in relayout_data) {
+            view.y = [relayout_data["yaxis.range[0]"], relayout_data["yaxis.range[1]"]];
+        }
+    }
+    tilesViews.set(meta.url, view);
+    return view;
+}
+
+function tilesLevelImages(meta, level, x_range, y_range) {
+    // Side of the tiles of this level, in pixels of the full-resolution image
+    const scale = Math.pow(2, level);
+    const span = meta.tile_size * scale;
+    const n_cols = Math.ceil(Math.ceil(meta.width / scale) / meta.tile_size);
+    const n_rows = Math.ceil(Math.ceil(meta.height / scale) / meta.tile_size);
+    const first_col = Math.max(0, Math.floor((x_range[0] + 0.5) / span));
+    const last_col = Math.min(n_cols - 1, Math.floor((x_range[1] + 0.5) / span));
+    const first_row = Math.max(0, Math.floor((y_range[0] + 0.5) / span));
+    const last_row = Math.min(n_rows - 1, Math.floor((y_range[1] + 0.5) / span));
+
+    const images = [];
+    for (let row = first_row; row <= last_row; row++) {
+        for (let col = first_col; col <= last_col; col++) {
+            images.push({
+                source: meta.url
+                    .replace("{level}", level)
+                    .replace("{row}", row)
+                    .replace("{col}", col),
+                xref: "x",
+                yref: "y",
+                x: col * span - 0.5,
+                y: row * span - 0.5,
+                // Tiles of the last row and column are cropped to the image
+                sizex: Math.min(span, meta.width - col * span),
+                sizey: Math.min(span, meta.height - row * span),
+                xanchor: "left",
+                yanchor: "top",
+                sizing: "stretch",
+                layer: "below",
+            });
+        }
+    }
+    return images;
+}
+
+function tilesRender(figure, relayout_data) {
+    const meta = figure.layout.meta.tiles;
+    const view = tilesUpdateView(meta, relayout_data);
+    const x_range = [Math.min(...view.x), Math.max(...view.x)];
+    const y_range = [Math.min(...view.y), Math.max(...view.y)];
+
+    // Pick the coarsest level still providing at least one tile pixel per screen pixel
+    const graph = document.getElementById(meta.graph_id);
+    const width_px = (graph && graph.clientWidth) || 1000;
+    const height_px = (graph && graph.clientHeight) || 800;
+    const ratio = Math.max(
+        (x_range[1] - x_range[0]) / width_px,
+        (y_range[1] - y_range[0]) / height_px
+    );
+    const level = Math.min(meta.n_levels - 1, Math.max(0, Math.floor(Math.log2(ratio))));
+
+    // The coarsest level is always drawn below, such that panning never shows empty areas
+    let images = tilesLevelImages(meta, meta.n_levels - 1, x_range, y_range);
+    if (level < meta.n_levels - 1) {
+        images = images.concat(tilesLevelImages(meta, level, x_range, y_range));
+    }
+    return Object.assign({}, figure, {
+        layout: Object.assign({}, figure.layout, { images: images }),
+    });
+}
+
+function tilesTriggeredByRelayout() {
+    const context = window.dash_clientside.callback_context;
+    const triggered = (context && context.triggered) || [];
+    return (
+        triggered.length > 0 &&
+        triggered.every((trigger) => trigger.prop_id.endsWith(".relayoutData"))
+    );
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    tiles: {
+        render_tiles: function (figure, relayout_data) {
+            if (!figure) {
+                // Figure not computed yet
+                return window.dash_clientside.no_update;
+            }
+            const meta = figure && figure.layout && figure.layout.meta;
+            if (!meta || !meta.tiles) {
+                // Figure already rendered server-side (see assets/template.js for the template)
+                return tilesTriggeredByRelayout()
+                    ? window.dash_clientside.no_update
+                    : lbaeWithTemplate(figure);
+            }
+            return lbaeWithTemplate(tilesRender(figure, relayout_data));
+        },
+    },
+});
@@ -0,0 +1,92 @@
+// Copyright (c) 2022, Colas Droin. All rights reserved.
+// Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+// Decoding of the 3D figures whose data arrays are sent as base64 binary buffers instead of JSON
+// lists of numbers (see pack_3D_figure in modules/figures.py). Integer arrays are decoded into
+// typed arrays as is, quantized arrays into Float32Arrays (NaN being restored), and the
+// coordinates of volumes sampled on a regular grid are rebuilt from the shape of the grid.
+
+const TYPED_ARRAYS = {
+    int32: Int32Array,
+    uint8: Uint8Array,
+    uint16: Uint16Array,
+    uint32: Uint32Array,
+};
+
+function typedIsEncoded(value) {
+    return value !== null && typeof value === "object" && typeof value.bdata === "string";
+}
+
+function typedDecodeArray(encoded) {
+    const binary = atob(encoded.bdata);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    const array = new TYPED_ARRAYS[encoded.dtype](bytes.buffer);
+    if (encoded.scale === undefined) {
+        return array;
+    }
+    const values = new Float32Array(array.length);
+    for (let i = 0; i < array.length; i++) {
+        values[i] =
+            array[i] === encoded.nan ? NaN : encoded.offset + array[i] * encoded.scale;
+    }
+    return values;
+}
+
+function typedGridCoordinates(shape) {
+    // Same order as np.indices(shape).reshape(3, -1), the first axis being z
+    const [n_z, n_y, n_x] = shape;
+    const x = new Uint16Array(n_z * n_y * n_x);
+    const y = new Uint16Array(x.length);
+    const z = new Uint16Array(x.length);
+    let n = 0;
+    for (let i = 0; i < n_z; i++) {
+        for (let j = 0; j < n_y; j++) {
+            for (let k = 0; k < n_x; k++, n++) {
+                z[n] = i;
+                y[n] = j;
+                x[n] = k;
+            }
+        }
+    }
+    return { x: x, y: y, z: z };
+}
+
+function typedDecodeTrace(trace) {
+    const decoded = Object.assign({}, trace);
+    if (decoded.lbae_grid) {
+        Object.assign(decoded, typedGridCoordinates(decoded.lbae_grid));
+        delete decoded.lbae_grid;
+    }
+    for (const key of Object.keys(decoded)) {
+        if (typedIsEncoded(decoded[key])) {
+            decoded[key] = typedDecodeArray(decoded[key]);
+        }
+    }
+    if (decoded.marker && typedIsEncoded(decoded.marker.color)) {
+        decoded.marker = Object.assign({}, decoded.marker, {
+            color: typedDecodeArray(decoded.marker.color),
+        });
+    }
+    return decoded;
+}
+
+function typedDecodeFigure(figure) {
+    if (!figure || !figure.data) {
+        return figure;
+    }
+    return Object.assign({}, figure, { data: figure.data.map(typedDecodeTrace) });
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    typed: {
+        decode_figure: function (figure) {
+            if (!figure) {
+                return window.dash_clientside.no_update;
+            }
+            return typedDecodeFigure(figure);
+        },
+    },
+});
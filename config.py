@@ -6,6 +6,7 @@
 # ==================================================================================================
 # --- Imports
 # ==================================================================================================
+import os
 import numpy as np
 from matplotlib import cm
 from matplotlib.colors import ListedColormap
@@ -39,3 +40,42 @@ basic_config = {
 newcolors = cm.get_cmap("viridis", 256)(np.linspace(0, 1, 256))
 newcolors[:1, :] = np.array([0 / 256, 0 / 256, 0 / 256, 1])
 black_viridis = ListedColormap(newcolors)
+
+# Route serving the encoded images of the app over HTTP (see app.py), and version of the served
+# images. The version is part of every image URL: since the responses are cached as immutable by
+# the browsers and proxies, it must be bumped whenever the underlying data changes.
+image_route = "/images/"
+image_cache_version = os.environ.get("LBAE_IMAGE_VERSION", "1")
+
+# Maximum number of images rendered concurrently by the image routes, in each worker process
+max_concurrent_image_renders = 4
+
+# Colors (RGBA) available for the Allen Brain Atlas contours overlaid on the images
+dic_overlay_colors = {
+    "orange": [255, 165, 0, 200],
+    "cyan": [0, 255, 255, 200],
+    "black": [0, 0, 0, 200],
+}
+
+# Load-adaptive render quality (see modules/render_quality.py): when more than max_pending other
+# renders are pending, or when the 95th percentile of the render latency over the last
+# render_quality_window_seconds exceeds max_p95_seconds while other renders are pending, pages
+# serve previews whose resolution is divided by preview_resolution_factor, encoded as lossy WebP
+# with preview_quality, and upgrade them once the app is idle (checked every
+# render_quality_upgrade_interval_ms). Renders running for more than render_pending_max_age_seconds
+# are no longer counted as pending, such that renders killed before completion (e.g. superseded long
+# callbacks) do not leave the app degraded.
+render_quality_window_seconds = 60
+render_pending_max_age_seconds = 120
+render_quality_upgrade_interval_ms = 3000
+dic_render_quality_thresholds = {
+    "default": {
+        "max_pending": 4,
+        "max_p95_seconds": 5.0,
+        "preview_resolution_factor": 2,
+        "preview_quality": 60,
+    },
+    # Pages combining several layers are slower to render, and degrade earlier
+    "lipizones_vs_celltypes": {"max_pending": 2, "max_p95_seconds": 3.0},
+    "lipids_vs_genes": {"max_pending": 2, "max_p95_seconds": 3.0},
+}
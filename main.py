@@ -18,6 +18,11 @@ following command:
 
 `pkill -P1 gunicorn`
 
+To merge offline the ID cards of the most common lipizone selections, such that they are served from
+the on-disk cache from the first request on, run the following command once the data is in place:
+
+`python main.py --precompute-id-cards`
+
 For a faster app, please install orjson with pip before launching the app:
 
 `pip install orjson`
@@ -31,6 +36,7 @@ WARNING: because of a bug with the shelvedb, the app precomputations must be com
 # --- Imports
 # ==================================================================================================
 
+import argparse
 import logging
 from modules.tools.misc import logmem  # To track memory usage
 import dash_mantine_components as dmc
@@ -85,6 +91,20 @@ server = app.server
 # --- App execution
 # ==================================================================================================
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the app, or one of its offline steps.")
+    parser.add_argument(
+        "--precompute-id-cards",
+        action="store_true",
+        help="Merge the ID cards of the common lipizone selections instead of running the app.",
+    )
+    args = parser.parse_args()
+
+    if args.precompute_id_cards:
+        from pages.lipizones_selection import precompute_merged_id_cards
+
+        precompute_merged_id_cards()
+        raise SystemExit(0)
+
     logging.info("Starting app" + logmem())
     try:
         app.run(port=8100, debug=False)
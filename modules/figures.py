@@ -17,6 +17,7 @@ import plotly.express as px
 from skimage import io
 from scipy.ndimage.interpolation import map_coordinates
 import pandas as pd
+import zarr
 from scipy.interpolate import griddata
 from modules.tools.external_lib.clustergram import Clustergram
 import copy
@@ -26,11 +27,15 @@ import PyPDF2
 import base64
 import re
 import os
+import shutil
+import threading
+from collections import OrderedDict
 from tqdm import tqdm
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, maximum_filter, minimum_filter
 import traceback
 import gc
 import time
+from urllib.parse import urlencode
 
 import matplotlib.colors as mcolors
 from matplotlib.cm import PuRd, viridis
@@ -43,7 +48,16 @@ import hashlib
 
 
 # LBAE imports
-from modules.tools.image import convert_image_to_base64
+from modules.tools.image import (
+    convert_image_to_base64,
+    convert_image_to_bytes,
+    convert_layer_to_bytes,
+    build_image_pyramid,
+    get_image_tile,
+    load_image_pyramid,
+    save_image_pyramid,
+    TILE_SIZE,
+)
 from modules.tools.atlas import project_image, slice_to_atlas_transform
 from modules.tools.volume import (
     filter_voxels,
@@ -51,8 +65,23 @@ from modules.tools.volume import (
     fill_array_interpolation,
     fill_array_slices,
     crop_array,
+    load_volume_level,
+    load_or_compute_array,
+    sample_voxels_stratified,
+    compute_label_index,
+    get_label_mask,
+)
+from modules.tools.mesh import (
+    MESH_ATLAS_FACTOR,
+    MESH_LIPID_LEVELS,
+    MESH_LIPID_OPACITIES,
+    compute_mask_mesh,
+    compute_volume_meshes,
+    get_mesh_path,
+    get_lipid_mesh_name,
+    load_or_compute_mesh,
 )
-from config import dic_colors, l_colors
+from config import dic_colors, l_colors, image_route, image_cache_version, dic_overlay_colors
 from modules.tools.spectra import (
     compute_image_using_index_and_image_lookup,
     compute_index_boundaries,
@@ -79,6 +108,14 @@ def black_aba_contours(overlay):
     
     return black_overlay
 
+def color_aba_contours(overlay, color):
+    """Recolor the Allen Brain Atlas contours with one of the colors of dic_overlay_colors."""
+    colored_overlay = overlay.copy()
+    contour_mask = overlay[:, :, 3] > 0
+    colored_overlay[contour_mask] = dic_overlay_colors[color]
+
+    return colored_overlay
+
 def hex_to_rgb(hex_color):
     """Convert hexadecimal color to RGB values."""
     hex_color = hex_color.lstrip('#')
@@ -164,6 +201,433 @@ def merge_pdfs(pdf_paths):
         logging.error(f"Error in merge_pdfs: {str(e)}")
         raise
 
+# Blurred backgrounds and label images of the lipizones, per section and per sample. Only the most
+# recently used ones are kept, as the layers of a sample hold full mosaics.
+dic_lipizone_layers = OrderedDict()
+lock_lipizone_layers = threading.Lock()
+MAX_LIPIZONE_LAYERS = 8
+
+def get_lipizone_layers(key, section_data):
+    """Returns the layers used to highlight lipizones in a section (or in the grid of sections of a
+    sample): the contrast-enhanced and blurred grayscale background, and a label image holding,
+    for each pixel, the index of its color in section_data["color_masks"] (-1 if none). These only
+    depend on the section, and are kept for the MAX_LIPIZONE_LAYERS most recently used keys.
+
+    Args:
+        key (tuple): Identifier of the section or sample, e.g. ("section", slice_index).
+        section_data (dict): Section (or sample) data, with the "grayscale_image" and "color_masks"
+            entries.
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): The background, the label image, and the colors of
+            the labels (n_colors, 3), in the 0-1 range.
+    """
+    with lock_lipizone_layers:
+        if key in dic_lipizone_layers:
+            dic_lipizone_layers.move_to_end(key)
+            return dic_lipizone_layers[key]
+
+    color_masks = section_data["color_masks"]
+    l_colors = list(color_masks.keys())
+
+    # Apply a power transformation to enhance contrast, then blur
+    background = np.power(section_data["grayscale_image"], float(1 / 6))
+    background = gaussian_filter(background, sigma=3)
+    background *= ~color_masks[l_colors[0]]
+
+    labels = np.full(background.shape, -1, dtype=np.int32)
+    for index, color in enumerate(l_colors):
+        labels[color_masks[color]] = index
+
+    layers = (background, labels, np.array(l_colors, dtype=np.float64))
+    with lock_lipizone_layers:
+        dic_lipizone_layers[key] = layers
+        dic_lipizone_layers.move_to_end(key)
+        while len(dic_lipizone_layers) > MAX_LIPIZONE_LAYERS:
+            dic_lipizone_layers.popitem(last=False)
+    return layers
+
+def get_highlight_mask(labels, label_colors, rgb_colors_to_highlight, threshold=0.05):
+    """Returns the mask of the pixels whose lipizone color is among the colors to highlight (or
+    closer than threshold, in squared distance, to one of them), as a single gather of a boolean
+    lookup table over the label image.
+
+    Args:
+        labels (np.ndarray): Label image, as returned by get_lipizone_layers().
+        label_colors (np.ndarray): Colors of the labels (n_colors, 3), in the 0-1 range.
+        rgb_colors_to_highlight (list(np.ndarray)): Colors to highlight, in the 0-1 range.
+        threshold (float, optional): Maximum squared distance to the closest label color.
+            Defaults to 0.05.
+
+    Returns:
+        (np.ndarray): Boolean mask with the shape of labels.
+    """
+    # The last entry of the lookup table corresponds to the -1 (unlabelled) pixels
+    lut = np.zeros(len(label_colors) + 1, dtype=bool)
+    if len(rgb_colors_to_highlight) > 0 and len(label_colors) > 0:
+        targets = np.array(rgb_colors_to_highlight, dtype=np.float64).reshape(-1, 3)
+        distances = ((targets[:, None, :] - label_colors[None, :, :]) ** 2).sum(axis=-1)
+        closest = np.argmin(distances, axis=1)
+        lut[closest[distances[np.arange(len(targets)), closest] < threshold]] = True
+    return lut[labels]
+
+# Layout shared by the lightweight image figures (see build_image_figure_dict), equivalent to the
+# one of Figures.build_lipid_heatmap_from_source. The dark template is not embedded in each
+# figure, but registered once client-side (see assets/template.js).
+dic_light_layout = {
+    "margin": {"t": 0, "r": 0, "b": 0, "l": 0},
+    "newshape": {
+        "fillcolor": dic_colors["blue"],
+        "opacity": 0.7,
+        "line": {"color": "white", "width": 1},
+    },
+    "xaxis": {"showgrid": False, "zeroline": False, "showticklabels": False},
+    "yaxis": {"showgrid": False, "zeroline": False, "showticklabels": False},
+    "coloraxis": {"showscale": False},
+    "plot_bgcolor": "rgba(0,0,0,0)",
+    "paper_bgcolor": "rgba(0,0,0,0)",
+}
+
+def build_image_figure_dict(source, draw=False, pixel_size=1):
+    """Lightweight counterpart of Figures.build_lipid_heatmap_from_source, which emits a plain
+    figure dict instead of building (and validating) a go.Figure, and does not embed the template.
+    The figures built this way must be displayed through a clientside callback that applies the
+    template (see assets/template.js).
+
+    Args:
+        source (str): The source of the image, either a base64 string or a URL.
+        draw (bool, optional): If True, the user will have the possibility to draw on the figure.
+            Defaults to False.
+        pixel_size (int, optional): The size of the pixels of the source, in pixels of the full
+            resolution image. Defaults to 1.
+
+    Returns:
+        (dict): The figure.
+    """
+    image = {"type": "image", "visible": True, "source": source}
+    if pixel_size != 1:
+        image.update(
+            x0=(pixel_size - 1) / 2, y0=(pixel_size - 1) / 2, dx=pixel_size, dy=pixel_size
+        )
+    layout = copy.deepcopy(dic_light_layout)
+    layout["dragmode"] = "drawclosedpath" if draw else "pan"
+    return {"data": [image], "layout": layout}
+
+def encode_typed_array(array, quantization=None):
+    """Encodes a flat data array as a base64 binary buffer, which is decoded into a typed array
+    client-side (see assets/typed.js), instead of a JSON list of numbers.
+
+    Args:
+        array (np.ndarray): The array to encode.
+        quantization (type, optional): If None, the array must hold integers, which are sent
+            exactly with the smallest fitting type. Otherwise, np.uint8 or np.uint16: the values
+            are quantized linearly between their extrema, the last level being reserved for NaN.
+            Defaults to None.
+
+    Returns:
+        (dict): The encoded array, with its type ("dtype"), its buffer ("bdata"), and for quantized
+            arrays the parameters to recover the values ("offset", "scale" and "nan").
+    """
+    array = np.asarray(array).reshape(-1)
+    if quantization is None:
+        if len(array) > 0 and array.min() < 0:
+            dtype = np.int32
+        elif len(array) == 0 or array.max() < 2**8:
+            dtype = np.uint8
+        elif array.max() < 2**16:
+            dtype = np.uint16
+        else:
+            dtype = np.uint32
+        encoded = {"dtype": np.dtype(dtype).name}
+        array_typed = array.astype(np.dtype(dtype).newbyteorder("<"))
+    else:
+        nan_value = np.iinfo(quantization).max
+        array = array.astype(np.float64)
+        finite = np.isfinite(array)
+        vmin, vmax = (array[finite].min(), array[finite].max()) if finite.any() else (0.0, 1.0)
+        scale = (vmax - vmin) / (nan_value - 1) if vmax > vmin else 1.0
+        array_typed = np.full(len(array), nan_value, dtype=np.dtype(quantization).newbyteorder("<"))
+        array_typed[finite] = np.round((array[finite] - vmin) / scale)
+        encoded = {
+            "dtype": np.dtype(quantization).name,
+            "offset": float(vmin),
+            "scale": float(scale),
+            "nan": int(nan_value),
+        }
+    encoded["bdata"] = base64.b64encode(array_typed.tobytes()).decode("ascii")
+    return encoded
+
+
+def is_integer_array(array):
+    """Returns True if the values of the array are all integers (whatever its dtype)."""
+    array = np.asarray(array)
+    if np.issubdtype(array.dtype, np.integer):
+        return True
+    return bool(np.issubdtype(array.dtype, np.floating) and np.all(np.mod(array, 1) == 0))
+
+
+def pack_3D_trace(trace):
+    """Encodes the data arrays of a 3D trace (go.Volume, go.Mesh3d or go.Scatter3d, as a dict) as
+    binary buffers (see encode_typed_array()): integer coordinates and face indices are sent
+    exactly, other coordinates are quantized to uint16 and volume values to uint8. The coordinates
+    of the volumes sampled on a regular grid (built with np.indices) are not sent at all, but
+    replaced by the shape of the grid ("lbae_grid").
+
+    Args:
+        trace (dict): The trace.
+
+    Returns:
+        (dict): The packed trace.
+    """
+    trace = dict(trace)
+    if trace.get("type") == "volume" and all(key in trace for key in ("x", "y", "z")):
+        z, y, x = (np.asarray(trace[key]).reshape(-1) for key in ("z", "y", "x"))
+        if len(x) > 0 and is_integer_array(x):
+            shape = (int(z.max()) + 1, int(y.max()) + 1, int(x.max()) + 1)
+            if len(x) == np.prod(shape) and all(
+                np.array_equal(a, b.reshape(-1)) for a, b in zip((z, y, x), np.indices(shape))
+            ):
+                trace["lbae_grid"] = list(shape)
+                del trace["x"], trace["y"], trace["z"]
+
+    for key in ("x", "y", "z", "i", "j", "k", "value"):
+        if key not in trace or trace[key] is None or np.isscalar(trace[key]):
+            continue
+        array = np.asarray(trace[key])
+        if key == "value":
+            trace[key] = encode_typed_array(array, quantization=np.uint8)
+        elif is_integer_array(array):
+            trace[key] = encode_typed_array(array)
+        else:
+            trace[key] = encode_typed_array(array, quantization=np.uint16)
+
+    # Numerical colors of the markers (e.g. indices in a colorscale)
+    marker = trace.get("marker")
+    if isinstance(marker, dict) and isinstance(marker.get("color"), np.ndarray):
+        if is_integer_array(marker["color"]):
+            trace["marker"] = dict(marker, color=encode_typed_array(marker["color"]))
+    return trace
+
+
+def pack_3D_figure(fig):
+    """Converts a figure of 3D traces into a dict whose data arrays are sent as binary buffers
+    (see pack_3D_trace()). The figures packed this way must be displayed through a clientside
+    callback that decodes them (see assets/typed.js).
+
+    Args:
+        fig (go.Figure): The figure.
+
+    Returns:
+        (dict): The packed figure.
+    """
+    figure = fig.to_plotly_json()
+    return {
+        "data": [pack_3D_trace(trace) for trace in figure["data"]],
+        "layout": figure["layout"],
+    }
+
+# Pyramids of the tiled mosaics, by tiles key (see get_image_pyramid). They are stored on disk and
+# memory-mapped, such that they are built once for all the processes of the app, and the on-disk
+# cache is kept under MAX_IMAGE_PYRAMIDS_BYTES by evicting the least recently used pyramids. Each
+# process only keeps the memory maps of the most recently used ones.
+PATH_IMAGE_PYRAMIDS = "./data/cache/image_pyramids"
+MAX_IMAGE_PYRAMIDS_BYTES = 2 * 1024**3
+dic_image_pyramids = OrderedDict()
+lock_image_pyramids = threading.Lock()
+MAX_IMAGE_PYRAMIDS = 8
+
+# Interpolated 3D lipid volumes, and their precomputed pyramids (see build_volume_pyramid in
+# modules/tools/volume.py)
+PATH_3D_INTERPOLATED = "./data/3d_interpolated_native"
+PATH_3D_PYRAMIDS = os.path.join(PATH_3D_INTERPOLATED, "pyramids")
+
+# Subsampled arrays of the Allen Brain Atlas (annotations and root volumes), by name (see
+# get_atlas_array). They are also stored on disk, such that they are computed once for all the
+# processes of the app.
+dic_atlas_arrays = {}
+PATH_ATLAS_ARRAYS = "./data/atlas/arrays"
+
+def get_atlas_array(name, compute_array):
+    """Returns the (read-only) atlas array registered under name, loading it from disk or computing
+    it with compute_array() if needed.
+
+    Args:
+        name (str): Name of the array, e.g. "annotation_x8".
+        compute_array (function): Function returning the array.
+
+    Returns:
+        (np.ndarray): The array.
+    """
+    if name not in dic_atlas_arrays:
+        dic_atlas_arrays[name] = load_or_compute_array(
+            os.path.join(PATH_ATLAS_ARRAYS, name + ".npy"), compute_array
+        )
+    return dic_atlas_arrays[name]
+
+# Masks of the selected regions in the subsampled atlas, by factor and region ids (see
+# Figures.get_array_of_regions_mask). Only the most recently used ones are kept.
+dic_regions_masks = OrderedDict()
+lock_regions_masks = threading.Lock()
+MAX_REGIONS_MASKS = 16
+
+# Isosurface meshes of the lipid volumes filtered by region, by lipid, factor and region ids (the
+# meshes of the whole brain are stored on disk, see Figures.compute_3D_lipid_meshes)
+dic_lipid_meshes = OrderedDict()
+lock_lipid_meshes = threading.Lock()
+MAX_LIPID_MESHES = 16
+
+# Point clouds of all the lipizones, sampled once from the color array (see
+# Figures.get_lipizones_point_cloud), and the corresponding figures, by downsampling factor (and
+# packing, see pack_3D_figure)
+dic_lipizones_point_clouds = {}
+dic_lipizones_figures = {}
+MAX_LIPIZONES_POINTS = 400000
+
+# Index of the voxels of each lipizone in the 3D label volume (see Figures.get_lipizones_index)
+dic_lipizones_index = {}
+
+def build_mesh_trace(vertices, faces, color, opacity, name=None):
+    """Builds the go.Mesh3d trace of a mesh, whose vertices are in voxel coordinates in the order of
+    the array axes, displayed on the same axes as the go.Volume traces (z, y, x).
+
+    Args:
+        vertices (np.ndarray): The vertices of the mesh, of shape (n_vertices, 3).
+        faces (np.ndarray): The triangular faces of the mesh, of shape (n_faces, 3).
+        color (str): The color of the mesh.
+        opacity (float): The opacity of the mesh.
+        name (str, optional): The name of the trace. Defaults to None.
+
+    Returns:
+        (go.Mesh3d): The mesh trace.
+    """
+    return go.Mesh3d(
+        x=vertices[:, 2],
+        y=vertices[:, 1],
+        z=vertices[:, 0],
+        i=faces[:, 0],
+        j=faces[:, 1],
+        k=faces[:, 2],
+        color=color,
+        opacity=opacity,
+        name=name,
+        flatshading=False,
+        hoverinfo="skip",
+        showscale=False,
+    )
+
+def evict_image_pyramids(keep_path=None):
+    """Removes the least recently used pyramids from the disk until the cache fits in
+    MAX_IMAGE_PYRAMIDS_BYTES. Processes that still map a removed pyramid keep reading it."""
+    entries = []
+    for entry in os.scandir(PATH_IMAGE_PYRAMIDS):
+        if entry.is_dir() and not entry.name.endswith(".tmp"):
+            size = sum(level.stat().st_size for level in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= MAX_IMAGE_PYRAMIDS_BYTES:
+            break
+        if path == keep_path:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+def get_image_pyramid(tiles_key, compute_image=None):
+    """Returns the image pyramid registered under tiles_key, loading it from the disk, or building
+    it from compute_image() if needed (e.g. when the tiles are requested after the pyramid has
+    been evicted).
+
+    Args:
+        tiles_key (str): Key of the mosaic (see Figures.get_tiles_key()).
+        compute_image (function, optional): Function returning the image of the mosaic. Defaults
+            to None.
+
+    Returns:
+        (list(np.ndarray)): The image pyramid, or None if it is not stored and compute_image is
+            None.
+    """
+    with lock_image_pyramids:
+        if tiles_key in dic_image_pyramids:
+            dic_image_pyramids.move_to_end(tiles_key)
+            return dic_image_pyramids[tiles_key]
+
+    path = os.path.join(PATH_IMAGE_PYRAMIDS, hashlib.md5(tiles_key.encode()).hexdigest())
+    pyramid = load_image_pyramid(path)
+    if pyramid is None:
+        if compute_image is None:
+            return None
+        image = compute_image()
+        if image is None:
+            return None
+        pyramid = build_image_pyramid(image)
+        os.makedirs(PATH_IMAGE_PYRAMIDS, exist_ok=True)
+        save_image_pyramid(path, pyramid)
+        evict_image_pyramids(keep_path=path)
+        # Map the saved pyramid, to release the memory of the built one
+        pyramid = load_image_pyramid(path) or pyramid
+    else:
+        # Refresh the modification time, used as LRU timestamp for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    with lock_image_pyramids:
+        dic_image_pyramids[tiles_key] = pyramid
+        dic_image_pyramids.move_to_end(tiles_key)
+        while len(dic_image_pyramids) > MAX_IMAGE_PYRAMIDS:
+            dic_image_pyramids.popitem(last=False)
+    return pyramid
+
+# Cells of the celltypes, per section. Only the most recently used sections are kept.
+dic_celltype_cells = OrderedDict()
+lock_celltype_cells = threading.Lock()
+MAX_CELLTYPE_CELLS = 16
+
+def get_celltype_cells(key, section_data):
+    """Returns the cells of a section, as the coordinates of their centers in the orientation of
+    the sections (the celltype masks are stored transposed) along with the index of their
+    celltype. Unlike a label image, cells of different celltypes centered on the same pixel are
+    all kept. The cells are kept for the MAX_CELLTYPE_CELLS most recently used sections.
+
+    Args:
+        key (tuple): Identifier of the section, e.g. ("section", slice_index).
+        section_data (dict): Celltype data of the section, with the "color_masks" entry.
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray, list(str)): The rows and columns of the cells, the
+            index of their celltype, and the celltype names of the indices.
+    """
+    with lock_celltype_cells:
+        if key in dic_celltype_cells:
+            dic_celltype_cells.move_to_end(key)
+            return dic_celltype_cells[key]
+
+    color_masks = section_data["color_masks"]
+    l_names = list(color_masks.keys())
+    # Seeded with empty arrays, for the sections without cells
+    empty = np.zeros(0, dtype=np.int64)
+    l_rows, l_cols, l_labels = [empty], [empty], [empty]
+    for index, name in enumerate(l_names):
+        rows, cols = np.nonzero(color_masks[name].T)
+        l_rows.append(rows)
+        l_cols.append(cols)
+        l_labels.append(np.full(len(rows), index, dtype=np.int64))
+    cells = (
+        np.concatenate(l_rows),
+        np.concatenate(l_cols),
+        np.concatenate(l_labels),
+        l_names,
+    )
+
+    with lock_celltype_cells:
+        dic_celltype_cells[key] = cells
+        dic_celltype_cells.move_to_end(key)
+        while len(dic_celltype_cells) > MAX_CELLTYPE_CELLS:
+            dic_celltype_cells.popitem(last=False)
+    return cells
+
 def get_memory_usage():
     """Get current memory usage in MB"""
     try:
@@ -214,14 +678,18 @@ class Figures:
         compute_3D_root_volume(): Generate a go.Isosurface of the Allen Brain root structure,
             which will be used to enclose the display of lipid expression of other structures in the
             brain.
+        compute_3D_root_mesh(): Generate a go.Mesh3d of the surface of the Allen Brain root
+            structure, lighter than compute_3D_root_volume().
+        compute_3D_lipid_meshes(): Computes the go.Mesh3d isosurfaces of the volume of a lipid.
         get_array_of_annotations(): Returns the array of annotations from the Allen Brain Atlas,
             subsampled to decrease the size of the output.
         compute_l_array_2D(): Gets the list of expression per slice for all slices for the
             computation of the 3D brain volume.
         compute_array_coordinates_3D(): Computes the list of coordinates and expression values for
             the voxels used in the 3D representation of the brain.
-        compute_3D_volume_figure(): Computes a Plotly Figure containing a go.Volume object
-            representing the expression of the requested lipids in the selected regions.
+        compute_3D_volume_figure(): Computes a Plotly Figure containing isosurface meshes (or a
+            go.Volume object) representing the expression of the requested lipids in the selected
+            regions.
         compute_clustergram_figure(): Computes a Plotly Clustergram figure, allowing to cluster and
             compare the expression of all the MAIA-transformed lipids in the dataset in the selected
             regions.
@@ -236,11 +704,20 @@ class Figures:
             computed in compute_figure_basic_image(), across all slices and all types of arrays.
         shelve_all_l_array_2D(): Precomputes and shelves all the arrays of lipid expression used in
             a 3D representation of the brain.
-        shelve_all_arrays_annotation(): Precomputes and shelves the array of structure annotation
-            used in a 3D representation of the brain.
+        shelve_all_arrays_annotation(): Precomputes and stores the arrays of structure annotation
+            and the root volumes used in a 3D representation of the brain.
     """
 
-    __slots__ = ["_data", "_celltype_data", "_lipizone_data", "_atlas", "_storage", "_redis_client", "_use_redis"]
+    __slots__ = [
+        "_data",
+        "_dataset",
+        "_celltype_data",
+        "_lipizone_data",
+        "_atlas",
+        "_storage",
+        "_redis_client",
+        "_use_redis",
+    ]
 
     # ==============================================================================================
     # --- Constructor
@@ -253,6 +730,7 @@ class Figures:
         atlas,
         celltype_data=None,
         lipizone_data=None,
+        dataset="lipid",
         # gene_data=None,
         # brain_id, slice_index, lipid_name,
         # scRNAseq, sample=False
@@ -263,6 +741,9 @@ class Figures:
             maldi_data (MaldiData): MaldiData object, used to manipulate the raw MALDI data.
             storage (Storage): Used to access the shelve database.
             atlas (Atlas): Used to manipulate the objects coming from the Allen Brain Atlas.
+            dataset (str, optional): Name of the dataset handled by maldi_data ("lipid", "peak" or
+                "program"), used to build the URLs of the images served over HTTP. Defaults to
+                "lipid".
             scRNAseq (ScRNAseq): Used to manipulate the objects coming from the scRNAseq dataset.
             sample (bool, optional): If True, only a fraction of the precomputations are made (for
                 debug). Default to False.
@@ -271,6 +752,7 @@ class Figures:
 
         # Attribute to easily access the maldi and allen brain atlas data
         self._data = maldi_data
+        self._dataset = dataset
         self._atlas = atlas
         self._celltype_data = celltype_data
         self._lipizone_data = lipizone_data
@@ -381,13 +863,15 @@ class Figures:
     # --- Methods used mainly in lipid_selection
     # ==============================================================================================
 
-    def _generate_cache_key(self, image, return_base64_string, draw, type_image, return_go_image, overlay, colormap_type, session_id=None):
+    def _generate_cache_key(self, image, return_base64_string, draw, type_image, return_go_image, overlay, colormap_type, session_id=None, render_params=None):
         """Generate a unique cache key for the given parameters."""
         # Create a hash of the image data and parameters
         image_hash = hashlib.md5(image.tobytes()).hexdigest()
-        params_hash = hashlib.md5(
-            f"{return_base64_string}_{draw}_{type_image}_{return_go_image}_{colormap_type}".encode()
-        ).hexdigest()
+        params_string = f"{return_base64_string}_{draw}_{type_image}_{return_go_image}_{colormap_type}"
+        # Previews are cached separately from full-quality renders
+        if render_params:
+            params_string += f"_{sorted(render_params.items())}"
+        params_hash = hashlib.md5(params_string.encode()).hexdigest()
         
         # For overlay, create a hash if it exists
         overlay_hash = ""
@@ -415,6 +899,22 @@ class Figures:
         
         return None
 
+    def _get_many_from_cache(self, cache_keys):
+        """Try to get several cached results from Redis in a single round trip (MGET). Since all
+        the data objects of the app share the same Redis database, this can also be used to fetch
+        keys generated by other objects."""
+        if not self._use_redis or len(cache_keys) == 0:
+            return [None] * len(cache_keys)
+
+        try:
+            cached_results = self._redis_client.mget(cache_keys)
+            logging.info(f"CACHE MGET: {sum(r is not None for r in cached_results)}/{len(cache_keys)} hits")
+            return [pickle.loads(r) if r else None for r in cached_results]
+        except Exception as e:
+            logging.warning(f"Error reading from cache: {e}")
+
+        return [None] * len(cache_keys)
+
     def _save_to_cache(self, cache_key, result, expire_seconds=1800):  # 30 min instead of 1 hour
         """Save a result to Redis cache."""
         if not self._use_redis:
@@ -490,7 +990,7 @@ class Figures:
         slice_index,
         RGB_format=True,
         lipid_name="",
-        cache_flask=None,
+        slice_data=None,
     ):
         """This function allows to query the MALDI data to extract an image in the form of a Numpy
         array representing the intensity of the lipid peaking between the values lb_mz and hb_mz in
@@ -520,9 +1020,8 @@ class Figures:
                 lipid_name corresponds to an existing lipid. Defaults to False.
             lipid_name (str, optional): Name of the lipid that must be MAIA-transformed, if
                 apply_transform and normalize are True. Defaults to "".
-            cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
-                None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
-                None.
+            slice_data (SliceData, optional): Data of the slice, if already fetched by the caller.
+                Defaults to None.
         Returns:
             (np.ndarray): An image (in the form of a numpy array) representing the intensity of the
                 lipid peaking between the values lb_mz and hb_mz in the spectral data, for the slice
@@ -530,7 +1029,7 @@ class Figures:
         """
         logging.info("Entering compute_image_per_lipid")
         
-        image = self._data.extract_lipid_image(slice_index, lipid_name)
+        image = self._data.extract_lipid_image(slice_index, lipid_name, slice_data=slice_data)
         
         # In case of bug, return None
         if image is None:
@@ -551,6 +1050,10 @@ class Figures:
         return_go_image=False,
         overlay=None,
         colormap_type="viridis",
+        decrease_resolution_factor=1,
+        format="png",
+        quality=85,
+        light=False,
     ):
         """This function converts a numpy array into a base64 string, which can be returned
         directly, or itself be turned into a go.Image, which can be returned directly, or be
@@ -572,14 +1075,27 @@ class Figures:
                 image. Defaults to None.
             colormap_type (str, optional): The type of colormap to use. Options are "viridis" or "PuOr".
                 Defaults to "viridis".
+            decrease_resolution_factor (int, optional): Used to divide the resolution of the image,
+                e.g. to serve previews under load (see RenderQualityPolicy). Defaults to 1.
+            format (str, optional): The format of the encoded image. Defaults to "png".
+            quality (int, optional): The quality of lossy formats, from 0 to 100. Defaults to 85.
+            light (bool, optional): If True, the figure is returned as a plain dict without
+                template (see build_image_figure_dict()), to be displayed through a clientside
+                callback. Defaults to False.
         Returns:
             Depending on the inputted arguments, may either return a base64 string, a go.Image, or
                 a Plotly Figure.
         """
 
         # Generate cache key for this request
+        render_params = (
+            {"decrease_resolution_factor": decrease_resolution_factor, "format": format, "quality": quality, "light": light}
+            if (decrease_resolution_factor, format, quality, light) != (1, "png", 85, False)
+            else None
+        )
         cache_key = self._generate_cache_key(
-            image, return_base64_string, draw, type_image, return_go_image, overlay, colormap_type
+            image, return_base64_string, draw, type_image, return_go_image, overlay, colormap_type,
+            render_params=render_params,
         )
         
         # Try to get result from cache first
@@ -597,18 +1113,62 @@ class Figures:
             overlay=overlay, 
             transparent_zeros=True, 
             optimize=False, 
-            colormap_type=colormap_type
+            colormap_type=colormap_type,
+            decrease_resolution_factor=decrease_resolution_factor,
+            format=format,
+            quality=quality,
         )
 
         # Either return image directly
         if return_base64_string:
             return base64_string
 
-        # Or compute heatmap as go image if needed
+        # Or compute heatmap as go image or plotly graph (possibly as a plain dict)
+        if light and not return_go_image:
+            fig = build_image_figure_dict(
+                base64_string, draw=draw, pixel_size=decrease_resolution_factor
+            )
+        else:
+            fig = self.build_lipid_heatmap_from_source(
+                base64_string,
+                draw=draw,
+                return_go_image=return_go_image,
+                pixel_size=decrease_resolution_factor,
+            )
+
+        # Save result to cache for future use
+        if not return_go_image:
+            self._save_to_cache(cache_key, fig)
+
+        return fig
+
+    def build_lipid_heatmap_from_source(self, source, draw=False, return_go_image=False, pixel_size=1):
+        """This function turns an image source (a base64 string, or the URL of an image served by
+        the app) into a go.Image, which can be returned directly, or be turned into a Plotly
+        Figure, which will be returned.
+
+        Args:
+            source (str): The source of the image, either a base64 string or a URL.
+            draw (bool, optional): If True, the user will have the possibility to draw on the
+                resulting Plotly Figure. Defaults to False.
+            return_go_image (bool, optional): If True, the go.Image is returned directly, before
+                being integrated to a Plotly Figure. Defaults to False.
+            pixel_size (int, optional): The size of the pixels of the source, in pixels of the full
+                resolution image, such that reduced-resolution images keep the same coordinates.
+                Defaults to 1.
+
+        Returns:
+            Depending on the inputted arguments, may either return a go.Image, or a Plotly Figure.
+        """
         logging.info("Converting image to go image")
         final_image = go.Image(
             visible=True,
-            source=base64_string,
+            source=source,
+            **(
+                dict(x0=(pixel_size - 1) / 2, y0=(pixel_size - 1) / 2, dx=pixel_size, dy=pixel_size)
+                if pixel_size != 1
+                else {}
+            ),
         )
 
         # Potentially return the go image directly
@@ -651,18 +1211,375 @@ class Figures:
         
         logging.info("Returning figure")
 
-        # Save result to cache for future use
-        self._save_to_cache(cache_key, fig)
+        return fig
+
+    def get_image_url(self, slice_index, l_lipid_names, colormap_type="viridis", overlay_color=None):
+        """This function returns the URL under which the app serves the image of the requested
+        lipids in the requested slice (see the image route in app.py). The URL fully describes the
+        image, such that the response can be cached as immutable by the browser.
+
+        Args:
+            slice_index (int): The index of the requested slice.
+            l_lipid_names (list(str)): The names of the requested lipids. A single name produces a
+                colormapped image, several names (possibly None) produce an RGB image.
+            colormap_type (str, optional): The type of colormap to use for single-lipid images.
+                Defaults to "viridis".
+            overlay_color (str, optional): If not None, the Allen Brain Atlas contours are overlaid
+                on the image with the corresponding color of dic_overlay_colors. Defaults to None.
+
+        Returns:
+            (str): The URL of the image.
+        """
+        query = urlencode(
+            {
+                "features": [name if name is not None else "" for name in l_lipid_names],
+                "colormap": colormap_type,
+                "overlay": overlay_color if overlay_color is not None else "",
+                "v": image_cache_version,
+            },
+            doseq=True,
+        )
+        return f"{image_route}{self._dataset}/{float(slice_index)}.png?{query}"
+
+    def compute_image_bytes(self, slice_index, l_lipid_names, colormap_type="viridis", overlay_color=None):
+        """This function computes the encoded (PNG) image of the requested lipids in the requested
+        slice, as served by the app under the URL returned by get_image_url().
+
+        Args:
+            slice_index (int): The index of the requested slice.
+            l_lipid_names (list(str)): The names of the requested lipids. A single name produces a
+                colormapped image, several names (possibly None) produce an RGB image.
+            colormap_type (str, optional): The type of colormap to use for single-lipid images.
+                Defaults to "viridis".
+            overlay_color (str, optional): If not None, the Allen Brain Atlas contours are overlaid
+                on the image with the corresponding color of dic_overlay_colors. Defaults to None.
+
+        Returns:
+            (bytes): The encoded image, or None if the image could not be computed.
+        """
+        overlay = (
+            color_aba_contours(self._data.get_aba_contours(slice_index), overlay_color)
+            if overlay_color is not None
+            else None
+        )
 
+        if len(l_lipid_names) == 1:
+            image = self.compute_image_per_lipid(
+                slice_index, RGB_format=False, lipid_name=l_lipid_names[0]
+            )
+            type_image = None
+        else:
+            image = self.compute_rgb_array_per_lipid_selection(
+                slice_index, ll_lipid_names=l_lipid_names
+            )
+            type_image = "RGB"
+
+        if image is None:
+            return None
+
+        return convert_image_to_bytes(
+            image,
+            type=type_image,
+            overlay=overlay,
+            transparent_zeros=True,
+            optimize=False,
+            colormap_type=colormap_type,
+        )
+
+    def build_lipid_heatmap_from_url(
+        self,
+        slice_index,
+        l_lipid_names,
+        colormap_type="viridis",
+        overlay_color=None,
+        draw=False,
+        return_go_image=False,
+    ):
+        """This function is similar to build_lipid_heatmap_from_image, but the resulting figure
+        references the image through its URL instead of embedding it as a base64 string. The image
+        itself is therefore not computed here, but when (and if) the browser requests it, and
+        repeated views are served from the browser (or proxy) cache.
+
+        Args:
+            slice_index (int): The index of the requested slice.
+            l_lipid_names (list(str)): The names of the requested lipids.
+            colormap_type (str, optional): The type of colormap to use for single-lipid images.
+                Defaults to "viridis".
+            overlay_color (str, optional): If not None, color of the Allen Brain Atlas contours
+                overlaid on the image. Defaults to None.
+            draw (bool, optional): If True, the user will have the possibility to draw on the
+                resulting Plotly Figure. Defaults to False.
+            return_go_image (bool, optional): If True, the go.Image is returned directly, before
+                being integrated to a Plotly Figure. Defaults to False.
+
+        Returns:
+            Depending on the inputted arguments, may either return a go.Image, or a Plotly Figure.
+        """
+        image_url = self.get_image_url(slice_index, l_lipid_names, colormap_type, overlay_color)
+        return self.build_lipid_heatmap_from_source(
+            image_url, draw=draw, return_go_image=return_go_image
+        )
+
+    def build_lipid_heatmap_client_colormap(
+        self,
+        slice_index,
+        lipid_name,
+        colormap_type="viridis",
+        overlay_color=None,
+        draw=False,
+    ):
+        """This function builds a Plotly Figure whose image is colormapped in the browser: the
+        figure references the 8-bit index image of the lipid (served by the image route with the
+        "index" colormap) in its layout metadata, and the clientside callback
+        lut.apply_colormap (see assets/colormaps.js) fetches it and applies the colormap. The
+        colormap can therefore be changed without any request to the server.
+
+        Args:
+            slice_index (int): The index of the requested slice.
+            lipid_name (str): The name of the requested lipid.
+            colormap_type (str, optional): The type of colormap to use. Defaults to "viridis".
+            overlay_color (str, optional): If not None, color of the Allen Brain Atlas contours,
+                which are referenced as a separate layer (see get_layer_url()) displayed above the
+                image when the annotations are toggled on. Defaults to None.
+            draw (bool, optional): If True, the user will have the possibility to draw on the
+                resulting Plotly Figure. Defaults to False.
+
+        Returns:
+            (dict): A figure with an empty image, to be filled client-side.
+        """
+        fig = build_image_figure_dict("", draw=draw)
+        fig["layout"]["meta"] = {
+            "lut_source": self.get_image_url(slice_index, [lipid_name], colormap_type="index"),
+            "colormap": colormap_type,
+            "overlay_source": (
+                self.get_layer_url("contours", slice_index, color=overlay_color)
+                if overlay_color is not None
+                else None
+            ),
+        }
+        return fig
+
+    def build_lipid_heatmap_client_rgb(
+        self,
+        slice_index,
+        l_lipid_names,
+        overlay_color=None,
+        draw=False,
+    ):
+        """This function is the RGB counterpart of build_lipid_heatmap_client_colormap: each
+        channel references its own 8-bit index image, and the channels are composited in the
+        browser by the clientside callback lut.apply_colormap (see assets/colormaps.js). Since each
+        channel is cached independently (by the server and by the browser), changing the lipid of
+        one channel only requires to fetch the corresponding image.
+
+        Args:
+            slice_index (int): The index of the requested slice.
+            l_lipid_names (list(str)): The names of the lipids of the red, green and blue channels,
+                None for empty channels.
+            overlay_color (str, optional): If not None, color of the Allen Brain Atlas contours,
+                referenced as a separate layer as in build_lipid_heatmap_client_colormap. Defaults
+                to None.
+            draw (bool, optional): If True, the user will have the possibility to draw on the
+                resulting Plotly Figure. Defaults to False.
+
+        Returns:
+            (dict): A figure with an empty image, to be filled client-side.
+        """
+        fig = build_image_figure_dict("", draw=draw)
+        fig["layout"]["meta"] = {
+            "rgb_sources": [
+                self.get_image_url(slice_index, [lipid_name], colormap_type="index")
+                if lipid_name is not None
+                else None
+                for lipid_name in l_lipid_names
+            ],
+            "overlay_source": (
+                self.get_layer_url("contours", slice_index, color=overlay_color)
+                if overlay_color is not None
+                else None
+            ),
+        }
         return fig
 
+    def get_layer_url(self, kind, slice_index, **params):
+        """This function returns the URL under which the app serves a layer displayed above the
+        image of the requested slice (see the layers route in app.py). Layers are toggled and
+        stacked client-side (see assets/layers.js), such that showing the annotations or adding a
+        region mask only fetches the corresponding layer, and never the image again.
+
+        Args:
+            kind (str): The kind of layer, either "contours" (the Allen Brain Atlas contours, with
+                the color parameter being a key of dic_overlay_colors) or "mask" (a brain region,
+                with the region parameter being its name, and the color parameter its hexadecimal
+                color without '#').
+            slice_index (int): The index of the requested slice.
+            **params: The parameters of the layer.
+
+        Returns:
+            (str): The URL of the layer.
+        """
+        query = urlencode({**params, "v": image_cache_version})
+        return f"{image_route}layers/{self._dataset}/{kind}/{float(slice_index)}.png?{query}"
+
+    def compute_layer_bytes(self, kind, slice_index, **params):
+        """This function computes the encoded (PNG) layer served under the URL returned by
+        get_layer_url().
+
+        Args:
+            kind (str): The kind of layer, either "contours" or "mask".
+            slice_index (int): The index of the requested slice.
+            **params: The parameters of the layer, see get_layer_url().
+
+        Returns:
+            (bytes): The encoded layer, or None if the layer could not be computed.
+        """
+        if kind == "contours":
+            if params.get("color") not in dic_overlay_colors:
+                return None
+            contours = self._data.get_aba_contours(slice_index)
+            if contours is None:
+                return None
+            return convert_layer_to_bytes(
+                contours[:, :, 3] > 0, dic_overlay_colors[params["color"]]
+            )
+
+        elif kind == "mask":
+            id_name = self._atlas.dic_name_acronym.get(params.get("region"))
+            l_existing_masks = self._atlas.dic_existing_masks.get(slice_index, [])
+            if id_name is None or id_name not in l_existing_masks:
+                return None
+            try:
+                color = [int(params["color"][i : i + 2], 16) for i in (0, 2, 4)]
+            except (KeyError, ValueError):
+                return None
+            descendants = self._atlas.bg_atlas.get_structure_descendants(id_name)
+            mask = np.isin(self._data.acronyms_masks[slice_index], descendants + [id_name])
+            return convert_layer_to_bytes(mask, color)
+
+        return None
+
+    def get_tiles_query(self, **params):
+        """This function returns the query string describing a mosaic, with its parameters sorted,
+        such that the same mosaic always gets the same query string (see get_tiles_url() and
+        get_tiles_key()).
+
+        Args:
+            **params: The parameters describing the mosaic.
+
+        Returns:
+            (str): The query string.
+        """
+        return urlencode(sorted({**params, "v": image_cache_version}.items()), doseq=True)
+
+    def get_tiles_key(self, kind, **params):
+        """This function returns the key under which the pyramid of a mosaic is registered (see
+        get_image_pyramid()), for the build of the figure and for the tiles route alike.
+
+        Args:
+            kind (str): The kind of mosaic (see get_tiles_url()).
+            **params: The parameters describing the mosaic.
+
+        Returns:
+            (str): The key of the mosaic.
+        """
+        return kind + "?" + self.get_tiles_query(**params)
+
+    def get_tiles_url(self, kind, **params):
+        """This function returns the URL template of the tiles of a mosaic served by the app (see
+        the tiles route in app.py), the placeholders {level}, {row} and {col} being filled by the
+        browser (see assets/tiles.js).
+
+        Args:
+            kind (str): The kind of mosaic, either "grid" (lipid expression in all the sections of
+                a sample) or "lipizones" (lipizones of all the sections of a sample).
+            **params: The parameters describing the mosaic, passed in the query string.
+
+        Returns:
+            (str): The URL template of the tiles.
+        """
+        query = self.get_tiles_query(**params)
+        return f"{image_route}tiles/{kind}/{{level}}/{{row}}_{{col}}.png?{query}"
+
+    def build_tiled_heatmap(self, compute_image, kind, graph_id, draw=False, **params):
+        """This function builds a Plotly Figure displaying a large mosaic as a pyramid of tiles:
+        the pyramid is registered for the tiles route, and the figure only references the URL
+        template of the tiles in its layout metadata. The clientside callback tiles.render_tiles
+        (see assets/tiles.js) then only fetches the tiles that are visible, at the resolution
+        matching the current zoom. The image of the mosaic is only computed if its pyramid is not
+        already stored.
+
+        Args:
+            compute_image (function): Function returning the image of the mosaic, in 2D
+                (colormapped with viridis) or in 3D (RGB).
+            kind (str): The kind of mosaic (see get_tiles_url()).
+            graph_id (str): The id of the graph displaying the figure, used to get its size.
+            draw (bool, optional): If True, the user will have the possibility to draw on the
+                resulting Plotly Figure. Defaults to False.
+            **params: The parameters describing the mosaic (see get_tiles_url()).
+
+        Returns:
+            (dict): A figure with an empty image, to be filled client-side.
+        """
+        tiles_url = self.get_tiles_url(kind, **params)
+        pyramid = get_image_pyramid(self.get_tiles_key(kind, **params), compute_image)
+        if pyramid is None:
+            logging.warning(f"No image for the {kind} mosaic {params}")
+            return build_image_figure_dict("", draw=draw)
+        height, width = pyramid[0].shape[:2]
+
+        fig = build_image_figure_dict("", draw=draw)
+        layout = fig["layout"]
+        layout["xaxis"].update(range=[-0.5, width - 0.5], autorange=False)
+        layout["yaxis"].update(
+            range=[height - 0.5, -0.5], autorange=False, scaleanchor="x", scaleratio=1
+        )
+        # Keep the zoom of the user as long as the mosaic does not change
+        layout["uirevision"] = tiles_url
+        layout["meta"] = {
+            "tiles": {
+                "url": tiles_url,
+                "width": width,
+                "height": height,
+                "n_levels": len(pyramid),
+                "tile_size": TILE_SIZE,
+                "graph_id": graph_id,
+            }
+        }
+        return fig
+
+    def compute_tile_bytes(self, tiles_key, level, row, col, compute_image, type_image=None):
+        """This function computes the encoded (PNG) tile of a mosaic, as served by the app under
+        the URLs built from get_tiles_url().
+
+        Args:
+            tiles_key (str): Key of the mosaic (see Figures.get_tiles_key()).
+            level (int): The level of the tile, 0 being the full resolution.
+            row (int): The row of the tile in the level.
+            col (int): The column of the tile in the level.
+            compute_image (function): Function returning the image of the mosaic, used if its
+                pyramid is not registered in this process.
+            type_image (str, optional): The type of the image, "RGB" for 3D images, None for 2D
+                images. Defaults to None.
+
+        Returns:
+            (bytes): The encoded tile, or None if the tile does not exist.
+        """
+        pyramid = get_image_pyramid(tiles_key, compute_image)
+        if pyramid is None:
+            return None
+        tile = get_image_tile(pyramid, level, row, col)
+        if tile is None:
+            return None
+        return convert_image_to_bytes(
+            tile, type=type_image, transparent_zeros=True, optimize=False
+        )
+
     def compute_heatmap_per_lipid(
         self,
         slice_index,
         lipid_name,
         draw=False,
         return_base64_string=False,
-        cache_flask=None,
         overlay=None,
         colormap_type="viridis",
     ):
@@ -681,9 +1598,6 @@ class Figures:
                 information). Defaults to True.
             return_base64_string (bool, optional): If True, the base64 string of the image is
                 returned directly, before any figure building. Defaults to False.
-            cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
-                None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
-                None.
         Returns:
             Depending on the value return_base64_string, may either return a base64 string, or
                 a Plotly Figure.
@@ -698,7 +1612,6 @@ class Figures:
             slice_index,
             RGB_format=False,
             lipid_name=lipid_name,
-            cache_flask=cache_flask,
         )
 
         # Compute corresponding figure
@@ -716,7 +1629,6 @@ class Figures:
         self,
         slice_index,
         ll_lipid_names=None,
-        cache_flask=None,
     ):
         """This function computes a numpy RGB array (each pixel has 3 intensity values) of
         expression of the requested lipids (those whose m/z values are in ll_t_bounds) in the slice.
@@ -740,9 +1652,6 @@ class Figures:
             ll_lipid_names (list(list(int)), optional): List of list of lipid names that must be
                 MAIA-transformed, if apply_transform and normalize are True. The first list is used
                 to separate channels, when applicable. Defaults to None.
-            cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
-                None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
-                None.
 
         Returns:
             (np.ndarray): A three-dimensional RGB numpy array (of uint8 dtype). The first two
@@ -750,23 +1659,18 @@ class Figures:
                 corresponds to the channels.
         """
 
-        # Build a list of empty images and add selected lipids for each channel
-        l_images = []
-        
-        # Loop over channels
-        for lipid_name in ll_lipid_names:
-            # Compute expression image per lipid
-            image_temp = self.compute_image_per_lipid(
-                slice_index,
-                RGB_format=True,
-                lipid_name=lipid_name,
-                cache_flask=cache_flask,
-            ) if lipid_name is not None else np.full(self._data.image_shape, np.nan)
-
-            l_images.append(image_temp)
+        # Extract all selected lipids at once, empty channels being left as NaN
+        l_names = [lipid_name for lipid_name in ll_lipid_names if lipid_name is not None]
+        l_images = np.full(
+            (len(ll_lipid_names), self._data.image_shape[0], self._data.image_shape[1]), np.nan
+        )
+        if len(l_names) > 0:
+            stack = self._data.extract_images(slice_index, l_names)
+            if stack is not None:
+                l_images[[lipid_name is not None for lipid_name in ll_lipid_names]] = stack * 255
 
         # Reoder axis to match plotly go.image requirementss
-        array_image = np.moveaxis(np.array(l_images), 0, 2)
+        array_image = np.moveaxis(l_images, 0, 2)
         
         return array_image
 
@@ -776,7 +1680,6 @@ class Figures:
         return_image=False,
         ll_lipid_names=None,
         return_base64_string=False,
-        cache_flask=None,
         overlay=None,
     ):
         """This function is very similar to compute_heatmap_per_lipid_selection, but it returns a
@@ -805,9 +1708,6 @@ class Figures:
                 to separate channels, when applicable. Defaults to None.
             return_base64_string (bool, optional): If True, the base64 string of the image is
                 returned directly, before any figure building. Defaults to False.
-            cache_flask (flask_caching.Cache, optional): Cache of the Flask database. If set to
-                None, the reading of memory-mapped data will not be multithreads-safe. Defaults to
-                None.
 
         Returns:
             Depending on the inputted arguments, may either return a base64 string, a go.Image, or
@@ -821,7 +1721,6 @@ class Figures:
         array_image = self.compute_rgb_array_per_lipid_selection(
             slice_index,
             ll_lipid_names=ll_lipid_names,
-            cache_flask=cache_flask,
         )
 
         logging.info("Returning fig for slice " + str(slice_index) + logmem())
@@ -877,7 +1776,32 @@ class Figures:
     # ==============================================================================================
     # --- Methods used mainly in lipizones-related pages
     # ==============================================================================================
-    
+
+    def retrieve_sections_data(self, slice_index):
+        """This function retrieves the lipizone and the celltype data of a given section with a
+        single Redis round trip, instead of one per data object. Sections missing from the cache
+        are retrieved (and cached) through the usual retrieve_section_data() methods.
+
+        Args:
+            slice_index (int): The index of the requested section.
+
+        Returns:
+            (dict, dict): The lipizone section data and the celltype section data.
+        """
+        lipizone_section_data = self._lipizone_data.section_data
+        cache_keys = [
+            lipizone_section_data._generate_cache_key("retrieve_section_data", float(slice_index)),
+            self._celltype_data._generate_cache_key("retrieve_section_data", int(slice_index)),
+        ]
+        section_data_lipizones, section_data_celltypes = self._get_many_from_cache(cache_keys)
+
+        if section_data_lipizones is None:
+            section_data_lipizones = lipizone_section_data.retrieve_section_data(float(slice_index))
+        if section_data_celltypes is None:
+            section_data_celltypes = self._celltype_data.retrieve_section_data(int(slice_index))
+
+        return section_data_lipizones, section_data_celltypes
+
     def all_sections_lipizones_image(self, hex_colors_to_highlight=None, brain_id="ReferenceAtlas"):
         def hex_to_rgb(hex_color):
             """Convert hexadecimal color to RGB values (0-1 range)"""
@@ -887,42 +1811,15 @@ class Figures:
             hex_colors_to_highlight = self._lipizone_data.lipizone_to_color.values()
         rgb_colors_to_highlight = [hex_to_rgb(hex_color) for hex_color in hex_colors_to_highlight]
 
-        # try:
         # Retrieve sample data from shelve database
         sample_data = self._lipizone_data.sample_data.retrieve_sample_data(brain_id)
-        color_masks = sample_data["color_masks"]
-        grayscale_image = sample_data["grayscale_image"]
         rgb_image = sample_data["grid_image"][:, :, :3]  # remove transparency channel for now
-        
-        # Apply square root transformation to enhance contrast
-        # grayscale_image = np.sqrt(np.sqrt(grayscale_image))
-        grayscale_image = np.power(grayscale_image, float(1/6))
-        grayscale_image = gaussian_filter(grayscale_image, sigma=3)
-        # grayscale_image = np.power(grayscale_image, 2) * 0.3
-        grayscale_image *= ~color_masks[list(color_masks.keys())[0]]
-        
-        hybrid_image = np.zeros_like(rgb_image)
-        for i in range(3):
-            hybrid_image[:, :, i] = grayscale_image
-        combined_mask = np.zeros((rgb_image.shape[0], rgb_image.shape[1]), dtype=bool)
-        for target_rgb in rgb_colors_to_highlight:
-            target_tuple = tuple(target_rgb)
-            
-            # If the exact color exists in our image
-            if target_tuple in color_masks:
-                combined_mask |= color_masks[target_tuple]
-            else:
-                # Find closest color
-                distances = np.array([np.sum((np.array(color) - target_rgb) ** 2) for color in color_masks.keys()])
-                closest_color_idx = np.argmin(distances)
-                closest_color = list(color_masks.keys())[closest_color_idx]
-                
-                # If close enough to our target color, add its mask
-                if distances[closest_color_idx] < 0.05:  # Threshold for color similarity
-                    combined_mask |= color_masks[closest_color]
-        
-        for i in range(3):
-            hybrid_image[:, :, i][combined_mask] = rgb_image[:, :, i][combined_mask]
+
+        # Blurred background and label image are computed once per sample
+        grayscale_image, labels, label_colors = get_lipizone_layers(("sample", brain_id), sample_data)
+        combined_mask = get_highlight_mask(labels, label_colors, rgb_colors_to_highlight)
+
+        hybrid_image = np.where(combined_mask[:, :, None], rgb_image, grayscale_image[:, :, None])
         hybrid_image = (hybrid_image*255) + 1
         mask = np.all(hybrid_image == 1, axis=-1)
         hybrid_image[mask] = np.nan
@@ -961,42 +1858,15 @@ class Figures:
         # Create a section key based on brain_id and slice_index
         section_data = self._lipizone_data.section_data.retrieve_section_data(float(slice_index))
         
-        # Use the section data to create a hybrid image
-        grayscale_image = section_data["grayscale_image"]
-        color_masks = section_data["color_masks"]
-        grid_image = section_data["grid_image"]
-        rgb_image = grid_image[:, :, :3]  # remove transparency channel
-        
-        # Apply square root transformation to enhance contrast
-        grayscale_image = np.power(grayscale_image, float(1/6)) 
-        grayscale_image = gaussian_filter(grayscale_image, sigma=3)
-        # grayscale_image = np.power(grayscale_image, 2) * 0.3
-        grayscale_image *= ~color_masks[list(color_masks.keys())[0]]        
-        
-        hybrid_image = np.zeros_like(rgb_image)
-        for i in range(3):
-            hybrid_image[:, :, i] = grayscale_image
-        
-        combined_mask = np.zeros((rgb_image.shape[0], rgb_image.shape[1]), dtype=bool)
-        for target_rgb in rgb_colors_to_highlight:
-            target_tuple = tuple(target_rgb)
-            
-            # If the exact color exists in our image
-            if target_tuple in color_masks:
-                combined_mask |= color_masks[target_tuple]
-            else:
-                # Find closest color
-                distances = np.array([np.sum((np.array(color) - target_rgb) ** 2) for color in color_masks.keys()])
-                closest_color_idx = np.argmin(distances)
-                closest_color = list(color_masks.keys())[closest_color_idx]
-                
-                # If close enough to our target color, add its mask
-                if distances[closest_color_idx] < 0.05:  # Threshold for color similarity
-                    combined_mask |= color_masks[closest_color]
-        
-        for i in range(3):
-            hybrid_image[:, :, i][combined_mask] = rgb_image[:, :, i][combined_mask]
-        
+        rgb_image = section_data["grid_image"][:, :, :3]  # remove transparency channel
+
+        # Blurred background and label image are computed once per section
+        grayscale_image, labels, label_colors = get_lipizone_layers(
+            ("section", float(slice_index)), section_data
+        )
+        combined_mask = get_highlight_mask(labels, label_colors, rgb_colors_to_highlight)
+
+        hybrid_image = np.where(combined_mask[:, :, None], rgb_image, grayscale_image[:, :, None])
         hybrid_image = (hybrid_image*255) + 1
         mask = np.all(hybrid_image == 1, axis=-1)
         hybrid_image[mask] = np.nan
@@ -1019,23 +1889,13 @@ class Figures:
         rgb_colors_to_highlight_celltypes = [self._celltype_data.celltype_to_color[name] for name in selected_celltype_names if name in self._celltype_data.celltype_to_color]
         
         # Get section data for both lipizones and celltypes
-        section_data_lipizones = self._lipizone_data.section_data.retrieve_section_data(float(slice_index))
-        section_data_celltypes = self._celltype_data.retrieve_section_data(int(slice_index))
-        
-        # Use the grayscale image from lipizones data (same for both)
-        grayscale_image = section_data_lipizones["grayscale_image"]
-        # grayscale_image = np.sqrt(np.sqrt(grayscale_image))
-        grayscale_image = np.power(grayscale_image, float(1/6))
+        section_data_lipizones, section_data_celltypes = self.retrieve_sections_data(slice_index)
         
-        # Apply Gaussian blur to smooth the grayscale image
-        grayscale_image = gaussian_filter(grayscale_image, sigma=3)
-        
-        # Get color masks for both
-        color_masks_lipizones = section_data_lipizones["color_masks"]
-        color_masks_celltypes = section_data_celltypes["color_masks"]
-
-        # mask the grayscale image with the color mask of the lipizones
-        grayscale_image *= ~color_masks_lipizones[list(color_masks_lipizones.keys())[0]]
+        # Use the blurred grayscale image from lipizones data (same for both), computed once per
+        # section along with the label image of the lipizones
+        grayscale_image, labels_lipizones, label_colors_lipizones = get_lipizone_layers(
+            ("section", float(slice_index)), section_data_lipizones
+        )
 
         # Grid image
         grid_image = section_data_lipizones["grid_image"]
@@ -1056,81 +1916,52 @@ class Figures:
         mid_point = lipizones_celltypes_image.shape[1] // 2
         
         # Process left side (lipizones)
-        combined_mask_lipizones = np.zeros((rgb_image.shape[0], mid_point), dtype=bool)
-        for target_rgb in tqdm(rgb_colors_to_highlight_lipizones):
-            target_tuple = tuple(target_rgb)
-            if target_tuple in color_masks_lipizones:
-                combined_mask_lipizones |= color_masks_lipizones[target_tuple][:, :mid_point]
-            else:
-                try:
-                    distances = np.array([np.sum((np.array(color) - target_rgb) ** 2) for color in color_masks_lipizones.keys()])
-                    closest_color_idx = np.argmin(distances)
-                    closest_color = list(color_masks_lipizones.keys())[closest_color_idx]
-                    if distances[closest_color_idx] < 0.05:
-                        combined_mask_lipizones |= color_masks_lipizones[closest_color][:, :mid_point]
-                except:
-                    logging.info(f"{target_rgb} not found in color_masks_lipizones")
-                    continue
+        combined_mask_lipizones = get_highlight_mask(
+            labels_lipizones[:, :mid_point], label_colors_lipizones, rgb_colors_to_highlight_lipizones
+        )
         
         # Process right side (celltypes) with pixel enlargement
-        # Initialize arrays for the right side
-        celltype_colors = np.zeros((rgb_image.shape[0], lipizones_celltypes_image.shape[1] - mid_point, 3))
-        celltype_mask = np.zeros((rgb_image.shape[0], lipizones_celltypes_image.shape[1] - mid_point), dtype=bool)
-        
-        # Process each celltype
-        for target_rgb in tqdm(rgb_colors_to_highlight_celltypes):
-            # Convert target_rgb to numpy array if it's a string
-            target_rgb_float = np.array([float(x) for x in target_rgb.strip('()').split(',')])
-            target_tuple = tuple(target_rgb_float)
-            # find the corresponding name of the celltype from the celltype_to_color dictionary
-            celltype_name = list(self._celltype_data.celltype_to_color.keys())[list(self._celltype_data.celltype_to_color.values()).index(target_rgb)]
-            
-            if celltype_name in color_masks_celltypes:
-                current_mask = color_masks_celltypes[celltype_name].T[:, mid_point:]
-                
-                # For each center point, create a square around it
-                y_coords, x_coords = np.where(current_mask)
-                
-                for y, x in zip(y_coords, x_coords):
-                    # # Get the original RGB color from the center point
-                    # center_color = rgb_image[y, x + mid_point]
-                    # Use the celltype's RGB color directly from celltype_to_color
-                    center_color = target_rgb_float[:3]
-                    
-                    # Define the square bounds
-                    y_min = max(0, y - celltype_radius)
-                    y_max = min(current_mask.shape[0], y + celltype_radius + 1)
-                    x_min = max(0, x - celltype_radius)
-                    x_max = min(current_mask.shape[1], x + celltype_radius + 1)
-                    
-                    # Only fill pixels that haven't been filled yet
-                    square_mask = np.zeros_like(celltype_mask)
-                    square_mask[y_min:y_max, x_min:x_max] = True
-                    unfilled_pixels = square_mask & ~celltype_mask
-                    
-                    if np.any(unfilled_pixels):
-                        # Use broadcasting to assign the center color to all unfilled pixels in the square
-                        for i in range(3):
-                            celltype_colors[..., i][unfilled_pixels] = center_color[i]
-                        celltype_mask[unfilled_pixels] = True
-            
-            # else:
-            #     # Convert color mask keys to numpy arrays for comparison
-            #     try:
-            #         mask_rgb_str = [celltype_to_color[celltype_name] for celltype_name in color_masks_celltypes.keys()]
-            #         color_keys = [np.array([float(x) for x in color.strip('()').split(',')]) 
-            #         for color in mask_rgb_str]
-
-            #         distances = np.array([np.sum((color - target_tuple) ** 2) for color in color_keys])
-            #         closest_color_idx = np.argmin(distances)
-            #         closest_color = list(color_masks_celltypes.keys())[closest_color_idx]
-            #         if distances[closest_color_idx] < 0.05:
-            #             current_mask = color_masks_celltypes[closest_color].T
-            #             combined_mask_celltypes |= current_mask[:, mid_point:]
-            #     except:
-            #         logging.info(f"{celltype_name} not found in color_masks_celltypes")
-            #         continue
-        
+        rows_cells, cols_cells, labels_cells, l_celltype_names = get_celltype_cells(
+            ("section", float(slice_index)), section_data_celltypes
+        )
+        color_to_celltype = {
+            color: name for name, color in reversed(self._celltype_data.celltype_to_color.items())
+        }
+        dic_celltype_index = {name: index for index, name in enumerate(l_celltype_names)}
+
+        # Rank of each celltype in the selection (celltypes selected first are drawn on top), and
+        # color of each rank. Unselected celltypes get a rank past the selection.
+        n_selected = len(rgb_colors_to_highlight_celltypes)
+        rank_lut = np.full(len(l_celltype_names), n_selected, dtype=np.int32)
+        rank_colors = np.zeros((n_selected + 1, 3))
+        for rank, target_rgb in enumerate(rgb_colors_to_highlight_celltypes):
+            celltype_name = color_to_celltype[target_rgb]
+            if celltype_name in dic_celltype_index and rank_lut[dic_celltype_index[celltype_name]] == n_selected:
+                rank_lut[dic_celltype_index[celltype_name]] = rank
+            rank_colors[rank] = [float(x) for x in target_rgb.strip('()').split(',')][:3]
+
+        # Best rank of the selected cells centered on each pixel of the right side
+        ranks_cells = rank_lut[labels_cells]
+        selected = (ranks_cells < n_selected) & (cols_cells >= mid_point)
+        rank_image = np.full(
+            (rgb_image.shape[0], rgb_image.shape[1] - mid_point), n_selected, dtype=np.int32
+        )
+        np.minimum.at(
+            rank_image,
+            (rows_cells[selected], cols_cells[selected] - mid_point),
+            ranks_cells[selected],
+        )
+
+        # Enlarge each cell into a square of side 2*celltype_radius+1: each pixel takes the best
+        # ranked cell around it
+        rank_image = minimum_filter(
+            rank_image,
+            size=2 * celltype_radius + 1,
+            mode="constant",
+            cval=n_selected,
+        )
+        celltype_mask = rank_image < n_selected
+        celltype_colors = rank_colors[rank_image]
         
         # Apply color masks to respective sides
         for i in range(3):
@@ -1204,41 +2035,155 @@ class Figures:
             logging.error(traceback.format_exc())
             raise e
 
-    def create_all_lipizones_figure(self, downsample_factor=1):
+    def get_lipizones_point_cloud(self, downsample_factor=1):
+        """Returns the point cloud of all the lipizones: a fixed sample of the colored voxels of the
+        color array, spread evenly over the brain (see sample_voxels_stratified()), with their
+        coordinates as uint16 and their colors packed as uint8. The sample is computed once and
+        stored next to the color array, such that it is shared by all the processes of the app.
+
+        Args:
+            downsample_factor (int, optional): Factor by which the color array is downsampled
+                before sampling. Defaults to 1.
+
+        Returns:
+            (np.ndarray): A read-only structured array with fields "zyx" (uint16, 3) and "rgb"
+                (uint8, 3), one row per point.
         """
-        Create a 3D visualization of all lipizones together using the color array
+        if downsample_factor not in dic_lipizones_point_clouds:
+
+            def compute_point_cloud():
+                color_array = np.load(self._lipizone_data.COLOR_ARRAY_PATH, mmap_mode="r")
+                color_array = color_array[
+                    ::downsample_factor, ::downsample_factor, ::downsample_factor, :
+                ]
+                # Colors may be stored in [0, 1] or [0, 255]
+                scale = 255 if color_array.max() <= 1 else 1
+                coordinates = sample_voxels_stratified(
+                    np.any(color_array > 0, axis=-1), MAX_LIPIZONES_POINTS
+                )
+                point_cloud = np.zeros(
+                    len(coordinates), dtype=[("zyx", np.uint16, 3), ("rgb", np.uint8, 3)]
+                )
+                point_cloud["zyx"] = coordinates
+                point_cloud["rgb"] = np.round(
+                    np.asarray(color_array[tuple(coordinates.T)], dtype=np.float32) * scale
+                )
+                return point_cloud
+
+            dic_lipizones_point_clouds[downsample_factor] = load_or_compute_array(
+                os.path.join(
+                    os.path.dirname(self._lipizone_data.COLOR_ARRAY_PATH),
+                    f"point_cloud_x{downsample_factor}.npy",
+                ),
+                compute_point_cloud,
+            )
+        return dic_lipizones_point_clouds[downsample_factor]
+
+    def get_lipizones_index(self):
+        """Returns the index of the voxels of each lipizone in the 3D label volume (see
+        compute_label_index()), such that the voxels of a lipizone are read without scanning the
+        whole volume. The index is computed once from the Zarr store and stored next to it, such
+        that it is shared by all the processes of the app.
+
+        Returns:
+            (dict): The bounding boxes ("bboxes"), run offsets ("offsets") and runs ("runs") of the
+                lipizones, as read-only arrays.
+        """
+        if not dic_lipizones_index:
+            path_index = os.path.join(
+                os.path.dirname(self._lipizone_data.LIPIZONES_ZARR_PATH), "lipizones_index"
+            )
+            l_names = ["bboxes", "offsets", "runs"]
+            index = {}
+
+            def compute_index(name):
+                if not index:
+                    root = zarr.group(
+                        store=zarr.DirectoryStore(self._lipizone_data.LIPIZONES_ZARR_PATH)
+                    )
+                    array_labels = np.nan_to_num(root["all_lipizones"][:]).astype(np.int32)
+                    index.update(zip(l_names, compute_label_index(array_labels)))
+                return index[name]
+
+            for name in l_names:
+                dic_lipizones_index[name] = load_or_compute_array(
+                    os.path.join(path_index, name + ".npy"), lambda: compute_index(name)
+                )
+        return dic_lipizones_index
+
+    def compute_3D_lipizone_mesh(
+        self, lipizone_index, color, decrease_dimensionality_factor=1, opacity=0.7, name=None
+    ):
+        """This function generates the go.Mesh3d of the surface of a lipizone. The mesh is computed
+        from the voxels of the lipizone in its bounding box only (see get_lipizones_index()), and
+        stored on disk (it can also be precomputed with modules/tools/mesh.py).
+
+        Args:
+            lipizone_index (int): The label of the lipizone in the 3D label volume.
+            color (str): The color of the mesh.
+            decrease_dimensionality_factor (int, optional): Subsampling factor of the atlas whose
+                coordinates the mesh is displayed in. Defaults to 1.
+            opacity (float, optional): The opacity of the mesh. Defaults to 0.7.
+            name (str, optional): The name of the trace. Defaults to None.
+
+        Returns:
+            (go.Mesh3d): The mesh of the lipizone, or None if the lipizone is absent from the
+                volume.
+        """
+
+        def compute_mesh():
+            index = self.get_lipizones_index()
+            mask, corner = get_label_mask(
+                index["bboxes"], index["offsets"], index["runs"], int(lipizone_index)
+            )
+            if not mask.any():
+                return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int32)
+
+            # Margin such that the smoothed surface is not cropped (as in compute_label_meshes())
+            vertices, faces = compute_mask_mesh(np.pad(mask, 3))
+            return vertices + np.array(corner, dtype=np.float32) - 3, faces
+
+        vertices, faces = load_or_compute_mesh(
+            get_mesh_path("lipizones", str(int(lipizone_index))), compute_mesh
+        )
+        if len(faces) == 0:
+            return None
+        return build_mesh_trace(
+            vertices / decrease_dimensionality_factor, faces, color, opacity, name=name
+        )
+
+    def create_all_lipizones_figure(self, downsample_factor=1, packed=False):
+        """
+        Create a 3D visualization of all lipizones together, as a point cloud sampled from the
+        color array (see get_lipizones_point_cloud). The figure is built once per process and
+        downsampling factor, then shared by all the sessions.
         
         Parameters:
         -----------
         downsample_factor : int
             Factor by which to downsample the array to reduce memory usage
+        packed : bool, default=False
+            Return the figure as a dict with binary data arrays (see pack_3D_figure)
             
         Returns:
         --------
-        go.Figure
-            The 3D figure with the volume rendering
+        go.Figure or dict
+            The 3D figure with the point cloud
         """
+        key = (downsample_factor, packed)
+        if key in dic_lipizones_figures:
+            return dic_lipizones_figures[key]
+        if packed:
+            dic_lipizones_figures[key] = pack_3D_figure(
+                self.create_all_lipizones_figure(downsample_factor)
+            )
+            return dic_lipizones_figures[key]
+
         try:
             start_time = time.time()
-            # logging.info("Loading all lipizones color array")
-            
-            # Load the color array
-            color_array = np.load(self._lipizone_data.COLOR_ARRAY_PATH)
-            
-            # Downsample the array
-            if downsample_factor > 1:
-                color_array = color_array[::downsample_factor, ::downsample_factor, ::downsample_factor, :]
-                # logging.info(f"Downsampled color array to shape: {color_array.shape}")
+            point_cloud = self.get_lipizones_point_cloud(downsample_factor)
             
-            # Create coordinate grid based on array shape
-            z, y, x = np.indices(color_array.shape[:3])
-            
-            # Create a mask for voxels with non-zero values
-            # Convert RGB to a single intensity value based on average brightness
-            intensity = np.mean(color_array, axis=-1)
-            mask = intensity > 0
-            
-            if not np.any(mask):
+            if len(point_cloud) == 0:
                 logging.warning("No non-zero values found in the color array!")
                 return go.Figure().update_layout(
                     title="No data found in color array",
@@ -1246,42 +2191,30 @@ class Figures:
                     plot_bgcolor="rgba(0,0,0,0)",
                     paper_bgcolor="rgba(0,0,0,0)",
                 )
+
+            # Color the points through a palette of the (few hundred) distinct lipizone colors,
+            # such that the trace carries one number per point instead of one string
+            rgb = np.asarray(point_cloud["rgb"])
+            packed = (rgb[:, 0].astype(np.uint32) << 16) | (rgb[:, 1].astype(np.uint32) << 8) | rgb[:, 2]
+            palette, color_indices = np.unique(packed, return_inverse=True)
+            l_palette = [f"rgb({c >> 16},{(c >> 8) & 255},{c & 255})" for c in palette.tolist()]
+            if len(l_palette) == 1:
+                l_palette = l_palette * 2
+            colorscale = [[i / (len(l_palette) - 1), color] for i, color in enumerate(l_palette)]
             
-            # Normalize RGB values to 0-1 range if they're not already
-            if color_array.max() > 1:
-                color_array = color_array / 255.0
-            
-            # Get the coordinates and colors of non-zero voxels
-            x_points = x[mask]
-            y_points = y[mask]
-            z_points = z[mask]
-            colors = color_array[mask]
-            
-            
-            # Create a figure with a scatter3d trace using the actual RGB colors
             fig = go.Figure()
-            
-            # Add a scatter3d trace for the point cloud with RGB colors
-            color_strings = [f'rgb({r*255},{g*255},{b*255})' for r, g, b in colors]
-            # Reduce points if there are too many (for performance)
-
-            max_points = 400000 # Limit the number of points for performance
-            if len(x_points) > max_points:
-                indices = np.random.choice(len(x_points), max_points, replace=False)
-                x_points = x_points[indices]
-                y_points = y_points[indices]
-                z_points = z_points[indices]
-                color_strings = [color_strings[i] for i in indices]
-            
-            # Add the scatter3d trace
+            zyx = np.asarray(point_cloud["zyx"])
             fig.add_trace(go.Scatter3d(
-                x=x_points, 
-                y=y_points, 
-                z=z_points,
+                x=zyx[:, 2], 
+                y=zyx[:, 1], 
+                z=zyx[:, 0],
                 mode='markers',
                 marker=dict(
-                    size=downsample_factor,  # Increased size from 2 to 10 (5x larger)
-                    color=color_strings,
+                    size=downsample_factor,
+                    color=color_indices.reshape(-1).astype(np.uint16),
+                    colorscale=colorscale,
+                    cmin=0,
+                    cmax=len(l_palette) - 1,
                     opacity=1.0
                 ),
                 hoverinfo='none'
@@ -1315,10 +2248,7 @@ class Figures:
                 plot_bgcolor="rgba(0,0,0,0)",
                 paper_bgcolor="rgba(0,0,0,0)",
             )
-            
-            # Clean up to free memory
-            del color_array, x, y, z, x_points, y_points, z_points, colors, color_strings
-            gc.collect()
+            dic_lipizones_figures[key] = fig
             
             end_time = time.time()
             logging.info(f"All lipizones figure creation completed in {end_time - start_time:.2f} seconds")
@@ -1353,13 +2283,11 @@ class Figures:
             gene_thresholds.append(0)
 
         # Get section data for both lipizones and celltypes
-        section_data_lipizones = self._lipizone_data.section_data.retrieve_section_data(float(slice_index))
+        section_data_lipizones, section_data_celltypes = self.retrieve_sections_data(slice_index)
         grayscale_image = section_data_lipizones["grayscale_image"]
         grayscale_image = np.power(grayscale_image, float(1/6))
         grayscale_image = gaussian_filter(grayscale_image, sigma=3)
 
-        section_data_celltypes = self._celltype_data.retrieve_section_data(int(slice_index))
-        color_masks_celltypes = section_data_celltypes["color_masks"]
         df_genes_filtered = df_genes[df_genes.index.isin(section_data_celltypes["color_masks"].keys())]
 
         lipid_gene_image = np.zeros((grayscale_image.shape[0], grayscale_image.shape[1], 3))
@@ -1379,7 +2307,6 @@ class Figures:
                             slice_index,
                             lipid_name=all_selected_lipids[0],
                             RGB_format=False,
-                            cache_flask=False,
                         ))*255
 
         # Create the overlay: grayscale background with lipid expression on the left side
@@ -1397,6 +2324,16 @@ class Figures:
         gene_overlay = np.zeros_like(lipid_gene_image[:, mid_point:, :])
         # Track how many genes are expressed in each pixel for blending
         gene_count = np.zeros((lipid_gene_image.shape[0], lipid_gene_image.shape[1] - mid_point), dtype=np.float32)
+
+        # Cells of the section, computed once. Cells up to celltype_radius to the left of the
+        # midpoint are kept, as their enlarged dots spill over the right side.
+        rows_cells, cols_cells, labels_cells, l_celltype_names = get_celltype_cells(
+            ("section", float(slice_index)), section_data_celltypes
+        )
+        start = max(0, mid_point - celltype_radius)
+        right_cells = cols_cells >= start
+        rows_right, cols_right = rows_cells[right_cells], cols_cells[right_cells] - start
+        labels_right = labels_cells[right_cells]
         
         # Right side (gene expression) - apply each gene with its own colorscale
         for gene_idx, gene in enumerate(all_selected_genes):
@@ -1422,53 +2359,42 @@ class Figures:
                 # If no valid values, skip this gene
                 continue
             
-            # Process each cell type for this gene
-            for celltype in color_masks_celltypes.keys():
-                cell_mask = color_masks_celltypes[celltype].T.copy()
-                
-                # Get gene expression value for this celltype
-                try:
-                    genexpr_value = df_genes_filtered.loc[celltype, gene]
-                except:
-                    genexpr_value = 0
-                
-                # Apply threshold filtering - skip cells with expression below the threshold
-                if np.isnan(genexpr_value) or genexpr_value < threshold:
-                    continue
-                
-                # Expand the mask to include neighboring pixels for better visibility
-                y_coords, x_coords = np.where(cell_mask)
-                for y, x in zip(y_coords, x_coords):
-                    y_min = max(0, y - celltype_radius)
-                    y_max = min(cell_mask.shape[0], y + celltype_radius + 1)
-                    x_min = max(0, x - celltype_radius)
-                    x_max = min(cell_mask.shape[1], x + celltype_radius + 1)
-                    
-                    cell_mask[y_min:y_max, x_min:x_max] = True
-                
-                # Apply the colorscale to this cell mask using the gene-specific normalization
-                if not np.isnan(genexpr_value) and genexpr_value > min_val:
-                    color_values = colorscale(gene_norm(genexpr_value))  # This gives RGB values
-                    
-                    # Apply each color channel separately - to the overlay
-                    right_side_mask = cell_mask[:, mid_point:]
-                    for i in range(3):  # RGB channels
-                        # Add this gene's color to the overlay
-                        gene_overlay[:, :, i][right_side_mask] += color_values[i] * 255
-                    
-                    # Increment gene count for these pixels
-                    gene_count[right_side_mask] += 1
+            # Gene expression of each celltype of the section (0 if missing from df_genes), with
+            # cells below the threshold (or at the minimum expression) discarded
+            genexpr_values = df_genes_filtered[gene].reindex(l_celltype_names, fill_value=0).values
+            genexpr_values = genexpr_values.astype(np.float64)
+            kept = (genexpr_values >= threshold) & (genexpr_values > min_val)
+
+            # Highest expression of the kept cells centered on each pixel
+            kept_cells = kept[labels_right]
+            genexpr_image = np.full(
+                (lipid_gene_image.shape[0], lipid_gene_image.shape[1] - start), -np.inf
+            )
+            np.maximum.at(
+                genexpr_image,
+                (rows_right[kept_cells], cols_right[kept_cells]),
+                genexpr_values[labels_right[kept_cells]],
+            )
+
+            # Expand the cells into squares for better visibility, the most expressing cell
+            # being shown where squares overlap
+            genexpr_image = maximum_filter(
+                genexpr_image,
+                size=2 * celltype_radius + 1,
+                mode="constant",
+                cval=-np.inf,
+            )[:, mid_point - start:]
+            right_side_mask = np.isfinite(genexpr_image)
+
+            # Apply the colorscale to the expressing pixels using the gene-specific normalization
+            color_values = colorscale(gene_norm(genexpr_image[right_side_mask]))[:, :3]
+            gene_overlay[right_side_mask] += color_values * 255
+            gene_count[right_side_mask] += 1
         
         # Apply the blended gene overlay to the right side of the image
         # Normalize by gene count to prevent oversaturation
-        for i in range(3):
-            # Where gene_count > 0, apply normalized gene colors
-            mask = gene_count > 0
-            if np.any(mask):
-                normalized_overlay = np.zeros_like(gene_overlay[:, :, i])
-                normalized_overlay[mask] = gene_overlay[:, :, i][mask] / gene_count[mask]
-                # Apply the normalized overlay to the right side
-                lipid_gene_image[:, mid_point:, i] = np.where(mask, normalized_overlay, lipid_gene_image[:, mid_point:, i])
+        mask = gene_count > 0
+        lipid_gene_image[:, mid_point:][mask] = gene_overlay[mask] / gene_count[mask][:, None]
         
         # Final processing
         binary_mask = np.where(self._data.acronyms_masks[slice_index] == 'Undefined', np.nan, 1)
@@ -1622,6 +2548,7 @@ class Figures:
     def compute_3D_root_volume(self, decrease_dimensionality_factor=7, differentiate_borders=False):
         """This function is used to generate a go.Volume (changed from Isosurface) of the Allen Brain root structure,
         which will be used to enclose the display of lipid expression of other structures in the brain.
+        The volume array is computed once per factor (see get_atlas_array()).
 
         Args:
             decrease_dimensionality_factor (int, optional): Decrease the dimensionality of the
@@ -1629,22 +2556,15 @@ class Figures:
         Returns:
             (go.Volume): A semi-transparent go.Volume of the Allen Brain root structure.
         """
-        # Get array of annotations, which associate coordinate to id
-        array_annotation_root = np.array(self._atlas.bg_atlas.annotation, dtype=np.int32)
-
-        # Subsample array of annotation
-        array_annotation_root = array_annotation_root[
-            ::decrease_dimensionality_factor,
-            ::decrease_dimensionality_factor,
-            ::decrease_dimensionality_factor,
-        ]
-
-        # Get the volume array
-        array_atlas_borders_root = fill_array_borders(
-            array_annotation_root,
-            differentiate_borders=differentiate_borders,
-            color_near_borders=False,
-            keep_structure_id=None,
+        # Get the volume array, from the subsampled array of annotations
+        array_atlas_borders_root = get_atlas_array(
+            f"root_x{decrease_dimensionality_factor}_{differentiate_borders}",
+            lambda: fill_array_borders(
+                np.array(self.get_array_of_annotations(decrease_dimensionality_factor)),
+                differentiate_borders=differentiate_borders,
+                color_near_borders=False,
+                keep_structure_id=None,
+            ),
         )
 
         # IMPORTANT CHANGE: Use np.indices instead of np.mgrid to match the lipid visualization
@@ -1666,25 +2586,122 @@ class Figures:
         )
         return brain_root_data
 
+    def compute_3D_root_mesh(self, decrease_dimensionality_factor=7, color="grey", opacity=0.1):
+        """This function is used to generate a go.Mesh3d of the surface of the Allen Brain root
+        structure, a much lighter alternative to compute_3D_root_volume(). The mesh is extracted
+        once from the annotations subsampled by MESH_ATLAS_FACTOR and stored on disk (see
+        modules/tools/mesh.py), then scaled to the requested factor.
+
+        Args:
+            decrease_dimensionality_factor (int, optional): Subsampling factor of the atlas whose
+                coordinates the mesh is displayed in. Defaults to 7.
+            color (str, optional): The color of the mesh. Defaults to "grey".
+            opacity (float, optional): The opacity of the mesh. Defaults to 0.1.
+
+        Returns:
+            (go.Mesh3d): A semi-transparent mesh of the Allen Brain root structure.
+        """
+        vertices, faces = load_or_compute_mesh(
+            get_mesh_path("atlas", "root"),
+            lambda: compute_mask_mesh(self.get_array_of_annotations(MESH_ATLAS_FACTOR) > 0),
+        )
+        vertices = vertices * (MESH_ATLAS_FACTOR / decrease_dimensionality_factor)
+        return build_mesh_trace(vertices, faces, color, opacity, name="root")
+
+    def compute_3D_lipid_meshes(
+        self, lipid_name, set_id_regions=None, downsample_factor=1, colorscale="Inferno"
+    ):
+        """This function computes the isosurface meshes of the volume of a lipid, at the levels
+        MESH_LIPID_LEVELS of its range of expression. The meshes of the whole brain are stored on
+        disk (and can be precomputed with modules/tools/mesh.py), while those of the volume
+        filtered by region are kept in memory for the last selections.
+
+        Args:
+            lipid_name (str): Name of the lipid.
+            set_id_regions (set(int), optional): The annotation ids of the regions to display the
+                lipid in. Defaults to None, i.e. the whole brain.
+            downsample_factor (int, optional): Factor by which the lipid volume is subsampled.
+                Defaults to 1.
+            colorscale (str, optional): Colorscale the colors of the isosurfaces are sampled from.
+                Defaults to "Inferno".
+
+        Returns:
+            (list(go.Mesh3d)): The meshes of the isosurfaces, from the lowest level to the highest.
+        """
+
+        def compute_volume():
+            lipid_path = os.path.join(PATH_3D_INTERPOLATED, f"{lipid_name}interpolation_log.npy")
+            array_volume = load_volume_level(
+                lipid_path, PATH_3D_PYRAMIDS, lipid_name, downsample_factor
+            )
+            if set_id_regions is not None:
+                mask = self.get_array_of_regions_mask(
+                    set_id_regions, decrease_dimensionality_factor=downsample_factor * 4
+                )
+                array_volume = np.where(mask, array_volume, np.nan)
+            return array_volume
+
+        if set_id_regions is None:
+            l_meshes = []
+            array_volume = None
+            for level in MESH_LIPID_LEVELS:
+                path = get_mesh_path(
+                    "lipids", get_lipid_mesh_name(lipid_name, downsample_factor, level)
+                )
+                if not os.path.exists(path) and array_volume is None:
+                    array_volume = compute_volume()
+                l_meshes.append(
+                    load_or_compute_mesh(
+                        path, lambda: compute_volume_meshes(array_volume, levels=(level,))[0]
+                    )
+                )
+        else:
+            key = (lipid_name, downsample_factor, tuple(sorted(set_id_regions)))
+            with lock_lipid_meshes:
+                l_meshes = dic_lipid_meshes.get(key)
+                if l_meshes is not None:
+                    dic_lipid_meshes.move_to_end(key)
+            if l_meshes is None:
+                l_meshes = compute_volume_meshes(compute_volume())
+                with lock_lipid_meshes:
+                    dic_lipid_meshes[key] = l_meshes
+                    dic_lipid_meshes.move_to_end(key)
+                    while len(dic_lipid_meshes) > MAX_LIPID_MESHES:
+                        dic_lipid_meshes.popitem(last=False)
+
+        l_colors_levels = px.colors.sample_colorscale(colorscale, list(MESH_LIPID_LEVELS))
+        return [
+            build_mesh_trace(vertices, faces, color, opacity, name=f"{lipid_name} ({level:.0%})")
+            for (vertices, faces), color, opacity, level in zip(
+                l_meshes, l_colors_levels, MESH_LIPID_OPACITIES, MESH_LIPID_LEVELS
+            )
+            if len(faces) > 0
+        ]
+
     def get_array_of_annotations(self, decrease_dimensionality_factor):
         """This function returns the array of annotations from the Allen Brain Atlas, subsampled to
-        decrease the size of the output.
+        decrease the size of the output. The array is computed once per factor (see
+        get_atlas_array()), and must not be modified.
         Args:
             decrease_dimensionality_factor (int): An integer used for subsampling the array. The
                 higher, the higher the subsampling.
 
         Returns:
-            (np.ndarray): A 3D array of annotation, in which structures are annotated with specific
-                identifiers.
+            (np.ndarray): A read-only 3D array of annotation, in which structures are annotated
+                with specific identifiers.
         """
-        # Get subsampled array of annotations
-        array_annotation = np.array(
-            self._atlas.bg_atlas.annotation[
-                ::decrease_dimensionality_factor,
-                ::decrease_dimensionality_factor,
-                ::decrease_dimensionality_factor,
-            ],
-            dtype=np.int32,
+        # Get subsampled array of annotations (subsampled before the conversion, to avoid copying
+        # the full-resolution array)
+        array_annotation = get_atlas_array(
+            f"annotation_x{decrease_dimensionality_factor}",
+            lambda: np.asarray(
+                self._atlas.bg_atlas.annotation[
+                    ::decrease_dimensionality_factor,
+                    ::decrease_dimensionality_factor,
+                    ::decrease_dimensionality_factor,
+                ],
+                dtype=np.int32,
+            ),
         )
 
         # Bug correction for the last slice
@@ -1697,6 +2714,64 @@ class Figures:
 
         return array_annotation
 
+    def get_array_of_labels(self, decrease_dimensionality_factor):
+        """This function returns the array of annotations subsampled by
+        decrease_dimensionality_factor (see get_array_of_annotations()), with the annotation ids
+        remapped to compact labels, such that the voxels of any set of regions can be selected
+        through a lookup table indexed by label. The arrays are computed once per factor (see
+        get_atlas_array()).
+
+        Args:
+            decrease_dimensionality_factor (int): An integer used for subsampling the array.
+
+        Returns:
+            (np.ndarray, np.ndarray): The sorted annotation ids, and the 3D array of labels, i.e.
+                of indices into the annotation ids.
+        """
+        array_ids = get_atlas_array(
+            f"annotation_ids_x{decrease_dimensionality_factor}",
+            lambda: np.unique(self.get_array_of_annotations(decrease_dimensionality_factor)),
+        )
+        array_labels = get_atlas_array(
+            f"annotation_labels_x{decrease_dimensionality_factor}",
+            lambda: np.searchsorted(
+                array_ids, self.get_array_of_annotations(decrease_dimensionality_factor)
+            ).astype(np.uint16),
+        )
+        return array_ids, array_labels
+
+    def get_array_of_regions_mask(self, set_id_regions, decrease_dimensionality_factor):
+        """This function returns the boolean mask of the voxels belonging to the requested regions
+        in the atlas subsampled by decrease_dimensionality_factor. The mask is gathered in one pass
+        through a lookup table indexed by the compact labels of get_array_of_labels(), and cached
+        per selection of regions and factor.
+
+        Args:
+            set_id_regions (set(int)): The annotation ids of the selected regions.
+            decrease_dimensionality_factor (int): An integer used for subsampling the array.
+
+        Returns:
+            (np.ndarray): A read-only 3D boolean array, True in the selected regions.
+        """
+        key = (decrease_dimensionality_factor, tuple(sorted(set_id_regions)))
+        with lock_regions_masks:
+            if key in dic_regions_masks:
+                # Move the mask to the end, such that the least recently used one is evicted first
+                dic_regions_masks.move_to_end(key)
+                return dic_regions_masks[key]
+
+        array_ids, array_labels = self.get_array_of_labels(decrease_dimensionality_factor)
+        lut = np.isin(array_ids, np.fromiter(set_id_regions, dtype=array_ids.dtype))
+        mask = lut[array_labels]
+        mask.flags.writeable = False
+
+        with lock_regions_masks:
+            dic_regions_masks[key] = mask
+            dic_regions_masks.move_to_end(key)
+            while len(dic_regions_masks) > MAX_REGIONS_MASKS:
+                dic_regions_masks.popitem(last=False)
+        return mask
+
     def compute_3D_volume_figure(
         self,
         lipid_name,
@@ -1706,10 +2781,13 @@ class Figures:
         opacity=0.4,
         surface_count=15,  # Reduced from 40 to 15
         colorscale="Inferno",
+        as_mesh=True,
+        packed=False,
     ):
         """
         Render a 3D volume visualization of lipid data with optional region filtering and grayscale root data.
-        Uses optimized rendering settings for better performance.
+        Uses optimized rendering settings for better performance. By default, the lipid expression
+        and the brain are rendered as isosurface meshes, which are much lighter than volumes.
 
         Parameters:
         -----------
@@ -1727,72 +2805,83 @@ class Figures:
             Number of isosurfaces to display
         colorscale : str, default='Inferno'
             Colorscale for the visualization
+        as_mesh : bool, default=True
+            Render isosurface meshes (go.Mesh3d) instead of volumes (go.Volume)
+        packed : bool, default=False
+            Return the figure as a dict with binary data arrays (see pack_3D_figure)
 
         Returns:
         --------
-        fig : plotly.graph_objects.Figure
+        fig : plotly.graph_objects.Figure or dict
             The 3D volume figure
         """
-        # Load lipid data
-        lipid_path = f"./data/3d_interpolated_native/{lipid_name}interpolation_log.npy"
-        np3d = np.load(lipid_path)
-
-        # CRITICAL: Use the same downsampling factor for both datasets
-        # Get root data with the same downsampling factor
-        root_data = self.compute_3D_root_volume(
-            decrease_dimensionality_factor=downsample_factor * 4
-        )
-        
-        # Get annotations with the same downsampling factor
-        annotations = self.get_array_of_annotations(
-            decrease_dimensionality_factor=downsample_factor * 4
-        )
-        # Downsample lipid data for better performance
-        sub_np3d = np3d[::downsample_factor, ::downsample_factor, ::downsample_factor]
-        
-        # Apply region filtering if regions are provided
-        if set_id_regions is not None:
-            # Create mask for selected regions
-            mask = np.zeros_like(annotations, dtype=bool)
-            for region_id in set_id_regions:
-                mask = np.logical_or(mask, annotations == region_id)
-
-            # Apply mask to lipid data
-            sub_np3d_clean = sub_np3d.copy()
-            sub_np3d_clean[~mask] = np.nan
+        if as_mesh:
+            # Root data with the same downsampling factor, and isosurfaces of the lipid expression
+            data = [
+                self.compute_3D_root_mesh(decrease_dimensionality_factor=downsample_factor * 4)
+            ] + self.compute_3D_lipid_meshes(
+                lipid_name,
+                set_id_regions=set_id_regions,
+                downsample_factor=downsample_factor,
+                colorscale=colorscale,
+            )
         else:
-            # If no filtering, use the downsampled data as is
-            sub_np3d_clean = sub_np3d
-
-        # Create coordinate grid for lipid data
-        z, y, x = np.indices(sub_np3d_clean.shape)
-
-        # Define custom opacity scale for better visualization (from old implementation)
-        # This makes background transparent while highlighting important features
-        opacityscale = [
-            [0.0, 0.0],      # Fully transparent for background/low values
-            [0.3, 0.2],      # Increase from 0.05 to 0.2
-            [0.7, 0.5],      # Increase from 0.2 to 0.5
-            [1.0, 0.8]       # Increase from 0.5 to 0.8
-        ]
+            # Load lipid data, reading only the requested level of its pyramid
+            lipid_path = os.path.join(PATH_3D_INTERPOLATED, f"{lipid_name}interpolation_log.npy")
+            sub_np3d = load_volume_level(lipid_path, PATH_3D_PYRAMIDS, lipid_name, downsample_factor)
+
+            # CRITICAL: Use the same downsampling factor for both datasets
+            # Get root data with the same downsampling factor
+            root_data = self.compute_3D_root_volume(
+                decrease_dimensionality_factor=downsample_factor * 4
+            )
+        
+            # Apply region filtering if regions are provided
+            if set_id_regions is not None:
+                # Get mask for selected regions, with the same downsampling factor
+                mask = self.get_array_of_regions_mask(
+                    set_id_regions, decrease_dimensionality_factor=downsample_factor * 4
+                )
 
-        # Set up volume plot with lipid data
-        lipid_volume = go.Volume(
-            x=x.flatten(),
-            y=y.flatten(),
-            z=z.flatten(),
-            value=sub_np3d_clean.flatten(),
-            isomin=np.nanmin(sub_np3d_clean) if not np.isnan(sub_np3d_clean).all() else 0,
-            isomax=np.nanmax(sub_np3d_clean) if not np.isnan(sub_np3d_clean).all() else 1,
-            # Replace flat opacity with custom opacity scale
-            opacityscale=opacityscale,
-            surface_count=surface_count,  # Reduced from 40 to 15
-            colorscale=colorscale,
-            caps=dict(x_show=False, y_show=False, z_show=False),
-        )
+                # Apply mask to lipid data
+                sub_np3d_clean = sub_np3d.copy()
+                sub_np3d_clean[~mask] = np.nan
+            else:
+                # If no filtering, use the downsampled data as is
+                sub_np3d_clean = sub_np3d
+
+            # Create coordinate grid for lipid data
+            z, y, x = np.indices(sub_np3d_clean.shape)
+
+            # Define custom opacity scale for better visualization (from old implementation)
+            # This makes background transparent while highlighting important features
+            opacityscale = [
+                [0.0, 0.0],      # Fully transparent for background/low values
+                [0.3, 0.2],      # Increase from 0.05 to 0.2
+                [0.7, 0.5],      # Increase from 0.2 to 0.5
+                [1.0, 0.8]       # Increase from 0.5 to 0.8
+            ]
 
-        # Create figure with both lipid and root data, root data first for proper layering
-        fig = go.Figure(data=[root_data, lipid_volume])
+            # Set up volume plot with lipid data
+            lipid_volume = go.Volume(
+                x=x.flatten(),
+                y=y.flatten(),
+                z=z.flatten(),
+                value=sub_np3d_clean.flatten(),
+                isomin=np.nanmin(sub_np3d_clean) if not np.isnan(sub_np3d_clean).all() else 0,
+                isomax=np.nanmax(sub_np3d_clean) if not np.isnan(sub_np3d_clean).all() else 1,
+                # Replace flat opacity with custom opacity scale
+                opacityscale=opacityscale,
+                surface_count=surface_count,  # Reduced from 40 to 15
+                colorscale=colorscale,
+                caps=dict(x_show=False, y_show=False, z_show=False),
+            )
+
+            # Root data first for proper layering
+            data = [root_data, lipid_volume]
+
+        # Create figure with both lipid and root data
+        fig = go.Figure(data=data)
 
         # Improve layout
         fig.update_layout(
@@ -1835,6 +2924,8 @@ class Figures:
             paper_bgcolor="rgba(0,0,0,0)",
         )
 
+        if packed:
+            return pack_3D_figure(fig)
         return fig
         
     # # ==============================================================================================
@@ -2203,203 +3294,19 @@ class Figures:
     #     )
 
     def shelve_all_arrays_annotation(self):
-        """This functions precomputes and shelves the array of structure annotation used in a
-        3D representation of the brain (through self.compute_3D_volume_figure()), at different
-        resolutions. Once everything has been shelved, a boolean value is stored in the shelve
-        database, to indicate that the arrays do not need to be recomputed at next app startup.
+        """This functions precomputes the arrays of structure annotation and the root volumes used
+        in a 3D representation of the brain (through self.compute_3D_volume_figure()), at different
+        resolutions, and stores them on disk (see get_atlas_array()). Once everything has been
+        computed, a boolean value is stored in the shelve database, to indicate that the arrays do
+        not need to be recomputed at next app startup.
         """
         for decrease_dimensionality_factor in range(2, 13):
-            self._storage.return_shelved_object(
-                "figures/3D_page",
-                "arrays_annotation",
-                force_update=False,
-                compute_function=self.get_array_of_annotations,
-                decrease_dimensionality_factor=decrease_dimensionality_factor,
-            )
+            self.get_array_of_annotations(decrease_dimensionality_factor)
+            self.compute_3D_root_volume(decrease_dimensionality_factor)
 
         # Variable to signal everything has been computed
         self._storage.dump_shelved_object("figures/3D_page", "arrays_annotation_computed", True)
 
-    def compute_heatmap_grid_per_lipid(
-        self,
-        lipid_name,
-        draw=False,
-        return_base64_string=False,
-        cache_flask=None,
-    ):
-        """This function creates a grid of heatmaps showing the lipid expression across all slices.
-
-        Args:
-            lipid_name (str): Name of the lipid to display
-            draw (bool, optional): If True, enables drawing on the figure. Defaults to False.
-            return_base64_string (bool, optional): If True, returns base64 string. Defaults to False.
-            cache_flask (flask_caching.Cache, optional): Flask cache. Defaults to None.
-
-        Returns:
-            go.Figure: A Plotly figure containing a grid of heatmaps for all slices
-        """
-        logging.info("Starting grid figure computation")
-
-        # Get total number of slices from MaldiData
-        n_slices = self._data.get_slice_number()
-
-        # Calculate grid dimensions, convert to Python int to avoid numpy integer issues
-        n_cols = 12
-        n_rows = int(
-            (n_slices + n_cols - 1) // n_cols
-        )  # Ceiling division with explicit int conversion
-
-        # Create subplots
-        fig = make_subplots(
-            rows=n_rows,
-            cols=n_cols,
-            horizontal_spacing=0.01,
-            vertical_spacing=0.01,
-        )
-
-        # Add heatmaps for each slice
-        valid_count = 0
-        max_height = 0
-        max_width = 0
-
-        # First pass to determine maximum dimensions for aspect ratio consistency
-        for slice_index in range(1, n_slices + 1):
-            try:
-                image = self._data.extract_lipid_image(float(slice_index), lipid_name)
-                if image is not None and image.size > 0:
-                    max_height = max(max_height, image.shape[0])
-                    max_width = max(max_width, image.shape[1])
-            except:
-                continue
-
-        # Calculate cell size to maintain aspect ratio
-        aspect_ratio = max_height / max_width if max_width > 0 else 1
-        cell_width = 100
-        cell_height = int(cell_width * aspect_ratio)
-
-        # Second pass to add the traces
-        for slice_index in range(1, n_slices + 1):
-            try:
-                # Calculate row and column position (1-based indexing for subplot)
-                row = (valid_count // n_cols) + 1
-                col = (valid_count % n_cols) + 1
-
-                # Get lipid image directly from MaldiData
-                image = self._data.extract_lipid_image(float(slice_index), lipid_name)
-
-                # Skip if image is None or empty
-                if image is None or image.size == 0:
-                    continue
-
-                # Flip the image vertically
-                image = np.flip(image.T, np.flipud(image), axis=0)
-
-                # Add heatmap to subplot
-                fig.add_trace(
-                    go.Heatmap(
-                        z=image,
-                        showscale=False,
-                        colorscale="viridis",
-                        hoverinfo="none",  # Disable hover to simplify
-                    ),
-                    row=row,
-                    col=col,
-                )
-
-                # Add a simple text annotation for slice number
-                fig.add_annotation(
-                    text=f"{slice_index}",
-                    x=0.5,
-                    y=0.9,
-                    xref=f"x{valid_count+1}",
-                    yref=f"y{valid_count+1}",
-                    showarrow=False,
-                    font=dict(color="white", size=10),
-                )
-
-                valid_count += 1
-
-            except Exception as e:
-                logging.warning(f"Error processing slice {slice_index}: {str(e)}")
-                continue
-
-        # Update layout
-        fig.update_layout(
-            height=cell_height * n_rows + 100,
-            width=cell_width * n_cols + 100,
-            showlegend=False,
-            margin=dict(t=30, r=10, b=10, l=10),
-            template="plotly_dark",
-            paper_bgcolor="rgba(0,0,0,0)",  # Darker background
-            plot_bgcolor="rgba(0,0,0,0)",  # Darker background
-            clickmode="event+select",  # Enable click events
-        )
-
-        # Remove all axes, grids and ticks
-        fig.update_xaxes(
-            visible=False,
-            showgrid=False,
-            zeroline=False,
-            constrain="domain",  # Maintain aspect ratio
-            scaleanchor="y",  # Keep x and y scales linked
-        )
-
-        fig.update_yaxes(
-            visible=False,
-            showgrid=False,
-            zeroline=False,
-            constrain="domain",  # Maintain aspect ratio
-            scaleanchor="x",  # Keep x and y scales linked
-        )
-
-        # Add a callback for handling double-click events
-        fig.update_layout(
-            updatemenus=[
-                dict(
-                    type="buttons",
-                    showactive=False,
-                    buttons=[
-                        dict(
-                            label="Reset View",
-                            method="relayout",
-                            args=[{"xaxis.autorange": True, "yaxis.autorange": True}],
-                        )
-                    ],
-                    x=0.05,
-                    y=0.05,
-                    xanchor="left",
-                    yanchor="bottom",
-                )
-            ]
-        )
-
-        # Add JavaScript for double-click zooming functionality
-        fig.update_layout(
-            annotations=[
-                dict(
-                    x=0,
-                    y=0,
-                    xref="paper",
-                    yref="paper",
-                    text="Double-click on a plot to zoom in",
-                    showarrow=False,
-                    font=dict(size=10, color="white"),
-                    opacity=0.7,
-                    align="left",
-                )
-            ]
-        )
-
-        # Add custom JavaScript for double-click zooming
-        fig.update_layout(
-            newshape=dict(line_color="yellow"),  # Just to add a hook for the JavaScript
-        )
-
-        # Add setup for callback via JavaScript with plotly_doubleclick event
-        fig._config = {"responsive": True}
-
-        return fig
-
     def export_grid_to_plotly(
         self,
         grid_image,
@@ -196,17 +196,10 @@ class Launch:
             "figures/3D_page/arrays_expression_False_computed",
             #
             # Computed in in Figures.__init(), calling Figures.shelve_all_arrays_annotation(),
-            # but it doesn't correspond to an object returned by a specific function. The
-            # corresponding objects saved in Figures.shelve_all_arrays_annotation() are in the
-            # comment below.
+            # but it doesn't correspond to an object returned by a specific function. The arrays
+            # computed in Figures.shelve_all_arrays_annotation() are stored on disk, outside of the
+            # shelve database (see get_atlas_array() in modules/figures.py).
             "figures/3D_page/arrays_annotation_computed",
-        ] + [
-            # Computed in in Figures.__init(), calling Figures.shelve_all_arrays_annotation().
-            # Corresponds to the object returned by
-            # Figures.get_array_of_annotations(decrease_dimensionality_factor), with
-            # decrease_dimensionality_factor ranging from 2 to 11.
-            "figures/3D_page/arrays_annotation_" + str(decrease_dimensionality_factor)
-            for decrease_dimensionality_factor in range(2, 13)
         ]
 
         # Objects to shelve in the ScRNAseq class. Everything in this list is shelved at
@@ -8,8 +8,9 @@ from time import time
 from typing import Dict, List, Optional, Tuple
 # from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
 import numpy as np
-from scipy.ndimage import generic_filter
-from collections import Counter
+from scipy.ndimage import generic_filter, correlate1d, uniform_filter
+from collections import Counter, OrderedDict
+import threading
 import pickle
 
 # Redis caching imports
@@ -47,6 +48,158 @@ def majority_vote_9x9(window):
     return mode
 
 
+def majority_vote_filter(array, size=9):
+    """Vectorized equivalent of generic_filter(array, majority_vote_9x9, size=(size, size)): the
+    non-NaN pixels are kept, and the NaN pixels take the most common non-NaN value of their
+    size x size neighbourhood (or stay NaN if there is none). Ties are broken towards the smallest
+    value.
+
+    Args:
+        array (np.ndarray): 2D float array, with NaN for missing pixels.
+        size (int, optional): Size of the square neighbourhood. Defaults to 9.
+
+    Returns:
+        (np.ndarray): The filtered array.
+    """
+    kernel = np.ones(size, dtype=np.uint8)
+    best_count = np.zeros(array.shape, dtype=np.uint8)
+    best_value = np.full(array.shape, np.nan)
+
+    # Count each value in the neighbourhood of each pixel with a separable box filter, and keep the
+    # running argmax
+    for value in np.unique(array[~np.isnan(array)]):
+        count = correlate1d((array == value).astype(np.uint8), kernel, axis=0, mode="constant")
+        count = correlate1d(count, kernel, axis=1, mode="constant")
+        better = count > best_count
+        best_count[better] = count[better]
+        best_value[better] = value
+
+    return np.where(np.isnan(array), best_value, array)
+
+
+# Contour masks are shared across datasets (and slices with identical pixel indices), such that
+# the atlas contours are only computed once per section
+dic_aba_contours_masks = {}
+
+
+def get_aba_contours_mask(coordinates, image_shape):
+    """Computes the (uint8) mask of the Allen Brain Atlas contours of a section, from the indices
+    of its pixels.
+
+    Args:
+        coordinates (np.ndarray): Array of shape (n_pixels, 3) containing the x_index, y_index and
+            z_index of each pixel of the section.
+        image_shape (tuple): Shape of the image.
+
+    Returns:
+        (np.ndarray): A uint8 array of shape image_shape, 1 on the contours and 0 elsewhere.
+    """
+    key = hashlib.md5(np.ascontiguousarray(coordinates).tobytes()).hexdigest()
+    if key in dic_aba_contours_masks:
+        return dic_aba_contours_masks[key]
+
+    raster_index = get_raster_index(coordinates[:, 1], coordinates[:, 2], image_shape)
+    arr_z = np.full(image_shape[0] * image_shape[1], np.nan)
+    arr_z[raster_index.flat_indices] = coordinates[raster_index.rows, 0]
+    arr_z = arr_z.reshape(image_shape)
+    arr_z = majority_vote_filter(arr_z, size=9)
+
+    # Look up the contours of the atlas plane of each pixel
+    rows, cols = np.nonzero(~np.isnan(arr_z))
+    planes = arr_z[rows, cols].astype(int)
+    in_atlas = (0 <= planes) & (planes < ABA_CONTOURS.shape[0])
+    rows, cols, planes = rows[in_atlas], cols[in_atlas], planes[in_atlas]
+
+    mask = np.zeros(image_shape, dtype=np.uint8)
+    mask[rows, cols] = ABA_CONTOURS[planes, rows, cols] == 1
+
+    dic_aba_contours_masks[key] = mask
+    return mask
+
+
+def fill_holes_nearest_neighbor(stack, undefined_mask, max_distance=5):
+    """Fill holes (NaN values) of a stack of images with the mean of the non-NaN values in a
+    (2 * max_distance + 1) square window around them, for all images at once. Pixels closer than
+    max_distance to the border are left untouched, and pixels outside of the brain are set to NaN.
+
+    Args:
+        stack: 3D numpy array (n_images, height, width) with potential NaN values
+        undefined_mask: 2D boolean array, True outside of the brain
+        max_distance: Half-size of the window used to search for neighbors
+
+    Returns:
+        3D numpy array with holes filled
+    """
+    size = (1, 2 * max_distance + 1, 2 * max_distance + 1)
+    n_window = size[1] * size[2]
+
+    # Sum and count of the non-NaN values in the window around each pixel
+    valid = ~np.isnan(stack)
+    counts = np.rint(uniform_filter(valid.astype(np.float64), size=size, mode="constant") * n_window)
+    sums = uniform_filter(np.where(valid, stack, 0.0), size=size, mode="constant") * n_window
+
+    interior = np.zeros(stack.shape[1:], dtype=bool)
+    interior[max_distance:-max_distance, max_distance:-max_distance] = True
+    holes = ~valid & interior & (counts > 0)
+
+    filled = np.where(holes, sums / np.maximum(counts, 1), stack)
+    filled[:, undefined_mask] = np.nan
+
+    return filled
+
+
+def rasterize_slice_data(slice_data, names, image_shape, dataset=None):
+    """Scatter the values of the requested features of a slice into a stack of images, in a single
+    vectorized pass.
+
+    Args:
+        slice_data: SliceData of the slice
+        names: Names of the features, as in slice_data.content_names
+        image_shape: Shape of each image
+        dataset: Name of the dataset of the slice, under which its raster index is registered.
+            Defaults to None, in which case the index is not registered.
+
+    Returns:
+        3D numpy array (len(names), height, width), NaN where there is no data. Unknown features
+        are left entirely NaN.
+    """
+    raster_index = get_slice_raster_index(slice_data, image_shape, dataset=dataset)
+    stack = np.full((len(names), image_shape[0] * image_shape[1]), np.nan)
+
+    dic_columns = {name: index for index, name in enumerate(slice_data.content_names)}
+    l_channels, l_columns = [], []
+    for channel, name in enumerate(names):
+        if name in dic_columns:
+            l_channels.append(channel)
+            l_columns.append(dic_columns[name])
+        else:
+            logging.info(f"{name} is not available in this slice.")
+
+    # Single flat-index assignment for all channels
+    if len(l_columns) > 0:
+        stack[np.array(l_channels)[:, None], raster_index.flat_indices] = (
+            slice_data.images[raster_index.rows][:, l_columns].T
+        )
+
+    return stack.reshape(len(names), image_shape[0], image_shape[1])
+
+
+def aba_contours_mask_to_overlay(mask, color=(255, 165, 0, 200)):
+    """Turns a contour mask into an RGBA overlay, transparent white outside of the contours.
+
+    Args:
+        mask (np.ndarray): uint8 contour mask, as returned by get_aba_contours_mask().
+        color (tuple, optional): RGBA color of the contours. Defaults to orange.
+
+    Returns:
+        (np.ndarray): RGBA image array of shape (mask.shape[0], mask.shape[1], 4).
+    """
+    overlay = np.empty((mask.shape[0], mask.shape[1], 4), dtype=np.uint8)
+    overlay[:] = (255, 255, 255, 0)
+    overlay[mask.astype(bool)] = color
+    return overlay
+
+
 # @dataclass
 # class LipidImage:
 #     """Class to store lipid image data and metadata.
@@ -92,6 +245,112 @@ class SliceData:
         # indices: np.ndarray     
         # images: np.ndarray
 
+
+@dataclass
+class RasterIndex:
+    """Class to store the rasterization index of a slice, i.e. where each row of its scatter data
+    lands in the image. Each pixel of the image maps to at most one row: rows of duplicated pixels
+    are dropped (see get_raster_index).
+
+    Attributes:
+        image_shape: Shape of the image
+        rows: Rows of the scatter data that fall within the image
+        flat_indices: Linear index in the image of each row in rows
+        mask: 2D boolean array, True for the pixels that have data
+        pixel_to_row: 2D integer array, row of the scatter data of each pixel (-1 if none)
+    """
+    image_shape: Tuple[int, int]
+    rows: np.ndarray
+    flat_indices: np.ndarray
+    mask: np.ndarray
+    pixel_to_row: np.ndarray
+
+
+# Raster indices of the slices, keyed by (dataset, brain_id, slice_index), and bounded as LRU. They
+# are not shared across datasets: the rows of a raster index are positions in the scatter data of
+# one dataset, and the lipid, peak and program data of a slice are stored independently, with no
+# guarantee that their pixels come in the same order (or are even the same). The lock makes the
+# registry safe for the threads of the server.
+MAX_RASTER_INDICES = 32
+dic_raster_indices = OrderedDict()
+lock_raster_indices = threading.Lock()
+
+
+def get_raster_index(row_coordinates, col_coordinates, image_shape, key=None):
+    """Returns the rasterization index of a slice from the coordinates of its pixels. If a key is
+    given, the index is registered under it in dic_raster_indices (bounded to MAX_RASTER_INDICES,
+    least recently used first out), and only computed if it is not already there. Without a key,
+    e.g. for ad-hoc sets of coordinates, the index is computed and not registered.
+
+    If several pixels share the same coordinates, only the last one is kept in the index, such
+    that each pixel of the image maps to a single row of the scatter data.
+
+    Args:
+        row_coordinates: 1D array, image row of each pixel (y_index for SliceData)
+        col_coordinates: 1D array, image column of each pixel (z_index for SliceData)
+        image_shape: Shape of the image
+        key: Hashable key of the slice, e.g. (dataset, brain_id, slice_index). Defaults to None.
+
+    Returns:
+        RasterIndex of the slice
+    """
+    if key is not None:
+        with lock_raster_indices:
+            if key in dic_raster_indices:
+                dic_raster_indices.move_to_end(key)
+                return dic_raster_indices[key]
+
+    row_coordinates = np.asarray(row_coordinates).astype(int)
+    col_coordinates = np.asarray(col_coordinates).astype(int)
+
+    # Ensure indices are within bounds
+    valid = (
+        (0 <= row_coordinates)
+        & (row_coordinates < image_shape[0])
+        & (0 <= col_coordinates)
+        & (col_coordinates < image_shape[1])
+    )
+    rows = np.flatnonzero(valid)
+    flat_indices = np.ravel_multi_index(
+        (row_coordinates[valid], col_coordinates[valid]), tuple(image_shape)
+    )
+
+    # Keep only the last row of duplicated pixels
+    _, last = np.unique(flat_indices[::-1], return_index=True)
+    if len(last) < len(flat_indices):
+        logging.info(f"{len(flat_indices) - len(last)} duplicated pixels ignored in raster index")
+        keep = np.sort(len(flat_indices) - 1 - last)
+        rows, flat_indices = rows[keep], flat_indices[keep]
+
+    pixel_to_row = np.full(image_shape[0] * image_shape[1], -1, dtype=np.int32)
+    pixel_to_row[flat_indices] = rows
+    pixel_to_row = pixel_to_row.reshape(image_shape)
+
+    raster_index = RasterIndex(
+        image_shape=tuple(image_shape),
+        rows=rows,
+        flat_indices=flat_indices,
+        mask=pixel_to_row >= 0,
+        pixel_to_row=pixel_to_row,
+    )
+    if key is not None:
+        with lock_raster_indices:
+            dic_raster_indices[key] = raster_index
+            dic_raster_indices.move_to_end(key)
+            while len(dic_raster_indices) > MAX_RASTER_INDICES:
+                dic_raster_indices.popitem(last=False)
+    return raster_index
+
+
+def get_slice_raster_index(slice_data, image_shape, dataset=None):
+    """Returns the rasterization index of a SliceData (see get_raster_index), registered under
+    (dataset, brain_id, slice_index) if a dataset is given."""
+    key = None if dataset is None else (dataset, slice_data.brain_id, slice_data.slice_index)
+    return get_raster_index(
+        slice_data.indices[:, 1], slice_data.indices[:, 2], image_shape, key=key
+    )
+
+
 class MaldiData:
     """Class to handle the storage of the new MALDI data format with direct lipid images.
 
@@ -165,11 +424,32 @@ class MaldiData:
         
         return None
 
+    def _get_many_from_cache(self, cache_keys):
+        """Try to get several cached results from Redis in a single round trip (MGET).
+
+        Args:
+            cache_keys: List of cache keys to fetch.
+
+        Returns:
+            List of the same length as cache_keys, with None for every missing key.
+        """
+        if not self._use_redis or len(cache_keys) == 0:
+            return [None] * len(cache_keys)
+
+        try:
+            cached_results = self._redis_client.mget(cache_keys)
+            logging.info(f"CACHE MGET: {sum(r is not None for r in cached_results)}/{len(cache_keys)} hits")
+            return [pickle.loads(r) if r else None for r in cached_results]
+        except Exception as e:
+            logging.warning(f"Error reading from cache: {e}")
+
+        return [None] * len(cache_keys)
+
     def _save_to_cache(self, cache_key, result, expire_seconds=3600):
         """Save a result to Redis cache."""
         if not self._use_redis:
             return
-        
+
         try:
             # Serialize the result
             serialized_result = pickle.dumps(result)
@@ -179,6 +459,24 @@ class MaldiData:
         except Exception as e:
             logging.warning(f"Error saving to cache: {e}")
 
+    def _save_many_to_cache(self, dic_results, expire_seconds=3600):
+        """Save several results to Redis cache in a single round trip (pipelined SETs).
+
+        Args:
+            dic_results: Dictionary mapping cache keys to the results to save.
+        """
+        if not self._use_redis or len(dic_results) == 0:
+            return
+
+        try:
+            pipe = self._redis_client.pipeline(transaction=False)
+            for cache_key, result in dic_results.items():
+                pipe.set(cache_key, pickle.dumps(result), ex=expire_seconds)
+            pipe.execute()
+            logging.info(f"Saved {len(dic_results)} items to cache")
+        except Exception as e:
+            logging.warning(f"Error saving to cache: {e}")
+
     def get_annotations(self) -> pd.DataFrame:
         return self._df_annotations
 
@@ -291,9 +589,41 @@ class MaldiData:
             else:
                 # Don't cache None results - they might be temporary failures
                 logging.warning(f"No data found for slice {slice_index}, brain_id {brain_id}")
-            
+
             return result
 
+    def get_slices_data(self, slice_indices):
+        """Retrieve the SliceData of several slices at once. Cached slices are fetched from Redis
+        in a single round trip, and the missing ones are read from the shelve database in a single
+        opening, then cached together.
+
+        Args:
+            slice_indices: List of slice indices
+
+        Returns:
+            List of SliceData objects (None for the slices that could not be found), in the same
+            order as slice_indices.
+        """
+        cache_keys = [self._generate_cache_key("get_lipids_image", s) for s in slice_indices]
+        l_slice_data = self._get_many_from_cache(cache_keys)
+
+        missing = [i for i, slice_data in enumerate(l_slice_data) if slice_data is None]
+        if len(missing) > 0:
+            logging.info(f"CACHE MISS! Reading {len(missing)} slices from the shelve database")
+            dic_to_cache = {}
+            with shelve.open(os.path.join(self.path_data, "lipid_images"), flag="r") as db:
+                for i in missing:
+                    brain_id = self.get_brain_id_from_sliceindex(slice_indices[i])
+                    result = db.get(f"{brain_id}/slice_{float(slice_indices[i])}")
+                    if result is not None:
+                        l_slice_data[i] = result
+                        dic_to_cache[cache_keys[i]] = result
+                    else:
+                        logging.warning(f"No data found for slice {slice_indices[i]}, brain_id {brain_id}")
+            self._save_many_to_cache(dic_to_cache)
+
+        return l_slice_data
+
     def get_available_brains(self) -> List[str]:
         """Get list of available brain IDs in the database."""
         with shelve.open(os.path.join(self.path_metadata, "metadata"), flag="r") as db_metadata:
@@ -443,54 +773,66 @@ class MaldiData:
             blank_image[:, :, 3] = 0
             return blank_image
             
-        coordinates_scatter = pd.DataFrame(coordinates, columns=["x_index", "y", "x"])
- 
-        # Convert coordinates to integers for indexing
-        x_indices = coordinates_scatter["x"].astype(int).values
-        y_indices = coordinates_scatter["y"].astype(int).values
-        # Ensure indices are within bounds
-        valid_indices = (
-            (0 <= x_indices) & (x_indices < 1000) & (0 <= y_indices) & (y_indices < 1000)
+        array_image_atlas = aba_contours_mask_to_overlay(
+            get_aba_contours_mask(coordinates, self.image_shape)
         )
-
-        arr_z = np.full(self.image_shape, np.nan)
-        arr_z[y_indices[valid_indices], x_indices[valid_indices]] = coordinates_scatter["x_index"].values[
-            valid_indices
-        ]
-        arr_z = generic_filter(arr_z, function=majority_vote_9x9, size=(9, 9), mode='constant', cval=np.nan)
-
-        # define array_image_atlas as all values to be (255, 255, 255, 0)
-        array_image_atlas = np.ones((arr_z.shape[0], arr_z.shape[1], 4), dtype=np.uint8)
-        array_image_atlas[:, :, :3] = 255
-        array_image_atlas[:, :, 3] = 0
-
-        for i in range(arr_z.shape[0]):
-            for j in range(arr_z.shape[1]):
-                k = arr_z[i,j]
-                try:
-                    is_contour = ABA_CONTOURS[int(k), i, j] == 1
-                    if is_contour:
-                        array_image_atlas[i, j] = [255, 165, 0, 200]
-                except:
-                    continue
         
         # Save result to cache for future use
         self._save_to_cache(cache_key, array_image_atlas)
         
         return array_image_atlas
 
+    def extract_images(
+        self,
+        slice_index,
+        lipid_names,
+        fill_holes=True,
+        slice_data=None,
+    ):
+        """Extract the images of several lipids at once: the slice data is fetched once, all the
+        lipids are scattered in a single pass, and holes are filled once for all images.
+
+        Args:
+            slice_index: Index of the slice
+            lipid_names: Names of the lipids
+            fill_holes: Whether to fill holes using nearest neighbor interpolation
+            slice_data: SliceData of the slice, if already fetched by the caller. Defaults to
+                None, in which case it is retrieved from the cache/database.
+
+        Returns:
+            3D numpy array (len(lipid_names), height, width) with the lipid distributions, or None
+            if the slice is not found
+        """
+        if slice_data is None:
+            slice_data = self.get_lipids_image(slice_index)
+        if slice_data is None:
+            logging.info(f"Slice {slice_index} was not found.")
+            return None
+
+        stack = rasterize_slice_data(
+            slice_data, lipid_names, self.image_shape, dataset=self.path_data
+        )
+        if fill_holes and np.isnan(stack).any():
+            stack = fill_holes_nearest_neighbor(
+                stack, self.acronyms_masks[slice_index] == 'Undefined'
+            )
+        return stack
+
     def extract_lipid_image(
         self, 
         slice_index, 
-        lipid_name, 
-        fill_holes=True
-    ): 
+        lipid_name,
+        fill_holes=True,
+        slice_data=None,
+    ):
         """Extract a lipid image from scatter data with optional hole filling.
 
         Args:
             slice_index: Index of the slice
             lipid_name: Name of the lipid
             fill_holes: Whether to fill holes using nearest neighbor interpolation
+            slice_data: SliceData of the slice, if already fetched by the caller. Defaults to
+                None, in which case it is retrieved from the cache/database.
 
         Returns:
             2D numpy array with the lipid distribution or None if not found
@@ -500,7 +842,8 @@ class MaldiData:
             # lipid_data = self.get_lipid_image(slice_index, lipid_name)
             # lipid_data.indices --> x_index, y_index, z_index (dim: num_pixels, 3)
             # lipid_data.image --> lipid_expression (dim: num_pixels, 1)
-            slice_data = self.get_lipids_image(slice_index)
+            if slice_data is None:
+                slice_data = self.get_lipids_image(slice_index)
             # slice_data.indices --> x_index, y_index, z_index (dim: num_pixels, 3)
             # slice_data.images --> lipid_expression (dim: num_pixels, num_lipids)
             
@@ -516,30 +859,14 @@ class MaldiData:
             # Convert scatter data to image
             # scatter_points = lipid_data.image  # This is a numpy array with shape (N, 1)
 
-            # Create a DataFrame from the scatter points
-            lipid_data = slice_data.images[:, slice_data.content_names.index(lipid_name)]
-            scatter = pd.DataFrame({
-                            "x": slice_data.indices[:, 2],
-                            "y": slice_data.indices[:, 1],
-                            "value": lipid_data # ensure it's 1D
-                        })
-
-            # Create an empty array to hold the image
-            arr = np.full(self.image_shape, np.nan)  # Adjust dimensions if needed
-
-            # Convert coordinates to integers for indexing
-            x_indices = scatter["x"].astype(int).values # z_index
-            y_indices = scatter["y"].astype(int).values # y_index
-
-            # Ensure indices are within bounds
-            valid_indices = (
-                (0 <= x_indices) & (x_indices < 1000) & (0 <= y_indices) & (y_indices < 1000)
-            )
+            if lipid_name not in slice_data.content_names:
+                logging.info(f"{lipid_name} is not available in slice {slice_index}.")
+                return None
 
-            # Fill the array with values at the specified coordinates
-            arr[y_indices[valid_indices], x_indices[valid_indices]] = scatter["value"].values[
-                valid_indices
-            ]
+            # Scatter the values with the (shared) raster index of the slice
+            arr = rasterize_slice_data(
+                slice_data, [lipid_name], self.image_shape, dataset=self.path_data
+            )[0]
 
             # Check if we need to fill holes
             if fill_holes:
@@ -571,54 +898,9 @@ class MaldiData:
         Returns:
             2D numpy array with holes filled
         """
-        # Make a copy to avoid modifying the original
-        filled = arr.copy()
-
-        # Find indices of NaN values
-        nan_indices = np.where(np.isnan(arr))
-
-        # No NaN values, return the original array
-        if len(nan_indices[0]) == 0:
-            return filled
-
-        # Find indices of non-NaN values
-        valid_indices = np.where(~np.isnan(arr))
-        valid_values = arr[valid_indices]
-
-        # For each NaN point, find the nearest non-NaN neighbor
-        for i in range(len(nan_indices[0])):
-            x, y = nan_indices[0][i], nan_indices[1][i]
-
-            # Skip if we're at the boundary
-            if (
-                x < max_distance
-                or y < max_distance
-                or x >= arr.shape[0] - max_distance
-                or y >= arr.shape[1] - max_distance
-            ):
-                continue
-
-            # Extract a window around the NaN point
-            window = arr[
-                x - max_distance : x + max_distance + 1, y - max_distance : y + max_distance + 1
-            ]
-
-            # Skip if all values in the window are NaN
-            if np.all(np.isnan(window)):
-                continue
-
-            # Get the nearest non-NaN value
-            window_values = window.flatten()
-            non_nan_values = window_values[~np.isnan(window_values)]
-
-            if len(non_nan_values) > 0:
-                # Use the mean of nearby non-NaN values
-                filled[x, y] = np.mean(non_nan_values)
-
-        binary_mask = np.where(self.acronyms_masks[slice_index] == 'Undefined', np.nan, 1)
-        filled = filled * binary_mask
-
-        return filled
+        return fill_holes_nearest_neighbor(
+            arr[None], self.acronyms_masks[slice_index] == 'Undefined', max_distance=max_distance
+        )[0]
 
         # """
         # # Optional: For remaining NaN values, use a more aggressive approach
@@ -694,16 +976,26 @@ class MaldiData:
         ]
 
     def get_pixels_from_indices(self, slice_index, z_indices, y_indices):
-        yz_coords = self.get_image_indices(slice_index)[:, 1:]
-        
-        mask_set = set(zip(y_indices, z_indices))
-        mask = np.array([(y, z) in mask_set for y, z in yz_coords])
+        slice_data = self.get_lipids_image(slice_index)
+        raster_index = get_slice_raster_index(slice_data, self.image_shape, dataset=self.path_data)
+
+        # Look up the rows of the requested pixels in the raster index. Each pixel maps to a single
+        # row, so duplicated pixels of the slice data are returned only once (see get_raster_index)
+        y_indices = np.asarray(y_indices).astype(int)
+        z_indices = np.asarray(z_indices).astype(int)
+        in_image = (
+            (0 <= y_indices) & (y_indices < self.image_shape[0])
+            & (0 <= z_indices) & (z_indices < self.image_shape[1])
+        )
+        rows = raster_index.pixel_to_row[y_indices[in_image], z_indices[in_image]]
+        mask = np.zeros(slice_data.images.shape[0], dtype=bool)
+        mask[rows[rows >= 0]] = True
 
         # pixels = np.array([
         #     self.get_lipid_image(slice_index=slice_index, lipid_name=lipid_name).image[mask]
         #     for lipid_name in self.get_available_lipids(slice_index)
         # ]).T
-        pixels = self.get_lipids_image(slice_index).images[mask, :]
+        pixels = slice_data.images[mask, :]
         
         return pixels
 
@@ -7,7 +7,14 @@ from dataclasses import dataclass
 from time import time
 from typing import Dict, List, Optional, Tuple
 
-from modules.maldi_data import SliceData, majority_vote_9x9
+from modules.maldi_data import (
+    SliceData,
+    majority_vote_9x9,
+    get_aba_contours_mask,
+    aba_contours_mask_to_overlay,
+    fill_holes_nearest_neighbor,
+    rasterize_slice_data,
+)
 from modules.atlas import ABA_DIM, ABA_CONTOURS, ACRONYM_MASKS, ACRONYMS_PIXELS
 # from allensdk.core.mouse_connectivity_cache import MouseConnectivityCaches
 from scipy.ndimage import generic_filter
@@ -169,6 +176,20 @@ class PeakData:
         with shelve.open(os.path.join(self.path_data, "peak_images"), flag="r") as db:
             return db.get(key)
 
+    def get_slices_data(self, slice_indices):
+        """Retrieve the SliceData of several slices at once, opening the shelve database only once.
+
+        Args:
+            slice_indices: List of slice indices
+
+        Returns:
+            List of SliceData objects (None for the slices that could not be found), in the same
+            order as slice_indices.
+        """
+        keys = [f"{self.get_brain_id_from_sliceindex(s)}/slice_{float(s)}" for s in slice_indices]
+        with shelve.open(os.path.join(self.path_data, "peak_images"), flag="r") as db:
+            return [db.get(key) for key in keys]
+
     def get_available_brains(self) -> List[str]:
         """Get list of available brain IDs in the database."""
         with shelve.open(os.path.join(self.path_metadata, "metadata_peaks"), flag="r") as db_metadata:
@@ -309,50 +330,62 @@ class PeakData:
         """
         # acronym_points = METADATA[METADATA["SectionID"] == slice_index][["z_index", "y_index", "x_index"]].values
         coordinates = self.get_image_indices(slice_index)
-        coordinates_scatter = pd.DataFrame(coordinates, columns=["x_index", "y", "x"])
-        
-        # Convert coordinates to integers for indexing
-        x_indices = coordinates_scatter["x"].astype(int).values
-        y_indices = coordinates_scatter["y"].astype(int).values
-        # Ensure indices are within bounds
-        valid_indices = (
-            (0 <= x_indices) & (x_indices < 1000) & (0 <= y_indices) & (y_indices < 1000)
+        array_image_atlas = aba_contours_mask_to_overlay(
+            get_aba_contours_mask(coordinates, self.image_shape)
         )
-
-        arr_z = np.full(self.image_shape, np.nan)
-        arr_z[y_indices[valid_indices], x_indices[valid_indices]] = coordinates_scatter["x_index"].values[
-            valid_indices
-        ]
-        arr_z = generic_filter(arr_z, function=majority_vote_9x9, size=(9, 9), mode='constant', cval=np.nan)
-
-        # define array_image_atlas as all values to be (255, 255, 255, 0)
-        array_image_atlas = np.ones((arr_z.shape[0], arr_z.shape[1], 4), dtype=np.uint8)
-        array_image_atlas[:, :, :3] = 255
-        array_image_atlas[:, :, 3] = 0
-
-        for i in range(arr_z.shape[0]):
-            for j in range(arr_z.shape[1]):
-                k = arr_z[i,j]
-                try:
-                    is_contour = ABA_CONTOURS[int(k), i, j] == 1
-                    if is_contour:
-                        array_image_atlas[i, j] = [255, 165, 0, 200]
-                except:
-                    continue
         
         return array_image_atlas
 
+    def extract_images(
+        self,
+        slice_index,
+        peak_names,
+        fill_holes=True,
+        slice_data=None,
+    ):
+        """Extract the images of several peaks at once: the slice data is fetched once, all the
+        peaks are scattered in a single pass, and holes are filled once for all images.
+
+        Args:
+            slice_index: Index of the slice
+            peak_names: Names of the peaks
+            fill_holes: Whether to fill holes using nearest neighbor interpolation
+            slice_data: SliceData of the slice, if already fetched by the caller. Defaults to
+                None, in which case it is retrieved from the database.
+
+        Returns:
+            3D numpy array (len(peak_names), height, width) with the peak distributions, or None
+            if the slice is not found
+        """
+        if slice_data is None:
+            slice_data = self.get_peaks_image(slice_index)
+        if slice_data is None:
+            logging.info(f"Slice {slice_index} was not found.")
+            return None
+
+        stack = rasterize_slice_data(
+            slice_data, peak_names, self.image_shape, dataset=self.path_data
+        )
+        if fill_holes and np.isnan(stack).any():
+            stack = fill_holes_nearest_neighbor(
+                stack, self.acronyms_masks[slice_index] == 'Undefined'
+            )
+        return stack
+
     def extract_lipid_image(
         self, 
         slice_index, 
-        peak_name, 
-        fill_holes=True):
+        peak_name,
+        fill_holes=True,
+        slice_data=None):
         """Extract a program image from scatter data with optional hole filling.
         
         Args:
             slice_index: Index of the slice
             program_name: Name of the program
             fill_holes: Whether to fill holes using nearest neighbor interpolation
+            slice_data: SliceData of the slice, if already fetched by the caller. Defaults to
+                None, in which case it is retrieved from the database.
             
         Returns:
             2D numpy array with the program distribution or None if not found
@@ -362,7 +395,8 @@ class PeakData:
             # peak_data = self.get_program_image(slice_index, program_name)
             # peak_data.indices --> x_index, y_index, z_index (dim: num_pixels, 3)
             # peak_data.image --> program_expression (dim: num_pixels, 1)
-            slice_data = self.get_peaks_image(slice_index)
+            if slice_data is None:
+                slice_data = self.get_peaks_image(slice_index)
             # slice_data.indices --> x_index, y_index, z_index (dim: num_pixels, 3)
             # slice_data.images --> program_expression (dim: num_pixels, num_programs)
             
@@ -378,30 +412,14 @@ class PeakData:
             # Convert scatter data to image
             # scatter_points = lipid_data.image  # This is a numpy array with shape (N, 1)
 
-            # Create a DataFrame from the scatter points
-            peak_data = slice_data.images[:, slice_data.content_names.index(peak_name)]
-            scatter = pd.DataFrame({
-                            "x": slice_data.indices[:, 2],
-                            "y": slice_data.indices[:, 1],
-                            "value": peak_data # ensure it's 1D
-                        })
-
-            # Create an empty array to hold the image
-            arr = np.full(self.image_shape, np.nan)  # Adjust dimensions if needed
-
-            # Convert coordinates to integers for indexing
-            x_indices = scatter["x"].astype(int).values # z_index
-            y_indices = scatter["y"].astype(int).values # y_index
-
-            # Ensure indices are within bounds
-            valid_indices = (
-                (0 <= x_indices) & (x_indices < 1000) & (0 <= y_indices) & (y_indices < 1000)
-            )
+            if peak_name not in slice_data.content_names:
+                logging.info(f"{peak_name} is not available in slice {slice_index}.")
+                return None
 
-            # Fill the array with values at the specified coordinates
-            arr[y_indices[valid_indices], x_indices[valid_indices]] = scatter["value"].values[
-                valid_indices
-            ]
+            # Scatter the values with the (shared) raster index of the slice
+            arr = rasterize_slice_data(
+                slice_data, [peak_name], self.image_shape, dataset=self.path_data
+            )[0]
 
             # Check if we need to fill holes
             if fill_holes:
@@ -430,54 +448,9 @@ class PeakData:
         Returns:
             2D numpy array with holes filled
         """
-        # Make a copy to avoid modifying the original
-        filled = arr.copy()
-
-        # Find indices of NaN values
-        nan_indices = np.where(np.isnan(arr))
-
-        # No NaN values, return the original array
-        if len(nan_indices[0]) == 0:
-            return filled
-
-        # Find indices of non-NaN values
-        valid_indices = np.where(~np.isnan(arr))
-        valid_values = arr[valid_indices]
-
-        # For each NaN point, find the nearest non-NaN neighbor
-        for i in range(len(nan_indices[0])):
-            x, y = nan_indices[0][i], nan_indices[1][i]
-
-            # Skip if we're at the boundary
-            if (
-                x < max_distance
-                or y < max_distance
-                or x >= arr.shape[0] - max_distance
-                or y >= arr.shape[1] - max_distance
-            ):
-                continue
-
-            # Extract a window around the NaN point
-            window = arr[
-                x - max_distance : x + max_distance + 1, y - max_distance : y + max_distance + 1
-            ]
-
-            # Skip if all values in the window are NaN
-            if np.all(np.isnan(window)):
-                continue
-
-            # Get the nearest non-NaN value
-            window_values = window.flatten()
-            non_nan_values = window_values[~np.isnan(window_values)]
-
-            if len(non_nan_values) > 0:
-                # Use the mean of nearby non-NaN values
-                filled[x, y] = np.mean(non_nan_values)
-
-        binary_mask = np.where(self.acronyms_masks[slice_index] == 'Undefined', np.nan, 1)
-        filled = filled * binary_mask
-
-        return filled
+        return fill_holes_nearest_neighbor(
+            arr[None], self.acronyms_masks[slice_index] == 'Undefined', max_distance=max_distance
+        )[0]
 
         # """
         # # Optional: For remaining NaN values, use a more aggressive approach
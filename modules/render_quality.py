@@ -0,0 +1,180 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" This class is used to adapt the quality of the images rendered server-side to the load of the
+app: under load, pages serve reduced-resolution lossy previews first, and upgrade them to full
+quality once the app is idle."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import logging
+import threading
+import time
+from uuid import uuid4
+import numpy as np
+
+# LBAE imports
+from config import (
+    dic_render_quality_thresholds,
+    render_pending_max_age_seconds,
+    render_quality_window_seconds,
+)
+
+# ==================================================================================================
+# --- Classes
+# ==================================================================================================
+
+
+class RenderLoadTracker:
+    """Context manager wrapping the renders of the long callbacks, which records the load of the
+    app in Redis: the renders waiting for (or holding) the semaphore of the process, and the
+    latency of each render. Since long callbacks run in separate processes, the load is shared
+    through Redis rather than kept in memory. Note that the semaphore only applies to the threads
+    of a given process, it does not bound the renders across long callback processes.
+
+    Each render is recorded in a sorted set, scored by its start time, and removed when it exits.
+    Long callbacks superseded by a new request are killed without exiting, so renders older than
+    render_pending_max_age_seconds are pruned instead of being counted forever.
+
+    Attributes:
+        semaphore (threading.Semaphore): The semaphore shared by the threads of the process.
+        redis_client (redis.Redis): Redis client used to share the load across processes.
+    """
+
+    PENDING_KEY = "render:pending"
+    LATENCIES_KEY = "render:latencies"
+
+    def __init__(self, semaphore, redis_client):
+        self.semaphore = semaphore
+        self.redis_client = redis_client
+        # The tracker is shared by all the threads of a process, so are the renders it records
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._local.start = time.time()
+        self._local.render_id = uuid4().hex
+        try:
+            pipeline = self.redis_client.pipeline()
+            pipeline.zadd(self.PENDING_KEY, {self._local.render_id: self._local.start})
+            # The key itself is dropped if no render starts for a while
+            pipeline.expire(self.PENDING_KEY, render_pending_max_age_seconds)
+            pipeline.execute()
+        except Exception as e:
+            logging.warning(f"Could not record the render load: {e}")
+        self.semaphore.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.semaphore.release()
+        end = time.time()
+        try:
+            pipeline = self.redis_client.pipeline()
+            pipeline.zrem(self.PENDING_KEY, self._local.render_id)
+            # Latencies are kept in a sorted set indexed by time, such that old ones can be dropped
+            pipeline.zadd(self.LATENCIES_KEY, {f"{uuid4().hex}:{end - self._local.start}": end})
+            pipeline.zremrangebyscore(
+                self.LATENCIES_KEY, "-inf", end - render_quality_window_seconds
+            )
+            pipeline.execute()
+        except Exception as e:
+            logging.warning(f"Could not record the render load: {e}")
+        return False
+
+
+class RenderQualityPolicy:
+    """Class used to decide, for each page, whether images should be rendered at full quality or as
+    previews, given the load recorded by RenderLoadTracker and the thresholds of
+    dic_render_quality_thresholds.
+
+    Attributes:
+        redis_client (redis.Redis): Redis client used to read the load shared across processes.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    def get_thresholds(self, page):
+        """Returns the thresholds of the given page, falling back on the default ones."""
+        return {**dic_render_quality_thresholds["default"], **dic_render_quality_thresholds.get(page, {})}
+
+    def get_load(self):
+        """Returns the load of the app.
+
+        Returns:
+            (int, float): The number of renders waiting or running, and the 95th percentile of the
+                render latency (in seconds) over the last render_quality_window_seconds (0 if no
+                render completed in that window).
+        """
+        try:
+            now = time.time()
+            pipeline = self.redis_client.pipeline()
+            # Renders killed without exiting are pruned by age
+            pipeline.zremrangebyscore(
+                RenderLoadTracker.PENDING_KEY, "-inf", now - render_pending_max_age_seconds
+            )
+            pipeline.zcard(RenderLoadTracker.PENDING_KEY)
+            pipeline.zrangebyscore(
+                RenderLoadTracker.LATENCIES_KEY, now - render_quality_window_seconds, "+inf"
+            )
+            _, n_pending, l_members = pipeline.execute()
+        except Exception as e:
+            logging.warning(f"Could not read the render load: {e}")
+            return 0, 0.0
+
+        l_latencies = [
+            float((member.decode() if isinstance(member, bytes) else member).split(":")[1])
+            for member in l_members
+        ]
+        p95 = float(np.percentile(l_latencies, 95)) if len(l_latencies) > 0 else 0.0
+        return int(n_pending), p95
+
+    def is_degraded(self, page, in_render=True):
+        """Returns True if the given page should serve previews, i.e. if too many renders are
+        pending, or if renders are slow while others are pending. Renders are never degraded when
+        no other render competes with them, such that previews are upgraded once the app is idle.
+
+        Args:
+            page (str): The name of the page, as in dic_render_quality_thresholds.
+            in_render (bool, optional): If True, the caller is itself a render counted as pending,
+                which is therefore not taken into account. Defaults to True.
+
+        Returns:
+            (bool): True if the load exceeds the thresholds of the page.
+        """
+        thresholds = self.get_thresholds(page)
+        n_pending, p95 = self.get_load()
+        if in_render:
+            n_pending = max(0, n_pending - 1)
+        return n_pending > thresholds["max_pending"] or (
+            n_pending > 0 and p95 > thresholds["max_p95_seconds"]
+        )
+
+    def is_idle(self):
+        """Returns True if no render is waiting or running, in which case previews can be
+        upgraded."""
+        return self.get_load()[0] == 0
+
+    def get_render_kwargs(self, page):
+        """Returns the arguments to pass to Figures.build_lipid_heatmap_from_image (and eventually
+        to convert_image_to_base64) for the current load: none at full quality, and a reduced
+        resolution lossy encoding for previews.
+
+        Args:
+            page (str): The name of the page, as in dic_render_quality_thresholds.
+
+        Returns:
+            (dict, bool): The arguments, and True if they correspond to a preview.
+        """
+        if not self.is_degraded(page):
+            return {}, False
+
+        thresholds = self.get_thresholds(page)
+        logging.info(f"High load, serving a preview for page {page}")
+        return {
+            "decrease_resolution_factor": thresholds["preview_resolution_factor"],
+            "format": "webp",
+            "quality": thresholds["preview_quality"],
+        }, True
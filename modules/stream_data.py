@@ -10,7 +10,7 @@ from typing import Dict, List, Optional, Tuple
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-from modules.maldi_data import SliceData, majority_vote_9x9
+from modules.maldi_data import SliceData, majority_vote_9x9, get_raster_index
 from modules.atlas import ABA_DIM, ABA_CONTOURS, ACRONYM_MASKS, ACRONYMS_PIXELS
 
 @dataclass
@@ -327,35 +327,15 @@ class StreamData:
             # Convert scatter data to image
             scatter_points = stream_data.image  # This is a numpy array with shape (N, 3)
 
-            # Create a DataFrame from the scatter points
-            scatter = pd.DataFrame(scatter_points, columns=["y", "x", "value"])
-            # # Create a DataFrame from the scatter points
-            # scatter = pd.DataFrame({
-            #                 "x": stream_data.indices[:, 2],
-            #                 "y": stream_data.indices[:, 1],
-            #                 "value": stream_data.image.flatten()  # ensure it's 1D
-            #             })
-
-            # Create an empty array to hold the image
-            arr = np.full(self.image_shape, np.nan)  # Adjust dimensions if needed
-
-            # Convert coordinates to integers for indexing
-            x_indices = scatter["x"].astype(int).values
-            y_indices = scatter["y"].astype(int).values
-
-            # Ensure indices are within bounds
-            valid_indices = (
-                (0 <= x_indices) & (x_indices < 1000) & (0 <= y_indices) & (y_indices < 1000)
+            # Scatter the values with the raster index of the stream pixels, not registered as each
+            # stream has its own pixels. Note that the "x" column (second one) indexes the rows of
+            # the image, and the "y" column the columns
+            raster_index = get_raster_index(
+                scatter_points[:, 1], scatter_points[:, 0], self.image_shape
             )
-
-            # Fill the array with values at the specified coordinates
-            arr[x_indices[valid_indices], y_indices[valid_indices]] = scatter["value"].values[
-                valid_indices
-            ]
-            # # Fill the array with values at the specified coordinates
-            # arr[y_indices[valid_indices], x_indices[valid_indices]] = scatter["value"].values[
-            #     valid_indices
-            # ]
+            arr = np.full(self.image_shape[0] * self.image_shape[1], np.nan)
+            arr[raster_index.flat_indices] = scatter_points[raster_index.rows, 2]
+            arr = arr.reshape(self.image_shape)
 
             # Check if we need to fill holes
             if fill_holes:
@@ -10,6 +10,10 @@ strings."""
 
 # Standard modules
 import logging
+import os
+import shutil
+from uuid import uuid4
+import time
 import numpy as np
 import base64
 from io import BytesIO
@@ -19,6 +23,22 @@ from PIL import Image
 from config import black_viridis
 from matplotlib import cm
 
+# ------------------------------------------------------------------------------------------------==
+# --- Constants
+# ------------------------------------------------------------------------------------------------==
+
+# Layout of the 256-entry palettes used by the LUT fast path: the first N_LUT_COLORS indices
+# sample the colormap, the last two are reserved for the overlay and for NaN (transparent) pixels
+N_LUT_COLORS = 254
+OVERLAY_INDEX = 254
+NAN_INDEX = 255
+
+# Palettes are computed once per colormap
+dic_lut_palettes = {}
+
+# Side (in pixels) of the tiles of the image pyramids, must match assets/tiles.js
+TILE_SIZE = 256
+
 # ------------------------------------------------------------------------------------------------==
 # --- Functions
 # ------------------------------------------------------------------------------------------------==
@@ -34,7 +54,7 @@ def black_to_transparency(img, original_array):
     
     return Image.fromarray(x)
 
-def convert_image_to_base64(
+def convert_image_to_bytes(
     image_array,
     optimize=True,
     quality=85,
@@ -46,9 +66,10 @@ def convert_image_to_base64(
     binary=False,
     transparent_zeros=False,
     colormap_type="viridis",
+    use_lut=False,
 ):
-    """This functions allows for the conversion of a numpy array into a bytestring image using PIL.
-    All images are paletted so save space.
+    """This functions allows for the conversion of a numpy array into an encoded image (raw bytes)
+    using PIL. All images are paletted so save space.
 
     Args:
         image_array (np.ndarray): The array containing the image. May be 1D of 3D or 4D. The type
@@ -73,11 +94,34 @@ def convert_image_to_base64(
             Defaults to False.
         colormap_type (str, optional): The type of colormap to use. Options are "viridis" or "PuOr".
             Defaults to "viridis".
+        use_lut (bool, optional): If True, single-channel PNG and WebP images are encoded with the
+            LUT fast path (see convert_image_to_bytes_lut()), about 4 times faster but about 2.5
+            times larger on noisy images, as the palette keeps 254 levels. Images with the "index"
+            colormap always use it. Defaults to False.
 
     Returns:
-        (str): The base 64 image encoded in a string.
+        (bytes): The encoded image.
     """
-    logging.info("Entering string conversion function")
+    logging.info("Entering bytes conversion function")
+
+    # Single-channel images can opt out of the float colormap and PIL conversions altogether
+    if (
+        (use_lut or colormap_type == "index")
+        and type is None
+        and format in ["png", "webp"]
+        and decrease_resolution_factor == 1
+        and not binary
+        and (overlay is None or get_overlay_color(overlay) is not None)
+    ):
+        return convert_image_to_bytes_lut(
+            image_array,
+            format=format,
+            overlay=overlay,
+            transparent_zeros=transparent_zeros,
+            colormap_type=colormap_type,
+            optimize=optimize,
+            quality=quality,
+        )
     
     # Select the appropriate colormap based on colormap_type
     if colormap_type == "PuOr":
@@ -113,6 +157,12 @@ def convert_image_to_base64(
         pil_img.paste(overlay_img, (0, 0), overlay_img)
         logging.info("Overlay has been added to the image")
 
+    if transparent_zeros:
+        # Takes ~5 ms but makes output much nicer. Done before decreasing the resolution, as the
+        # NaN mask has the shape of the original array.
+        pil_img = black_to_transparency(pil_img, image_array)
+        logging.info("Empty pixels are now transparent")
+
     # If we want to decrease resolution to save space
     if decrease_resolution_factor > 1:
         x, y = pil_img.size
@@ -122,14 +172,9 @@ def convert_image_to_base64(
         )
         pil_img = pil_img.resize((x2, y2), Image.ANTIALIAS)
         logging.info("Resolution has been decreased")
-    
-    if transparent_zeros:
-        # Takes ~5 ms but makes output much nicer
-        pil_img = black_to_transparency(pil_img, image_array)
-        logging.info("Empty pixels are now transparent")
 
-    # Convert to base64
-    base64_string = None
+    # Encode the image
+    image_bytes = None
     with BytesIO() as stream:
         # Handle image format
 
@@ -159,12 +204,322 @@ def convert_image_to_base64(
             logging.info("png mode selected, quality argument is not supported")
             pil_img.save(stream, format=format, optimize=optimize, bits=9)
 
-        # Encode final image
-        base64_string = (
-            "data:image/"
-            + format
-            + ";base64,"
-            + base64.b64encode(stream.getvalue()).decode("utf-8")
-        )
+        image_bytes = stream.getvalue()
+    logging.info("Image has been encoded. Returning it now.")
+    return image_bytes
+
+
+def get_lut_palette(colormap_type="viridis"):
+    """Returns the 256-entry RGB palette used to encode single-channel images with the given
+    colormap (see N_LUT_COLORS for its layout). The reserved entries are black. The "index"
+    colormap maps each index to the corresponding grey level, such that the image can be
+    colormapped in the browser (see assets/colormaps.js).
+
+    Args:
+        colormap_type (str, optional): The type of colormap to use. Options are "viridis", "PuOr"
+            or "index". Defaults to "viridis".
+
+    Returns:
+        (np.ndarray): A uint8 array of shape (256, 3).
+    """
+    if colormap_type not in dic_lut_palettes:
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        if colormap_type == "index":
+            palette[:] = np.arange(256, dtype=np.uint8)[:, None]
+        else:
+            colormap = cm.PuOr if colormap_type == "PuOr" else cm.viridis
+            palette[:N_LUT_COLORS] = np.uint8(
+                colormap(np.linspace(0, 1, N_LUT_COLORS))[:, :3] * 255
+            )
+        dic_lut_palettes[colormap_type] = palette
+    return dic_lut_palettes[colormap_type]
+
+
+def get_lut_palettes():
+    """Returns the palettes of the colormaps available in the browser, as lists, to be sent to the
+    client-side colormapping callbacks."""
+    return {
+        colormap_type: get_lut_palette(colormap_type).tolist()
+        for colormap_type in ["viridis", "PuOr"]
+    }
+
+
+def quantize_to_lut_indices(image_array):
+    """Quantizes a single-channel image with values in [0, 1] into uint8 palette indices, NaN pixels
+    being mapped to NAN_INDEX.
+
+    Args:
+        image_array (np.ndarray): The 2D array containing the image.
+
+    Returns:
+        (np.ndarray): A 2D uint8 array of palette indices.
+    """
+    image_array = np.asarray(image_array, dtype=np.float32)
+    nan_mask = np.isnan(image_array)
+    indices = np.clip(np.where(nan_mask, 0, image_array), 0, 1) * (N_LUT_COLORS - 1) + 0.5
+    indices = indices.astype(np.uint8)
+    indices[nan_mask] = NAN_INDEX
+    return indices
+
+
+def get_overlay_color(overlay):
+    """Returns the color of the contours of an overlay if they are drawn with a single RGB color (as
+    the atlas contours are), None otherwise."""
+    colors = overlay[overlay[:, :, 3] > 0][:, :3]
+    if len(colors) == 0 or not np.all(colors == colors[0]):
+        return None
+    return colors[0]
+
+
+def convert_layer_to_bytes(mask, color):
+    """Encodes a layer drawn with a single color (e.g. the atlas contours, or a brain region) as a
+    two-entry paletted PNG, transparent outside of the mask, to be displayed above a section image.
+
+    Args:
+        mask (np.ndarray): A 2D boolean array, True on the pixels of the layer.
+        color (list(int)): The RGB or RGBA color of the layer.
+
+    Returns:
+        (bytes): The encoded image.
+    """
+    pil_img = Image.fromarray(np.asarray(mask, dtype=np.uint8))
+    pil_img.putpalette([0, 0, 0] + [int(c) for c in color[:3]])
+    alpha = int(color[3]) if len(color) > 3 else 255
+    with BytesIO() as stream:
+        pil_img.save(stream, format="png", optimize=True, transparency=bytes([0, alpha]))
+        image_bytes = stream.getvalue()
+    return image_bytes
+
+
+def convert_image_to_bytes_lut(
+    image_array,
+    format="png",
+    overlay=None,
+    transparent_zeros=False,
+    colormap_type="viridis",
+    optimize=True,
+    quality=85,
+):
+    """Fast path of convert_image_to_bytes() for single-channel images: the image is quantized
+    straight to uint8 indices into a precomputed palette, and encoded in one pass as a paletted PNG
+    (or a lossless WebP, which does not support palettes).
+
+    Args:
+        image_array (np.ndarray): The 2D array containing the image, with values in [0, 1].
+        format (str, optional): The output format, either "png" or "webp". Defaults to "png".
+        overlay (np.ndarray, optional): An RGBA overlay whose contours are drawn with a single
+            color (see get_overlay_color()). Contour pixels are drawn opaque. Defaults to None.
+        transparent_zeros (bool, optional): If True, NaN pixels are transparent, else they are
+            black. Defaults to False.
+        colormap_type (str, optional): The type of colormap to use. Options are "viridis" or "PuOr".
+            Defaults to "viridis".
+        optimize (bool, optional): If True, PIL will try to optimize the image size, at the expense
+            of a longer computation time. Defaults to True.
+        quality (int, optional): Compression effort of the lossless WebP, from 0 to 100. Defaults
+            to 85.
+
+    Returns:
+        (bytes): The encoded image.
+    """
+    indices = quantize_to_lut_indices(image_array)
+    palette = get_lut_palette(colormap_type)
+
+    if overlay is not None:
+        # Index images keep the reserved index, the overlay color is then set by the client
+        if colormap_type != "index":
+            palette = palette.copy()
+            palette[OVERLAY_INDEX] = get_overlay_color(overlay)
+        indices[overlay[:, :, 3] > 0] = OVERLAY_INDEX
+
+    with BytesIO() as stream:
+        if format == "webp":
+            palette_rgba = np.hstack((palette, np.full((256, 1), 255, dtype=np.uint8)))
+            if transparent_zeros:
+                palette_rgba[NAN_INDEX, 3] = 0
+            pil_img = Image.fromarray(palette_rgba[indices], "RGBA")
+            pil_img.save(
+                stream, format="webp", lossless=True, quality=quality, method=3 if optimize else 0
+            )
+        else:
+            pil_img = Image.fromarray(indices, "P")
+            pil_img.putpalette(palette.ravel().tolist())
+            if transparent_zeros:
+                pil_img.save(stream, format="png", optimize=optimize, transparency=NAN_INDEX)
+            else:
+                pil_img.save(stream, format="png", optimize=optimize)
+        image_bytes = stream.getvalue()
+
+    logging.info("Image has been encoded with the LUT fast path. Returning it now.")
+    return image_bytes
+
+
+def convert_image_to_base64(image_array, format="png", **kwargs):
+    """This functions allows for the conversion of a numpy array into a base64 bytestring image,
+    to be embedded directly in a figure. See convert_image_to_bytes() for the arguments.
+
+    Args:
+        image_array (np.ndarray): The array containing the image.
+        format (str, optional): The output format for the bytestring image. Defaults to "png".
+        **kwargs: Other arguments passed to convert_image_to_bytes().
+
+    Returns:
+        (str): The base 64 image encoded in a string.
+    """
+    image_bytes = convert_image_to_bytes(image_array, format=format, **kwargs)
+
+    # Encode final image
+    base64_string = (
+        "data:image/" + format + ";base64," + base64.b64encode(image_bytes).decode("utf-8")
+    )
     logging.info("Image has been converted to base64. Returning it now.")
     return base64_string
+
+
+def downsample_image(image_array, factor):
+    """Downsamples an image by averaging blocks of factor x factor pixels, ignoring NaN pixels. A
+    block made only of NaN pixels remains NaN. The last row and column of blocks may be partial.
+
+    Args:
+        image_array (np.ndarray): The array containing the image, in 2D, or in 3D with the channels
+            as the last dimension.
+        factor (int): The downsampling factor.
+
+    Returns:
+        (np.ndarray): The downsampled image, as a float array.
+    """
+    if factor == 1:
+        return np.asarray(image_array, dtype=np.float32)
+
+    height, width = image_array.shape[:2]
+    new_height, new_width = -(-height // factor), -(-width // factor)
+
+    # Pad the image with NaN to a multiple of the factor, then average the blocks
+    padded = np.full(
+        (new_height * factor, new_width * factor) + image_array.shape[2:], np.nan, dtype=np.float32
+    )
+    padded[:height, :width] = image_array
+    blocks = padded.reshape((new_height, factor, new_width, factor) + image_array.shape[2:])
+    valid = ~np.isnan(blocks)
+    counts = valid.sum(axis=(1, 3))
+    sums = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan).astype(np.float32)
+
+
+def build_image_pyramid(image_array, tile_size=TILE_SIZE):
+    """Builds the pyramid of an image, from the full resolution (level 0) down to the level at
+    which the image fits in a single tile, each level halving the resolution of the previous one.
+
+    Args:
+        image_array (np.ndarray): The array containing the image, in 2D, or in 3D with the channels
+            as the last dimension.
+        tile_size (int, optional): The side of the tiles, in pixels. Defaults to TILE_SIZE.
+
+    Returns:
+        (list(np.ndarray)): The levels of the pyramid.
+    """
+    l_levels = [np.asarray(image_array, dtype=np.float32)]
+    while max(l_levels[-1].shape[:2]) > tile_size:
+        l_levels.append(downsample_image(l_levels[-1], 2))
+    return l_levels
+
+
+def save_image_pyramid(path, pyramid):
+    """Saves an image pyramid as a directory holding one .npy file per level. The levels are
+    written in a temporary directory first, which is then renamed, such that concurrent readers
+    never see a partial pyramid. If another process saved the pyramid in the meantime, its copy is
+    kept.
+
+    Args:
+        path (str): The path of the directory of the pyramid.
+        pyramid (list(np.ndarray)): The levels of the pyramid, as returned by build_image_pyramid().
+    """
+    path_temp = f"{path}.{uuid4().hex}.tmp"
+    os.makedirs(path_temp)
+    for level, image in enumerate(pyramid):
+        np.save(os.path.join(path_temp, f"level_{level}.npy"), image)
+    try:
+        os.rename(path_temp, path)
+    except OSError:
+        shutil.rmtree(path_temp, ignore_errors=True)
+
+
+def load_image_pyramid(path):
+    """Loads an image pyramid saved with save_image_pyramid(), each level being a read-only memory
+    map, such that the pyramid is shared by all the processes of the app through the page cache.
+
+    Args:
+        path (str): The path of the directory of the pyramid.
+
+    Returns:
+        (list(np.ndarray)): The levels of the pyramid, or None if it is not saved.
+    """
+    l_levels = []
+    while os.path.exists(os.path.join(path, f"level_{len(l_levels)}.npy")):
+        l_levels.append(np.load(os.path.join(path, f"level_{len(l_levels)}.npy"), mmap_mode="r"))
+    return l_levels if len(l_levels) > 0 else None
+
+
+def get_image_tile(pyramid, level, row, col, tile_size=TILE_SIZE):
+    """Returns a tile of an image pyramid. Tiles of the last row and column may be smaller than
+    tile_size.
+
+    Args:
+        pyramid (list(np.ndarray)): The image pyramid, as returned by build_image_pyramid().
+        level (int): The level of the tile, 0 being the full resolution.
+        row (int): The row of the tile in the level.
+        col (int): The column of the tile in the level.
+        tile_size (int, optional): The side of the tiles, in pixels. Defaults to TILE_SIZE.
+
+    Returns:
+        (np.ndarray): The tile, or None if it is outside of the pyramid.
+    """
+    if not 0 <= level < len(pyramid) or row < 0 or col < 0:
+        return None
+    image = pyramid[level]
+    if row * tile_size >= image.shape[0] or col * tile_size >= image.shape[1]:
+        return None
+    return image[row * tile_size : (row + 1) * tile_size, col * tile_size : (col + 1) * tile_size]
+
+
+def benchmark_image_conversion(n_repeats=10, format="png"):
+    """Micro-benchmark of the LUT fast path against the former colormap/PIL path of
+    convert_image_to_bytes(), on a single 320x456 section and on a grid mosaic of 32 sections.
+
+    Args:
+        n_repeats (int, optional): Number of conversions timed per case. Defaults to 10.
+        format (str, optional): The output format. Defaults to "png".
+
+    Returns:
+        (dict): For each case, the mean time (in ms) and the output size (in bytes) of both paths.
+    """
+    # Smooth signal with some noise and a NaN background, as lipid images
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:320, 0:456]
+    frame = 0.5 + 0.3 * np.sin(x / 40) * np.cos(y / 30) + 0.1 * rng.random((320, 456))
+    frame[(x - 228) ** 2 / 200**2 + (y - 160) ** 2 / 140**2 > 1] = np.nan
+    dic_cases = {"frame": frame, "mosaic": np.tile(frame, (4, 8))}
+
+    dic_results = {}
+    for name, image in dic_cases.items():
+        for path, use_lut in [("former", False), ("lut", True)]:
+            t0 = time.perf_counter()
+            for _ in range(n_repeats):
+                image_bytes = convert_image_to_bytes(
+                    image, format=format, transparent_zeros=True, use_lut=use_lut
+                )
+            dic_results[(name, path)] = (
+                (time.perf_counter() - t0) / n_repeats * 1000,
+                len(image_bytes),
+            )
+            logging.info(
+                f"{name}, {path} path: {dic_results[(name, path)][0]:.1f} ms,"
+                f" {dic_results[(name, path)][1]} bytes"
+            )
+    return dic_results
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    for (name, path), (duration, size) in benchmark_image_conversion().items():
+        print(f"{name:>6} | {path:>6} | {duration:8.1f} ms | {size:>9} bytes")
@@ -0,0 +1,320 @@
+# Copyright (c) 2022, Colas Droin. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+""" In this module, functions used to build, decimate and store the isosurface meshes displayed in
+the 3D views (as go.Mesh3d traces, which are much lighter than go.Volume traces carrying every
+voxel) are defined.
+"""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+
+# Standard modules
+import os
+import logging
+import argparse
+import numpy as np
+from scipy.ndimage import gaussian_filter, find_objects
+from skimage.measure import marching_cubes
+
+# Directory of the precomputed meshes, subsampling factor of the atlas annotations the meshes of
+# the atlas are built from, and levels (as fractions of the expression range) of the isosurfaces
+# of the lipid volumes, with the opacity of each
+PATH_3D_MESHES = "./data/3d_meshes"
+MESH_ATLAS_FACTOR = 2
+MESH_LIPID_LEVELS = (0.3, 0.5, 0.7, 0.9)
+MESH_LIPID_OPACITIES = (0.15, 0.25, 0.4, 0.6)
+
+# ==================================================================================================
+# --- Functions
+# ==================================================================================================
+
+
+def compute_isosurface_mesh(array, level, decimation_cell_size=None):
+    """Computes the isosurface of a 3D array with marching cubes, and optionally decimates it.
+
+    Args:
+        array (np.ndarray): The 3D array. NaN values are considered below the level.
+        level (float): The value of the isosurface.
+        decimation_cell_size (float, optional): If not None, the mesh is decimated by clustering its
+            vertices on a grid of this cell size, in voxels (see decimate_mesh()). Defaults to None.
+
+    Returns:
+        (np.ndarray, np.ndarray): The float32 vertices (in voxel coordinates, in the order of the
+            array axes) and the int32 triangular faces. Both are empty if the level is not crossed.
+    """
+    array = np.nan_to_num(np.asarray(array, dtype=np.float32), nan=np.float32(level) - 1)
+
+    # Pad the array such that the surfaces are closed on the borders of the volume
+    array = np.pad(array, 1, mode="constant", constant_values=min(np.min(array), level - 1))
+    if not (np.min(array) < level < np.max(array)):
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int32)
+
+    vertices, faces, _, _ = marching_cubes(array, level=level, allow_degenerate=False)
+    vertices = (vertices - 1).astype(np.float32)
+    faces = faces.astype(np.int32)
+    if decimation_cell_size is not None:
+        vertices, faces = decimate_mesh(vertices, faces, decimation_cell_size)
+    return vertices, faces
+
+
+def decimate_mesh(vertices, faces, cell_size):
+    """Decimates a mesh by vertex clustering: the vertices falling in the same cell of a regular
+    grid are merged into their centroid, and the faces that collapse are removed.
+
+    Args:
+        vertices (np.ndarray): The vertices of the mesh, of shape (n_vertices, 3).
+        faces (np.ndarray): The triangular faces of the mesh, of shape (n_faces, 3).
+        cell_size (float): The size of the cells of the grid, in the units of the vertices.
+
+    Returns:
+        (np.ndarray, np.ndarray): The vertices and faces of the decimated mesh.
+    """
+    if len(vertices) == 0:
+        return vertices, faces
+
+    cells = np.floor(vertices / cell_size).astype(np.int64)
+    _, cluster_indices, cluster_counts = np.unique(
+        cells, axis=0, return_inverse=True, return_counts=True
+    )
+    cluster_indices = cluster_indices.reshape(-1)
+
+    # Centroid of each cluster
+    new_vertices = np.zeros((len(cluster_counts), 3), dtype=np.float64)
+    np.add.at(new_vertices, cluster_indices, vertices)
+    new_vertices = (new_vertices / cluster_counts[:, None]).astype(np.float32)
+
+    # Remap the faces, and drop the degenerate and duplicated ones
+    new_faces = cluster_indices[faces]
+    non_degenerate = (
+        (new_faces[:, 0] != new_faces[:, 1])
+        & (new_faces[:, 1] != new_faces[:, 2])
+        & (new_faces[:, 0] != new_faces[:, 2])
+    )
+    new_faces = new_faces[non_degenerate]
+    _, unique_indices = np.unique(np.sort(new_faces, axis=1), axis=0, return_index=True)
+    new_faces = new_faces[np.sort(unique_indices)].astype(np.int32)
+    return new_vertices, new_faces
+
+
+def compute_mask_mesh(mask, smoothing_sigma=1.0, decimation_cell_size=2.0):
+    """Computes the (smoothed and decimated) mesh of the surface of a binary mask, e.g. of a brain
+    region or of a lipizone.
+
+    Args:
+        mask (np.ndarray): The 3D boolean mask.
+        smoothing_sigma (float, optional): Standard deviation of the Gaussian filter applied to the
+            mask before extracting its surface, to avoid a staircase surface. Defaults to 1.0.
+        decimation_cell_size (float, optional): See compute_isosurface_mesh(). Defaults to 2.0.
+
+    Returns:
+        (np.ndarray, np.ndarray): The vertices and faces of the mesh.
+    """
+    array = np.asarray(mask, dtype=np.float32)
+    if smoothing_sigma:
+        array = gaussian_filter(array, smoothing_sigma)
+    return compute_isosurface_mesh(array, 0.5, decimation_cell_size=decimation_cell_size)
+
+
+def compute_volume_meshes(array_volume, levels=MESH_LIPID_LEVELS, decimation_cell_size=1.0):
+    """Computes the meshes of the isosurfaces of a volume (e.g. of lipid expression) at the given
+    levels of its range of values.
+
+    Args:
+        array_volume (np.ndarray): The 3D volume, with NaN outside of the brain.
+        levels (tuple(float), optional): The levels of the isosurfaces, as fractions of the range of
+            values of the volume. Defaults to MESH_LIPID_LEVELS.
+        decimation_cell_size (float, optional): See compute_isosurface_mesh(). Defaults to 1.0.
+
+    Returns:
+        (list((np.ndarray, np.ndarray))): The vertices and faces of the mesh of each level.
+    """
+    if np.isnan(array_volume).all():
+        vmin, vmax = 0.0, 1.0
+    else:
+        vmin, vmax = float(np.nanmin(array_volume)), float(np.nanmax(array_volume))
+    return [
+        compute_isosurface_mesh(
+            array_volume, vmin + level * (vmax - vmin), decimation_cell_size=decimation_cell_size
+        )
+        for level in levels
+    ]
+
+
+def compute_label_meshes(array_labels, **kwargs):
+    """Computes the mesh of every label of a label volume (e.g. of the lipizones). The volume is
+    scanned once to get the bounding box of each label, such that each mesh is computed on the
+    corresponding sub-volume only.
+
+    Args:
+        array_labels (np.ndarray): The 3D array of (non-negative integer) labels, 0 being the
+            background.
+        **kwargs: Arguments of compute_mask_mesh().
+
+    Yields:
+        (int, np.ndarray, np.ndarray): Each label, and the vertices and faces of its mesh, in the
+            coordinates of the full volume.
+    """
+    array_labels = np.asarray(array_labels)
+    for index, bbox in enumerate(find_objects(array_labels.astype(np.int64))):
+        if bbox is None:
+            continue
+        # Margin such that the smoothed surface is not cropped
+        bbox = tuple(
+            slice(max(0, s.start - 3), min(n, s.stop + 3))
+            for s, n in zip(bbox, array_labels.shape)
+        )
+        vertices, faces = compute_mask_mesh(array_labels[bbox] == index + 1, **kwargs)
+        vertices += np.array([s.start for s in bbox], dtype=np.float32)
+        yield index + 1, vertices, faces
+
+
+def get_mesh_path(kind, name, mesh_dir=PATH_3D_MESHES):
+    """Returns the path of a precomputed mesh.
+
+    Args:
+        kind (str): The kind of mesh: "atlas", "lipids" or "lipizones".
+        name (str): The name of the mesh, e.g. the name of the region, or see
+            get_lipid_mesh_name().
+        mesh_dir (str, optional): The directory of the meshes. Defaults to PATH_3D_MESHES.
+
+    Returns:
+        (str): The path of the mesh.
+    """
+    return os.path.join(mesh_dir, kind, f"{name}.npz")
+
+
+def get_lipid_mesh_name(lipid_name, factor, level):
+    """Returns the name of the mesh of the isosurface of a lipid volume at a level of
+    MESH_LIPID_LEVELS, for the volume subsampled by factor."""
+    return f"{lipid_name}_x{factor}_{int(round(level * 100))}"
+
+
+def save_mesh(path, vertices, faces):
+    """Stores a mesh compactly: the vertices are quantized to uint16 over their bounding box, and
+    the faces are stored as uint16 when possible. The file is written through a temporary file,
+    such that concurrent readers never see a partially written mesh.
+
+    Args:
+        path (str): The path of the mesh file (.npz).
+        vertices (np.ndarray): The vertices of the mesh, of shape (n_vertices, 3).
+        faces (np.ndarray): The triangular faces of the mesh, of shape (n_faces, 3).
+    """
+    vertices = np.asarray(vertices, dtype=np.float32)
+    if len(vertices) > 0:
+        origin = vertices.min(axis=0)
+        scale = np.maximum(vertices.max(axis=0) - origin, 1e-6) / 65535
+    else:
+        origin, scale = np.zeros(3, dtype=np.float32), np.ones(3, dtype=np.float32)
+    vertices_quantized = np.round((vertices - origin) / scale).astype(np.uint16)
+    faces = np.asarray(faces).astype(np.uint16 if len(vertices) <= 65536 else np.uint32)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    path_temp = f"{path}.{os.getpid()}.tmp"
+    with open(path_temp, "wb") as f:
+        np.savez_compressed(
+            f, vertices=vertices_quantized, origin=origin, scale=scale, faces=faces
+        )
+    os.replace(path_temp, path)
+
+
+def load_mesh(path):
+    """Loads a mesh stored with save_mesh().
+
+    Args:
+        path (str): The path of the mesh file (.npz).
+
+    Returns:
+        (np.ndarray, np.ndarray): The float32 vertices and the faces of the mesh.
+    """
+    with np.load(path) as mesh:
+        vertices = mesh["vertices"] * mesh["scale"] + mesh["origin"]
+        return vertices.astype(np.float32), mesh["faces"]
+
+
+def load_or_compute_mesh(path, compute_mesh):
+    """Returns the mesh stored at path, computing it with compute_mesh() and storing it first if
+    needed, such that each mesh is only built once for all the processes of the app.
+
+    Args:
+        path (str): The path of the mesh file (.npz).
+        compute_mesh (function): Function returning the vertices and faces of the mesh.
+
+    Returns:
+        (np.ndarray, np.ndarray): The float32 vertices and the faces of the mesh.
+    """
+    if not os.path.exists(path):
+        logging.info(f"Computing mesh {path}")
+        save_mesh(path, *compute_mesh())
+    return load_mesh(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline computation of the meshes of the 3D views.")
+    parser.add_argument("--output-dir", default=PATH_3D_MESHES)
+    parser.add_argument("--force", action="store_true", help="Rebuild the existing meshes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("root", help="Build the mesh of the whole brain from the atlas.")
+
+    parser_lipids = subparsers.add_parser(
+        "lipids", help="Build the isosurface meshes of the interpolated 3D lipid volumes."
+    )
+    parser_lipids.add_argument("--input-dir", default="./data/3d_interpolated_native")
+    parser_lipids.add_argument("--pyramid-dir", default="./data/3d_interpolated_native/pyramids")
+    parser_lipids.add_argument("--factor", type=int, default=2)
+
+    parser_lipizones = subparsers.add_parser(
+        "lipizones", help="Build the meshes of the lipizones from their label volume."
+    )
+    parser_lipizones.add_argument(
+        "--zarr-path", default="./data/lipizone_data/3d_lipizones_all.zarr"
+    )
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+
+    def build(kind, name, compute_mesh):
+        path = get_mesh_path(kind, name, mesh_dir=args.output_dir)
+        if args.force or not os.path.exists(path):
+            logging.info(f"Building mesh {path}")
+            save_mesh(path, *compute_mesh())
+
+    if args.command == "root":
+        from bg_atlasapi import BrainGlobeAtlas
+
+        bg_atlas = BrainGlobeAtlas(
+            "allen_mouse_25um", brainglobe_dir="data/atlas/", check_latest=False
+        )
+        f = MESH_ATLAS_FACTOR
+        build("atlas", "root", lambda: compute_mask_mesh(bg_atlas.annotation[::f, ::f, ::f] > 0))
+
+    elif args.command == "lipids":
+        from modules.tools.volume import load_volume_level
+
+        suffix = "interpolation_log.npy"
+        for filename in sorted(os.listdir(args.input_dir)):
+            if not filename.endswith(suffix):
+                continue
+            lipid_name = filename[: -len(suffix)]
+            names = [get_lipid_mesh_name(lipid_name, args.factor, level) for level in MESH_LIPID_LEVELS]
+            if not args.force and all(
+                os.path.exists(get_mesh_path("lipids", name, mesh_dir=args.output_dir))
+                for name in names
+            ):
+                continue
+            array_volume = load_volume_level(
+                os.path.join(args.input_dir, filename), args.pyramid_dir, lipid_name, args.factor
+            )
+            for name, mesh in zip(names, compute_volume_meshes(array_volume)):
+                save_mesh(get_mesh_path("lipids", name, mesh_dir=args.output_dir), *mesh)
+
+    elif args.command == "lipizones":
+        import zarr
+
+        array_labels = zarr.open(args.zarr_path, mode="r")["all_lipizones"][:]
+        for index, vertices, faces in compute_label_meshes(array_labels):
+            path = get_mesh_path("lipizones", str(index), mesh_dir=args.output_dir)
+            if args.force or not os.path.exists(path):
+                save_mesh(path, vertices, faces)
@@ -10,8 +10,19 @@ are defined.
 # ==================================================================================================
 
 # Standard modules
+import os
+import logging
+import argparse
 import numpy as np
-from numba import njit
+from scipy.ndimage import find_objects
+from numba import njit, prange
+
+# Downsampling factors of the precomputed pyramids of the 3D lipid volumes (see
+# build_volume_pyramid()). The volumes are stored quantized to uint8, the last value being reserved
+# for NaN voxels.
+VOLUME_PYRAMID_FACTORS = (2, 4, 8)
+N_VOLUME_LEVELS = 255
+VOLUME_NAN_VALUE = 255
 
 # ==================================================================================================
 # --- Functions
@@ -236,7 +247,85 @@ def fill_array_slices(
     return array_slices
 
 
-@njit
+def get_interpolation_kernel(size_radius):
+    """Returns the offsets of the voxels of the sphere of radius size_radius, in lexicographic
+    order, and their interpolation weights (exp(-d), d being their distance to the center).
+
+    Args:
+        size_radius (int): The radius of the sphere, in voxels.
+
+    Returns:
+        (np.ndarray, np.ndarray): The (n_offsets, 3) integer offsets and the n_offsets weights.
+    """
+    d = np.arange(-size_radius, size_radius + 1)
+    dx, dy, dz = np.meshgrid(d, d, d, indexing="ij")
+    distances = np.sqrt(dx**2 + dy**2 + dz**2)
+    inside = distances <= size_radius
+    offsets = np.stack((dx[inside], dy[inside], dz[inside]), axis=1).astype(np.int64)
+    return offsets, np.exp(-distances[inside])
+
+
+@njit(parallel=True)
+def interpolate_voxels(
+    array_annotation,
+    array_slices,
+    offsets,
+    weights,
+    annot_inside,
+    limit_value_inside,
+    use_limit_value_inside,
+    structure_guided,
+    x_start,
+):
+    """This function computes the distance-weighted average of the assigned voxels around each
+    voxel to fill, over the kernel returned by get_interpolation_kernel(). The planes of the first
+    axis are processed in parallel. See fill_array_interpolation() for the arguments.
+
+    Returns:
+        (np.ndarray): A three-dimensional array containing the interpolated lipid intensity values.
+    """
+    array_interpolated = np.copy(array_slices)
+    shape_x, shape_y, shape_z = array_annotation.shape
+    for x in prange(x_start, shape_x):
+        for y in range(shape_y):
+            for z in range(shape_z):
+                # If we are in a unfilled region of the brain or just inside the brain (same
+                # conditions as in the original sequential implementation)
+                if array_slices[x, y, z] >= 0:
+                    condition_fulfilled = True
+                elif use_limit_value_inside:
+                    condition_fulfilled = array_annotation[x, y, z] > limit_value_inside
+                else:
+                    condition_fulfilled = np.abs(array_slices[x, y, z] - annot_inside) < 10**-4
+                if not condition_fulfilled:
+                    continue
+
+                # Distance-weighted average of the datapoints in the sphere (and in the same
+                # structure)
+                value_voxel = 0.0
+                sum_weights = 0.0
+                for i in range(offsets.shape[0]):
+                    xt = x + offsets[i, 0]
+                    yt = y + offsets[i, 1]
+                    zt = z + offsets[i, 2]
+                    if xt < 0 or xt >= shape_x or yt < 0 or yt >= shape_y or zt < 0 or zt >= shape_z:
+                        continue
+                    if array_slices[xt, yt, zt] < 0:
+                        continue
+                    if (
+                        structure_guided
+                        and np.abs(array_annotation[x, y, z] - array_annotation[xt, yt, zt])
+                        >= 10**-4
+                    ):
+                        continue
+                    value_voxel += weights[i] * array_slices[xt, yt, zt]
+                    sum_weights += weights[i]
+                if sum_weights > 0:
+                    array_interpolated[x, y, z] = value_voxel / sum_weights
+
+    return array_interpolated
+
+
 def fill_array_interpolation(
     array_annotation,
     array_slices,
@@ -246,7 +335,8 @@ def fill_array_interpolation(
     structure_guided=True,
 ):
     """This function is used to fill the empty space (unassigned voxels) between the slices with
-    interpolated values.
+    interpolated values. The offsets and weights of the interpolation sphere are computed once,
+    and the voxels are filled in parallel (see interpolate_voxels()).
 
     Args:
         array_annotation (np.ndarray): Three-dimensional array of annotation coming from the Allen
@@ -265,70 +355,21 @@ def fill_array_interpolation(
     Returns:
         (np.ndarray): A three-dimensional array containing the interpolated lipid intensity values.
     """
-    array_interpolated = np.copy(array_slices)
+    offsets, weights = get_interpolation_kernel(int(array_annotation.shape[0] / divider_radius))
 
     # Start from 8 as we don't have data before and the structure disposition makes it look
     # like a bug with the interpolation
-    for x in range(8, array_annotation.shape[0]):
-        for y in range(0, array_annotation.shape[1]):
-            for z in range(0, array_annotation.shape[2]):
-                # If we are in a unfilled region of the brain or just inside the brain
-                condition_fulfilled = False
-                if array_slices[x, y, z] >= 0:
-                    condition_fulfilled = True
-                elif limit_value_inside is not None and not condition_fulfilled:
-                    if array_annotation[x, y, z] > limit_value_inside:
-                        condition_fulfilled = True
-                elif (
-                    np.abs(array_slices[x, y, z] - annot_inside) < 10**-4
-                ) and not condition_fulfilled:
-                    condition_fulfilled = True
-                if condition_fulfilled:
-                    # Check all datapoints in the same structure, and do a distance-weighted average
-                    value_voxel = 0
-                    sum_weights = 0
-                    size_radius = int(array_annotation.shape[0] / divider_radius)
-                    for xt in range(
-                        max(0, x - size_radius), min(array_annotation.shape[0], x + size_radius + 1)
-                    ):
-                        for yt in range(
-                            max(0, y - size_radius),
-                            min(array_annotation.shape[1], y + size_radius + 1),
-                        ):
-                            for zt in range(
-                                max(0, z - size_radius),
-                                min(array_annotation.shape[2], z + size_radius + 1),
-                            ):
-                                # If we are inside of the shere of radius size_radius
-                                if (
-                                    np.sqrt((x - xt) ** 2 + (y - yt) ** 2 + (z - zt) ** 2)
-                                    <= size_radius
-                                ):
-                                    # The voxel has data
-                                    if array_slices[xt, yt, zt] >= 0:
-                                        # The structure is identical
-                                        if (
-                                            structure_guided
-                                            and np.abs(
-                                                array_annotation[x, y, z]
-                                                - array_annotation[xt, yt, zt]
-                                            )
-                                            < 10**-4
-                                        ) or not structure_guided:
-                                            d = np.sqrt(
-                                                (x - xt) ** 2 + (y - yt) ** 2 + (z - zt) ** 2
-                                            )
-                                            value_voxel += np.exp(-d) * array_slices[xt, yt, zt]
-                                            sum_weights += np.exp(-d)
-                    if sum_weights == 0:
-                        pass
-                        # print("No other voxel found for structure ", array_annotation[x, y, z])
-                    else:
-                        # print('Voxel found for structure', array_annotation[x, y, z])
-                        value_voxel = value_voxel / sum_weights
-                        array_interpolated[x, y, z] = value_voxel
-
-    return array_interpolated
+    return interpolate_voxels(
+        array_annotation,
+        array_slices,
+        offsets,
+        weights,
+        annot_inside,
+        limit_value_inside if limit_value_inside is not None else 0.0,
+        limit_value_inside is not None,
+        structure_guided,
+        8,
+    )
 
 
 @njit
@@ -415,3 +456,321 @@ def crop_array(array_annotation, list_id_regions):
         return None
     else:
         return x_min, x_max, y_min, y_max, z_min, z_max
+
+
+def get_volume_pyramid_path(pyramid_dir, volume_name, factor=None):
+    """Returns the path of one level of the pyramid of a 3D volume, or the path of the quantization
+    bounds of the pyramid if factor is None."""
+    suffix = "bounds" if factor is None else f"x{factor}"
+    return os.path.join(pyramid_dir, f"{volume_name}_{suffix}.npy")
+
+
+def save_array_atomically(path, array):
+    """Saves an array as .npy through a temporary file, such that concurrent readers never see a
+    partially written file."""
+    path_temp = f"{path}.{os.getpid()}.tmp"
+    with open(path_temp, "wb") as f:
+        np.save(f, array)
+    os.replace(path_temp, path)
+
+
+def get_volume_bounds(array_volume):
+    """Returns the extrema of a volume, ignoring NaN voxels, or (0, 1) if the volume is empty."""
+    if np.isnan(array_volume).all():
+        return 0.0, 1.0
+    return float(np.nanmin(array_volume)), float(np.nanmax(array_volume))
+
+
+def load_or_compute_array(path, compute_array):
+    """Returns the array stored at path through a read-only memory map, computing it with
+    compute_array() and storing it first if needed. Since the memory map is backed by the page
+    cache, the array is computed once and shared by all the processes of the app."""
+    if not os.path.exists(path):
+        logging.info(f"Computing {path}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_array_atomically(path, compute_array())
+    return np.load(path, mmap_mode="r")
+
+
+def sample_voxels_stratified(mask, max_points, seed=0):
+    """Samples at most max_points voxels of a mask, spread evenly over space: the volume is divided
+    into cubic cells, as small as possible while having at most max_points non-empty cells, and one
+    random voxel of the mask is kept per cell. The sample is deterministic for a given seed.
+
+    Args:
+        mask (np.ndarray): The 3D boolean mask of the voxels to sample.
+        max_points (int): The maximum number of voxels to sample.
+        seed (int, optional): Seed of the random choice of the voxel of each cell. Defaults to 0.
+
+    Returns:
+        (np.ndarray): The coordinates of the sampled voxels, of shape (n_points, 3).
+    """
+    coordinates = np.argwhere(mask)
+    if len(coordinates) <= max_points:
+        return coordinates
+
+    # Visit the voxels in a random order, such that the first voxel of each cell is a random one
+    coordinates = coordinates[np.random.default_rng(seed).permutation(len(coordinates))]
+    cell_size = max(1, int(np.floor((len(coordinates) / max_points) ** (1 / 3))))
+    while True:
+        cells = coordinates // cell_size
+        n_cells = cells.max(axis=0) + 1
+        cell_ids = (cells[:, 0] * n_cells[1] + cells[:, 1]) * n_cells[2] + cells[:, 2]
+        _, indices = np.unique(cell_ids, return_index=True)
+        if len(indices) <= max_points:
+            return coordinates[np.sort(indices)]
+        cell_size += 1
+
+
+def compute_label_index(array_labels):
+    """Computes an index of the voxels of each label of a label volume, such that the voxels of a
+    few labels can be retrieved without scanning the whole volume: the bounding box of each label,
+    and its voxels as runs of consecutive voxels along the last axis.
+
+    Args:
+        array_labels (np.ndarray): The 3D array of (non-negative integer) labels, 0 being the
+            background.
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): The bounding boxes, of shape (n_labels, 6), as
+            (z_start, z_stop, y_start, y_stop, x_start, x_stop) per label (the row of the
+            background label 0 holding the shape of the volume, and missing labels having empty
+            boxes); the offsets of the runs of each label, of shape (n_labels + 1,); and the runs,
+            sorted by label, as a structured array with fields "start" (linear index of the first
+            voxel) and "length".
+    """
+    array_labels = np.asarray(array_labels)
+    n_z, n_y, n_x = array_labels.shape
+
+    # Runs of identical labels along the last axis
+    rows = array_labels.reshape(-1, n_x)
+    is_start = np.ones(rows.shape, dtype=bool)
+    is_start[:, 1:] = rows[:, 1:] != rows[:, :-1]
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.append(starts, rows.size))
+    labels = rows.reshape(-1)[starts]
+    keep = labels > 0
+    starts, lengths, labels = starts[keep], lengths[keep], labels[keep].astype(np.int64)
+
+    # Group the runs by label
+    n_labels = int(labels.max()) + 1 if len(labels) > 0 else 1
+    order = np.argsort(labels, kind="stable")
+    offsets = np.searchsorted(labels[order], np.arange(n_labels + 1)).astype(np.int64)
+    runs = np.zeros(len(order), dtype=[("start", np.uint32), ("length", np.uint16)])
+    runs["start"] = starts[order]
+    runs["length"] = lengths[order]
+
+    bboxes = np.zeros((n_labels, 6), dtype=np.int32)
+    bboxes[0] = (0, n_z, 0, n_y, 0, n_x)
+    for label, bbox in enumerate(find_objects(array_labels.astype(np.int32)), start=1):
+        if bbox is not None:
+            bboxes[label] = [bound for s in bbox for bound in (s.start, s.stop)]
+    return bboxes, offsets, runs
+
+
+def get_label_mask(bboxes, offsets, runs, label):
+    """Returns the mask of a label within its bounding box, from the index computed by
+    compute_label_index().
+
+    Args:
+        bboxes (np.ndarray): The bounding boxes of the labels.
+        offsets (np.ndarray): The offsets of the runs of each label.
+        runs (np.ndarray): The runs of the labels.
+        label (int): The label.
+
+    Returns:
+        (np.ndarray, tuple(int)): The 3D boolean mask of the label in its bounding box, and the
+            coordinates of the corner of the bounding box in the volume. The mask is empty if the
+            label is absent from the volume.
+    """
+    if not 0 < label < len(bboxes):
+        return np.zeros((0, 0, 0), dtype=bool), (0, 0, 0)
+    z_start, z_stop, y_start, y_stop, x_start, x_stop = (int(bound) for bound in bboxes[label])
+    mask = np.zeros((z_stop - z_start, y_stop - y_start, x_stop - x_start), dtype=bool)
+
+    # Expand the runs into the linear indices of their voxels
+    label_runs = runs[offsets[label] : offsets[label + 1]]
+    starts = label_runs["start"].astype(np.int64)
+    lengths = label_runs["length"].astype(np.int64)
+    first_voxels = np.cumsum(lengths) - lengths
+    voxels = np.repeat(starts - first_voxels, lengths) + np.arange(lengths.sum())
+
+    z, y, x = np.unravel_index(voxels, tuple(int(n) for n in bboxes[0, 1::2]))
+    mask[z - z_start, y - y_start, x - x_start] = True
+    return mask, (z_start, y_start, x_start)
+
+
+def quantize_volume(array_volume, bounds=None):
+    """Quantizes a float volume to uint8, NaN voxels being mapped to VOLUME_NAN_VALUE.
+
+    Args:
+        array_volume (np.ndarray): The 3D volume to quantize.
+        bounds (tuple(float), optional): The values mapped to the first and last quantization
+            levels. Defaults to None, in which case the extrema of the volume are used.
+
+    Returns:
+        (np.ndarray, tuple(float)): The quantized volume, and the quantization bounds.
+    """
+    if bounds is None:
+        bounds = get_volume_bounds(array_volume)
+    vmin, vmax = bounds
+    scale = (N_VOLUME_LEVELS - 1) / (vmax - vmin) if vmax > vmin else 0.0
+
+    nan_mask = np.isnan(array_volume)
+    array_quantized = np.clip(
+        (np.where(nan_mask, vmin, array_volume) - vmin) * scale + 0.5, 0, N_VOLUME_LEVELS - 1
+    )
+    array_quantized = array_quantized.astype(np.uint8)
+    array_quantized[nan_mask] = VOLUME_NAN_VALUE
+    return array_quantized, bounds
+
+
+def dequantize_volume(array_quantized, bounds):
+    """Inverse of quantize_volume(), returning a float32 volume with NaN voxels."""
+    vmin, vmax = bounds
+    lut = np.linspace(vmin, vmax, N_VOLUME_LEVELS, dtype=np.float32)
+    lut = np.append(lut, np.float32(np.nan))
+    return lut[array_quantized]
+
+
+def build_volume_pyramid(volume_path, pyramid_dir, volume_name, factors=VOLUME_PYRAMID_FACTORS):
+    """Precomputes the pyramid of a 3D volume: for each factor, the volume subsampled with the same
+    stride as the annotation arrays it is displayed with, quantized with bounds shared by all the
+    levels. Each level is stored as a .npy file, such that only the requested one is read (through
+    a memory map) at display time. The bounds are written last, and mark the pyramid as complete.
+
+    Args:
+        volume_path (str): Path of the full-resolution volume (.npy).
+        pyramid_dir (str): Directory in which the pyramid is stored.
+        volume_name (str): Name of the volume, used to name the files of the pyramid.
+        factors (tuple(int), optional): The downsampling factors of the levels. Defaults to
+            VOLUME_PYRAMID_FACTORS.
+    """
+    logging.info(f"Building the pyramid of volume {volume_name}")
+    os.makedirs(pyramid_dir, exist_ok=True)
+    array_volume = np.load(volume_path, mmap_mode="r")
+    # Bounds are computed on the full volume, such that all levels share them
+    bounds = get_volume_bounds(array_volume)
+    for factor in factors:
+        array_level = np.asarray(array_volume[::factor, ::factor, ::factor], dtype=np.float32)
+        array_quantized, _ = quantize_volume(array_level, bounds)
+        save_array_atomically(
+            get_volume_pyramid_path(pyramid_dir, volume_name, factor), array_quantized
+        )
+    save_array_atomically(get_volume_pyramid_path(pyramid_dir, volume_name), np.array(bounds))
+
+
+def load_volume_level(volume_path, pyramid_dir, volume_name, factor):
+    """Returns a 3D volume subsampled by factor, reading only the corresponding level of its
+    pyramid (which is built on first use if needed). Factors without a precomputed level are
+    subsampled from the full-resolution volume.
+
+    Args:
+        volume_path (str): Path of the full-resolution volume (.npy).
+        pyramid_dir (str): Directory in which the pyramid is stored.
+        volume_name (str): Name of the volume, used to name the files of the pyramid.
+        factor (int): The downsampling factor.
+
+    Returns:
+        (np.ndarray): The subsampled volume, as float32 with NaN voxels.
+    """
+    if factor not in VOLUME_PYRAMID_FACTORS:
+        array_volume = np.load(volume_path, mmap_mode="r")
+        return np.asarray(array_volume[::factor, ::factor, ::factor], dtype=np.float32)
+
+    path_bounds = get_volume_pyramid_path(pyramid_dir, volume_name)
+    if not os.path.exists(path_bounds):
+        build_volume_pyramid(volume_path, pyramid_dir, volume_name)
+    bounds = tuple(np.load(path_bounds))
+    array_quantized = np.load(
+        get_volume_pyramid_path(pyramid_dir, volume_name, factor), mmap_mode="r"
+    )
+    return dequantize_volume(array_quantized, bounds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precomputations of the 3D volumes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_pyramids = subparsers.add_parser(
+        "pyramids", help="Build the pyramids of the interpolated 3D lipid volumes."
+    )
+    parser_pyramids.add_argument("--input-dir", default="./data/3d_interpolated_native")
+    parser_pyramids.add_argument("--output-dir", default="./data/3d_interpolated_native/pyramids")
+    parser_pyramids.add_argument(
+        "--force", action="store_true", help="Rebuild the pyramids that already exist."
+    )
+
+    parser_interpolate = subparsers.add_parser(
+        "interpolate",
+        help="Interpolate the 3D lipid volumes between the slices.",
+        description="Interpolate the 3D lipid volumes between the slices (see"
+        " fill_array_interpolation()), using all the cores. Volumes already computed are skipped,"
+        " such that an interrupted run can be resumed. The volumes are written in the scale of"
+        " their input, as {lipid}interpolation.npy, with NaN outside of the brain. They are not the"
+        " {lipid}interpolation_log.npy volumes displayed by the app, which are never overwritten.",
+    )
+    parser_interpolate.add_argument(
+        "--input-dir",
+        required=True,
+        help="Directory of the volumes filled with the slices, named {lipid}slices.npy. Each one is"
+        " an array returned by fill_array_borders() (negative outside of the brain and in the"
+        " voxels to interpolate), filled with the expression in the slices by fill_array_slices(),"
+        " and saved with np.save().",
+    )
+    parser_interpolate.add_argument(
+        "--annotation", required=True, help="Path of the array of annotation (.npy)."
+    )
+    parser_interpolate.add_argument("--output-dir", default="./data/3d_interpolated_cli")
+    parser_interpolate.add_argument("--divider-radius", type=int, default=5)
+    parser_interpolate.add_argument(
+        "--threads", type=int, default=None, help="Number of threads. Defaults to all the cores."
+    )
+    parser_interpolate.add_argument(
+        "--force", action="store_true", help="Recompute the volumes that already exist."
+    )
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+    if args.command == "interpolate":
+        from numba import set_num_threads
+        from tqdm import tqdm
+
+        if args.threads is not None:
+            set_num_threads(args.threads)
+        array_annotation = np.load(args.annotation)
+        suffix = "slices.npy"
+        l_lipid_names = sorted(
+            filename[: -len(suffix)]
+            for filename in os.listdir(args.input_dir)
+            if filename.endswith(suffix)
+        )
+        os.makedirs(args.output_dir, exist_ok=True)
+        for lipid_name in tqdm(l_lipid_names, desc="Interpolating volumes"):
+            path_output = os.path.join(args.output_dir, f"{lipid_name}interpolation.npy")
+            if not args.force and os.path.exists(path_output):
+                continue
+            array_interpolated = fill_array_interpolation(
+                array_annotation,
+                np.load(os.path.join(args.input_dir, lipid_name + suffix)),
+                divider_radius=args.divider_radius,
+            ).astype(np.float32)
+
+            # Voxels still negative are outside of the brain (see fill_array_borders()), or could
+            # not be interpolated
+            array_interpolated[array_interpolated < 0] = np.nan
+            save_array_atomically(path_output, array_interpolated)
+
+    elif args.command == "pyramids":
+        suffix = "interpolation_log.npy"
+        for filename in sorted(os.listdir(args.input_dir)):
+            if not filename.endswith(suffix):
+                continue
+            volume_name = filename[: -len(suffix)]
+            if not args.force and os.path.exists(
+                get_volume_pyramid_path(args.output_dir, volume_name)
+            ):
+                continue
+            build_volume_pyramid(
+                os.path.join(args.input_dir, filename), args.output_dir, volume_name
+            )
@@ -15,7 +15,7 @@ import logging
 import dash
 import json
 import pandas as pd
-from dash.dependencies import Input, Output, State, ALL
+from dash.dependencies import Input, Output, State, ALL, ClientsideFunction
 import dash_mantine_components as dmc
 import numpy as np
 # threadpoolctl import threadpool_limits, threadpool_info
@@ -24,7 +24,8 @@ import numpy as np
 # os.environ['OMP_NUM_THREADS'] = '1'
 
 # LBAE imports
-from app import app, figures, data, cache_flask, atlas, grid_data
+from app import app, figures, data, atlas, grid_data
+from modules.tools.image import get_lut_palettes
 
 # ==================================================================================================
 # --- Layout
@@ -50,6 +51,12 @@ def return_layout(basic_config, slice_index):
                 dcc.Store(id="lipid-tutorial-step", data=0),
                 dcc.Store(id="lipid-tutorial-completed", storage_type="local", data=False),
 
+                # Figure computed server-side, and colormap applied client-side to single-channel
+                # images (see assets/colormaps.js)
+                dcc.Store(id="page-2-figure-store"),
+                dcc.Store(id="page-2-colormap", data="viridis"),
+                dcc.Store(id="page-2-lut-palettes", data=get_lut_palettes()),
+
                 # Add tutorial button under welcome text
                 html.Div(
                     id="lipid-start-tutorial-target",
@@ -121,7 +128,6 @@ def return_layout(basic_config, slice_index):
                             figure=figures.compute_heatmap_per_lipid(
                                 slice_index,
                                 "HexCer 42:2;O2",
-                                cache_flask=cache_flask,
                             ),
                         ),
                         # Allen Brain Atlas switch (independent)
@@ -982,7 +988,7 @@ from dash import no_update
 from app import long_callback_limiter
 
 @app.long_callback(
-    Output("page-2-graph-heatmap-mz-selection", "figure"),
+    Output("page-2-figure-store", "data"),
     Output("page-2-badge-input", "children"),
     inputs=[
         Input("main-slider", "data"),
@@ -992,7 +998,6 @@ from app import long_callback_limiter
         Input("page-2-rgb-switch", "checked"),
         Input("page-2-sections-mode", "value"),
         Input("main-brain", "value"),
-        Input("page-2-toggle-annotations", "checked"),
     ],
     prevent_initial_call=True,
 )
@@ -1004,11 +1009,9 @@ def page_2_plot_graph_heatmap_mz_selection_long(
     rgb_mode,
     sections_mode,
     brain_id,
-    annotations_checked,
 ):
     with long_callback_limiter:
         """Compute the figure based on current state (no callback_context)."""
-        overlay = data.get_aba_contours(slice_index) if annotations_checked else None
 
         # Helper: index -> "Name Structure"
         def idx_to_name(idx):
@@ -1029,33 +1032,47 @@ def page_2_plot_graph_heatmap_mz_selection_long(
         # All-sections mode: show only first lipid
         if sections_mode == "all":
             first = active[0] if active else "HexCer 42:2;O2"
-            image = grid_data.retrieve_grid_image(lipid=first, sample=brain_id)
-            fig = figures.build_lipid_heatmap_from_image(
-                image, return_base64_string=False, overlay=overlay
+            # The mosaic is served as tiles, only the visible ones being loaded by the browser. Its
+            # image is only retrieved if the pyramid of its tiles is not stored yet
+            fig = figures.build_tiled_heatmap(
+                lambda: grid_data.retrieve_grid_image(lipid=first, sample=brain_id),
+                "grid",
+                "page-2-graph-heatmap-mz-selection",
+                lipid=first,
+                sample=brain_id,
             )
             return fig, "Now displaying:"
 
-        # Single-section mode
+        # Single-section mode: the image is served (and cached by the browser) through its URL,
+        # and the annotations are a separate layer toggled client-side
+        overlay_color = "orange"
         if rgb_mode and len(active) > 1:
-            fig = figures.compute_rgb_image_per_lipid_selection(
-                slice_index,
-                ll_lipid_names=[n1, n2, n3],
-                cache_flask=cache_flask,
-                overlay=overlay,
+            fig = figures.build_lipid_heatmap_client_rgb(
+                slice_index, [n1, n2, n3], overlay_color=overlay_color
             )
             return fig, "Now displaying:"
 
         # Fallback: single-lipid colormap
         first = active[0] if active else "HexCer 42:2;O2"
-        image = figures.compute_image_per_lipid(
-            slice_index, RGB_format=False, lipid_name=first, cache_flask=cache_flask
-        )
-        fig = figures.build_lipid_heatmap_from_image(
-            image, return_base64_string=False, overlay=overlay
+        fig = figures.build_lipid_heatmap_client_colormap(
+            slice_index, first, overlay_color=overlay_color
         )
         return fig, "Now displaying:"
 
 
+# Apply the colormap of single-channel images, or composite the channels of RGB images,
+# client-side (see assets/colormaps.js), and stack the annotations above them (see
+# assets/layers.js). Tiled mosaics are updated when zooming (see assets/tiles.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="lut", function_name="apply_colormap"),
+    Output("page-2-graph-heatmap-mz-selection", "figure"),
+    Input("page-2-figure-store", "data"),
+    Input("page-2-colormap", "data"),
+    Input("page-2-graph-heatmap-mz-selection", "relayoutData"),
+    Input("page-2-toggle-annotations", "checked"),
+    State("page-2-lut-palettes", "data"),
+    prevent_initial_call=True,
+)
 
 
 @app.callback(
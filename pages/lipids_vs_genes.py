@@ -25,6 +25,7 @@ import numpy as np
 from dash.long_callback import DiskcacheLongCallbackManager
 
 # LBAE imports
+from config import render_quality_upgrade_interval_ms
 from app import app, figures, data, atlas, celltype_data
 
 # ==================================================================================================
@@ -111,6 +112,13 @@ def return_layout(basic_config, slice_index):
                 # Add a store component to hold the slider style
                 dcc.Store(id="page-6tris-main-slider-style", data={"display": "block"}),
                 dcc.Store(id="lipigene-tutorial-step", data=0),
+                # Previews served under load are upgraded to full quality once the app is idle
+                dcc.Interval(
+                    id="page-6tris-quality-upgrade-interval",
+                    interval=render_quality_upgrade_interval_ms,
+                    disabled=True,
+                ),
+                dcc.Store(id="page-6tris-quality-upgrade"),
                 dcc.Store(id="lipigene-tutorial-completed", storage_type="local", data=False),
 
                 html.Div(id="page-6tris-refresh-trigger"),
@@ -1165,12 +1173,26 @@ def page_6tris_hover(hoverData, slice_index):
 #         return fig, "Lipids selected", "Genes selected:"
 
 from dash.long_callback import DiskcacheLongCallbackManager  # (ok if unused globally)
-from app import long_callback_limiter
+from app import long_callback_limiter, render_quality_policy
+
+# Upgrade previews served under load once the app is idle
+@app.callback(
+    Output("page-6tris-quality-upgrade", "data"),
+    Input("page-6tris-quality-upgrade-interval", "n_intervals"),
+    prevent_initial_call=True,
+)
+def page_6tris_upgrade_quality(n_intervals):
+    """Trigger a full-quality render of the current preview once no other render is pending."""
+    if not render_quality_policy.is_idle():
+        return dash.no_update
+    return n_intervals
+
 
 @app.long_callback(
     Output("page-6tris-graph-heatmap-mz-selection", "figure"),
     Output("page-6tris-badge-input", "children"),
     Output("page-6tris-badge-input-genes", "children"),
+    Output("page-6tris-quality-upgrade-interval", "disabled"),
     inputs=[
         Input("main-slider", "data"),
         Input("page-6tris-rgb-switch", "checked"),
@@ -1185,6 +1207,7 @@ from app import long_callback_limiter
         Input("page-6tris-gene-threshold-1", "data"),
         Input("page-6tris-gene-threshold-2", "data"),
         Input("page-6tris-gene-threshold-3", "data"),
+        Input("page-6tris-quality-upgrade", "data"),
     ],
     prevent_initial_call=True,
 )
@@ -1202,6 +1225,7 @@ def page_6tris_plot_graph_heatmap_mz_selection_long(
     gene_threshold_1,
     gene_threshold_2,
     gene_threshold_3,
+    quality_upgrade,
 ):
     with long_callback_limiter:
         logging.info("Entering page_3_plot_heatmap_long (with semaphore)")
@@ -1250,6 +1274,8 @@ def page_6tris_plot_graph_heatmap_mz_selection_long(
             df_genes=df_genes,
             rgb_mode_lipids=rgb_mode_lipids,
         )
+        # Serve a preview under load, upgraded once the app is idle
+        render_kwargs, preview = render_quality_policy.get_render_kwargs("lipids_vs_genes")
         fig = figures.build_lipid_heatmap_from_image(
             lipid_gene_image,
             return_base64_string=False,
@@ -1257,8 +1283,9 @@ def page_6tris_plot_graph_heatmap_mz_selection_long(
             type_image="RGB",
             return_go_image=False,
             overlay=overlay,
+            **render_kwargs,
         )
-        return fig, "Lipids selected", "Genes selected:"
+        return fig, "Lipids selected", "Genes selected:", not preview
 
 
 @app.callback(
@@ -15,7 +15,7 @@ import logging
 import dash
 import json
 import pandas as pd
-from dash.dependencies import Input, Output, State, ALL
+from dash.dependencies import Input, Output, State, ALL, ClientsideFunction
 import dash_mantine_components as dmc
 import numpy as np
 from scipy.ndimage import gaussian_filter
@@ -24,11 +24,14 @@ import os
 import re
 import PyPDF2
 import io
+import hashlib
+from uuid import uuid4
 from flask import send_file
 # os.environ['OMP_NUM_THREADS'] = '1'
 from dash.long_callback import DiskcacheLongCallbackManager
 
 # LBAE imports
+from config import render_quality_upgrade_interval_ms
 from app import app, figures, data, atlas, lipizone_data, cache_flask
 import plotly.express as px
 
@@ -39,6 +42,13 @@ import plotly.express as px
 # Path to the ID cards
 ID_CARDS_PATH = "./data/ID_cards"
 
+# Path and size cap (in bytes) of the on-disk cache of merged ID cards
+MERGED_ID_CARDS_CACHE_PATH = "./data/cache/merged_id_cards"
+MERGED_ID_CARDS_CACHE_MAX_BYTES = 2 * 1024**3
+
+# Hierarchy levels whose nodes get their merged ID cards precomputed at startup
+MERGED_ID_CARDS_PRECOMPUTED_LEVELS = ["level_1_name", "level_2_name"]
+
 # ==================================================================================================
 # --- Helper functions
 # ==================================================================================================
@@ -65,7 +75,17 @@ def return_layout(basic_config, slice_index):
         },
         children=[
             dcc.Store(id="lipizone-tutorial-step", data=0),
+            # Previews served under load are upgraded to full quality once the app is idle
+            dcc.Interval(
+                id="page-6-quality-upgrade-interval",
+                interval=render_quality_upgrade_interval_ms,
+                disabled=True,
+            ),
+            dcc.Store(id="page-6-quality-upgrade"),
             dcc.Store(id="lipizone-tutorial-completed", storage_type="local", data=False),
+            # Figure computed server-side when the page is loaded, whose tiles are loaded
+            # client-side (see assets/tiles.js)
+            dcc.Store(id="page-6-figure-store"),
             # Add tutorial button under welcome text
             html.Div(
                 id="lipizone-start-tutorial-target",
@@ -119,15 +139,6 @@ def return_layout(basic_config, slice_index):
                             "top": "0",
                             "background-color": "#1d1c1f",
                         },
-                        figure=figures.build_lipid_heatmap_from_image(
-                            figures.all_sections_lipizones_image(
-                                hex_colors_to_highlight=None, # all lipizones
-                                brain_id="ReferenceAtlas"),
-                            return_base64_string=False,
-                            draw=False,
-                            type_image="RGB",
-                            return_go_image=False,
-                        )
                     ),
                     # OffCanvas panel for ID cards
                     dbc.Offcanvas(
@@ -1301,18 +1312,32 @@ def page_6_active_sections_control(all_selected_lipizones):
 
 
 from dash.long_callback import DiskcacheLongCallbackManager  # ok if not used directly
-from app import long_callback_limiter
+from app import long_callback_limiter, render_quality_policy
+
+# Upgrade previews served under load once the app is idle
+@app.callback(
+    Output("page-6-quality-upgrade", "data"),
+    Input("page-6-quality-upgrade-interval", "n_intervals"),
+    prevent_initial_call=True,
+)
+def page_6_upgrade_quality(n_intervals):
+    """Trigger a full-quality render of the current preview once no other render is pending."""
+    if not render_quality_policy.is_idle():
+        return dash.no_update
+    return n_intervals
+
 
 @app.long_callback(
-    Output("page-6-graph-heatmap-mz-selection", "figure"),
+    Output("page-6-figure-store", "data"),
+    Output("page-6-quality-upgrade-interval", "disabled"),
     inputs=[
         Input("main-slider", "data"),
         Input("page-6-all-selected-lipizones", "data"),
         Input("page-6-sections-mode", "value"),
         Input("main-brain", "value"),
         Input("page-6-toggle-annotations", "checked"),
+        Input("page-6-quality-upgrade", "data"),
     ],
-    prevent_initial_call=True,
 )
 def page_6_plot_graph_heatmap_mz_selection_long(
     slice_index,
@@ -1320,6 +1345,7 @@ def page_6_plot_graph_heatmap_mz_selection_long(
     sections_mode,
     brain_id,
     annotations_checked,
+    quality_upgrade,
 ):
     with long_callback_limiter:
         logging.info("Entering page_3_plot_heatmap_long (with semaphore)")
@@ -1337,36 +1363,47 @@ def page_6_plot_graph_heatmap_mz_selection_long(
         )
 
         if sections_mode == "all":
-            image = figures.all_sections_lipizones_image(
-                hex_colors_to_highlight=hex_colors_to_highlight,
-                brain_id=brain_id
-            )
-            if brain_id in ("ReferenceAtlas", "SecondAtlas"):
-                image = np.pad(image, ((200, 200), (0, 0), (0, 0)), mode="edge")
-            else:
-                image = np.pad(image, ((800, 800), (0, 0), (0, 0)), mode="edge")
-
-            return figures.build_lipid_heatmap_from_image(
-                image,
-                return_base64_string=False,
-                draw=False,
-                type_image="RGB",
-                return_go_image=False,
+            # The mosaic is served as tiles, only the visible ones being loaded by the browser. Its
+            # image is only computed if the pyramid of its tiles is not stored yet
+            params = {"brain_id": brain_id}
+            if hex_colors_to_highlight is not None:
+                params["colors"] = ",".join(color.lstrip("#") for color in hex_colors_to_highlight)
+            fig = figures.build_tiled_heatmap(
+                lambda: figures.all_sections_lipizones_image(
+                    hex_colors_to_highlight=hex_colors_to_highlight, brain_id=brain_id
+                ),
+                "lipizones",
+                "page-6-graph-heatmap-mz-selection",
+                **params,
             )
+            return fig, True
 
         # sections_mode == "one"
         hybrid_image = figures.one_section_lipizones_image(
             slice_index=slice_index,
             hex_colors_to_highlight=hex_colors_to_highlight,
         )
-        return figures.build_lipid_heatmap_from_image(
+        # Serve a preview under load, upgraded once the app is idle
+        render_kwargs, preview = render_quality_policy.get_render_kwargs("lipizones_selection")
+        fig = figures.build_lipid_heatmap_from_image(
             hybrid_image,
             return_base64_string=False,
             draw=False,
             type_image="RGB",
             return_go_image=False,
             overlay=overlay,
+            light=True,
+            **render_kwargs,
         )
+        return fig, not preview
+
+# Load the visible tiles of the mosaics client-side, when the figure changes or when zooming
+app.clientside_callback(
+    ClientsideFunction(namespace="tiles", function_name="render_tiles"),
+    Output("page-6-graph-heatmap-mz-selection", "figure"),
+    Input("page-6-figure-store", "data"),
+    Input("page-6-graph-heatmap-mz-selection", "relayoutData"),
+)
 
 # Add callback to update badges
 @app.callback(
@@ -1621,6 +1658,111 @@ def update_pdf_viewer(all_selected_lipizones, n_clicks, current_style):
         }
     ), current_style
 
+def get_id_card_paths(filenames):
+    """Return the paths of the existing ID cards among the (cleaned) lipizone filenames."""
+    pdf_paths = []
+    for filename in filenames:
+        pdf_path = os.path.join(ID_CARDS_PATH, f"lipizone_ID_card_{filename}.pdf")
+        if os.path.exists(pdf_path):
+            pdf_paths.append(pdf_path)
+        else:
+            logging.warning(f"PDF file not found: {pdf_path}")
+    return pdf_paths
+
+
+def evict_merged_id_cards(keep_path=None):
+    """Remove the least recently used merged ID cards until the cache fits in its size cap."""
+    entries = []
+    for entry in os.scandir(MERGED_ID_CARDS_CACHE_PATH):
+        if entry.is_file() and entry.name.endswith(".pdf"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= MERGED_ID_CARDS_CACHE_MAX_BYTES:
+            break
+        if path == keep_path:
+            continue
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError as e:
+            logging.warning(f"Could not evict merged ID cards {path}: {e}")
+
+
+def get_merged_id_cards_path(pdf_paths):
+    """Return the path of the merged PDF of the given ID cards, merging them only if the merge is
+    not already in the on-disk cache. The ID cards are merged in the order of the selection,
+    which is therefore part of the cache key (along with the modification times of the ID cards,
+    so that updated cards invalidate the merge). The cache is kept under
+    MERGED_ID_CARDS_CACHE_MAX_BYTES by evicting the least recently used merges.
+
+    Args:
+        pdf_paths (list(str)): The paths of the ID cards to merge, in the order of the pages.
+
+    Returns:
+        (str): The path of the merged PDF, or None if no PDF could be merged.
+    """
+    key = hashlib.md5(
+        str([(pdf_path, os.path.getmtime(pdf_path)) for pdf_path in pdf_paths]).encode()
+    ).hexdigest()
+    merged_path = os.path.join(MERGED_ID_CARDS_CACHE_PATH, f"{key}.pdf")
+
+    # Cache hit: refresh the modification time, used as LRU timestamp for eviction
+    if os.path.exists(merged_path):
+        os.utime(merged_path)
+        return merged_path
+
+    # Merge PDFs
+    merger = PyPDF2.PdfMerger()
+    for pdf_path in pdf_paths:
+        try:
+            merger.append(pdf_path)
+        except Exception as e:
+            logging.error(f"Error appending PDF {pdf_path}: {e}")
+            continue
+
+    if len(merger.pages) == 0:
+        merger.close()
+        return None
+
+    # Write to a temporary file first, such that concurrent requests never read a partial merge
+    os.makedirs(MERGED_ID_CARDS_CACHE_PATH, exist_ok=True)
+    tmp_path = f"{merged_path}.{uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        merger.write(f)
+    merger.close()
+    os.replace(tmp_path, merged_path)
+
+    evict_merged_id_cards(keep_path=merged_path)
+    return merged_path
+
+
+def precompute_merged_id_cards():
+    """Merge the ID cards of all lipizones, and of each node of the upper hierarchy levels, such
+    that the most common selections are served from the cache from the first request on. This is
+    an offline step, run with `python main.py --precompute-id-cards`, rather than at import time,
+    as the page is imported by every worker and every long callback process."""
+    if not os.path.exists(ID_CARDS_PATH):
+        return
+
+    df = lipizone_data.df_hierarchy_lipizones
+    l_selections = [df["lipizone_names"].unique()]
+    for column in MERGED_ID_CARDS_PRECOMPUTED_LEVELS:
+        for _, df_node in df.groupby(column):
+            l_selections.append(df_node["lipizone_names"].unique())
+
+    for selection in l_selections:
+        try:
+            pdf_paths = get_id_card_paths([clean_filenamePD(name) for name in selection])
+            if len(pdf_paths) > 1:
+                get_merged_id_cards_path(pdf_paths)
+        except Exception as e:
+            logging.error(f"Error precomputing merged ID cards: {e}")
+    logging.info("Merged ID cards precomputed for the common hierarchy nodes")
+
+
 # Add route for serving merged PDFs
 @app.server.route('/merged-id-cards-pdf/<path:filenames>')
 def serve_merged_pdf(filenames):
@@ -1630,48 +1772,28 @@ def serve_merged_pdf(filenames):
             logging.error(f"ID cards directory not found at {ID_CARDS_PATH}")
             return "ID cards directory not found. Please ensure the data directory is properly set up.", 404
 
-        # Split filenames and construct full paths
-        pdf_paths = []
         # split the filenames by comma, but not by comma+space
-        split_filenames = re.split(r',(?! )', filenames)
-        for filename in split_filenames:
-            pdf_path = os.path.join(ID_CARDS_PATH, f"lipizone_ID_card_{filename}.pdf")
-            if os.path.exists(pdf_path):
-                pdf_paths.append(pdf_path)
-            else:
-                logging.warning(f"PDF file not found: {pdf_path}")
+        pdf_paths = get_id_card_paths(re.split(r',(?! )', filenames))
         
         if not pdf_paths:
             return "No PDFs found for the selected lipizones. Please ensure the ID cards are available in the data directory.", 404
         
         # If only one PDF, serve it directly
         if len(pdf_paths) == 1:
-            return send_file(pdf_paths[0])
-        
-        # Merge PDFs
-        merger = PyPDF2.PdfMerger()
-        for pdf_path in pdf_paths:
-            try:
-                merger.append(pdf_path)
-            except Exception as e:
-                logging.error(f"Error appending PDF {pdf_path}: {e}")
-                continue
+            return send_file(pdf_paths[0], conditional=True)
         
-        if len(merger.pages) == 0:
+        # Merge PDFs, or get them from the on-disk cache
+        merged_path = get_merged_id_cards_path(pdf_paths)
+        if merged_path is None:
             return "No valid PDFs could be merged. Please check the PDF files in the data directory.", 404
         
-        # Write to BytesIO
-        output = io.BytesIO()
-        merger.write(output)
-        merger.close()
-        
-        # Prepare for sending
-        output.seek(0)
+        # Stream the file from disk, with support for range requests
         return send_file(
-            output,
+            merged_path,
             mimetype='application/pdf',
             as_attachment=False,
-            download_name='merged_id_cards.pdf'
+            download_name='merged_id_cards.pdf',
+            conditional=True,
         )
     except Exception as e:
         logging.error(f"Error serving merged PDF: {e}")
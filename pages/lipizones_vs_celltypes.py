@@ -30,6 +30,7 @@ import pickle
 import plotly.express as px
 
 # LBAE imports
+from config import render_quality_upgrade_interval_ms
 from app import app, figures, data, atlas, lipizone_data, celltype_data
 
 # ==================================================================================================
@@ -98,6 +99,13 @@ def return_layout(basic_config, slice_index):
                 },
             ),
             dcc.Store(id="lipicell-tutorial-step", data=0),
+            # Previews served under load are upgraded to full quality once the app is idle
+            dcc.Interval(
+                id="page-6bis-quality-upgrade-interval",
+                interval=render_quality_upgrade_interval_ms,
+                disabled=True,
+            ),
+            dcc.Store(id="page-6bis-quality-upgrade"),
             dcc.Store(
                 id="lipicell-tutorial-completed", storage_type="local", data=False
             ),
@@ -1688,15 +1696,30 @@ def page_6_hover(hoverData, slice_index):
 
 
 from dash.long_callback import DiskcacheLongCallbackManager  # safe if unused
-from app import long_callback_limiter
+from app import long_callback_limiter, render_quality_policy
+
+# Upgrade previews served under load once the app is idle
+@app.callback(
+    Output("page-6bis-quality-upgrade", "data"),
+    Input("page-6bis-quality-upgrade-interval", "n_intervals"),
+    prevent_initial_call=True,
+)
+def page_6bis_upgrade_quality(n_intervals):
+    """Trigger a full-quality render of the current preview once no other render is pending."""
+    if not render_quality_policy.is_idle():
+        return dash.no_update
+    return n_intervals
+
 
 @app.long_callback(
     Output("page-6bis-graph-heatmap-mz-selection", "figure"),
+    Output("page-6bis-quality-upgrade-interval", "disabled"),
     inputs=[
         Input("main-slider", "data"),
         Input("page-6bis-all-selected-lipizones", "data"),
         Input("page-6bis-all-selected-celltypes", "data"),
         Input("page-6bis-toggle-annotations", "checked"),
+        Input("page-6bis-quality-upgrade", "data"),
     ],
     prevent_initial_call=True,
 )
@@ -1705,6 +1728,7 @@ def page_6bis_plot_graph_heatmap_mz_selection_long(
     all_selected_lipizones,
     all_selected_celltypes,
     annotations_checked,
+    quality_upgrade,
 ):
     with long_callback_limiter:
         logging.info("Entering page_3_plot_heatmap_long (with semaphore)")
@@ -1732,14 +1756,18 @@ def page_6bis_plot_graph_heatmap_mz_selection_long(
                 slice_index,
             )
 
-        return figures.build_lipid_heatmap_from_image(
+        # Serve a preview under load, upgraded once the app is idle
+        render_kwargs, preview = render_quality_policy.get_render_kwargs("lipizones_vs_celltypes")
+        fig = figures.build_lipid_heatmap_from_image(
             image,
             return_base64_string=False,
             draw=False,
             type_image="RGB",
             return_go_image=False,
             overlay=overlay,
+            **render_kwargs,
         )
+        return fig, not preview
 
 
 
@@ -15,7 +15,7 @@ import logging
 import dash
 import json
 import pandas as pd
-from dash.dependencies import Input, Output, State, ALL
+from dash.dependencies import Input, Output, State, ALL, ClientsideFunction
 import dash_mantine_components as dmc
 import numpy as np
 from dash.long_callback import DiskcacheLongCallbackManager
@@ -25,7 +25,8 @@ from dash.long_callback import DiskcacheLongCallbackManager
 # os.environ['OMP_NUM_THREADS'] = '1'
 
 # LBAE imports
-from app import app, program_figures, program_data, cache_flask, atlas, grid_data
+from app import app, program_figures, program_data, atlas, grid_data
+from modules.tools.image import get_lut_palettes
 
 def cyan_aba_contours(overlay):
     cyan_overlay = overlay.copy()
@@ -56,6 +57,12 @@ def return_layout(basic_config, slice_index):
                 dcc.Store(id="lp-tutorial-step", data=0),
                 dcc.Store(id="lp-tutorial-completed", storage_type="local", data=False),
 
+                # Figure computed server-side, and colormap applied client-side to single-channel
+                # images (see assets/colormaps.js)
+                dcc.Store(id="page-2bis-figure-store"),
+                dcc.Store(id="page-2bis-colormap", data="PuOr"),
+                dcc.Store(id="page-2bis-lut-palettes", data=get_lut_palettes()),
+
                 # Add tutorial button under welcome text
                 html.Div(
                     id="lp-start-tutorial-target",
@@ -127,7 +134,6 @@ def return_layout(basic_config, slice_index):
                             figure=program_figures.compute_heatmap_per_lipid(
                                 slice_index,
                                 "mitochondrion",
-                                cache_flask=cache_flask,
                                 colormap_type="PuOr",
                             ),
                         ),
@@ -966,7 +972,7 @@ from dash.long_callback import DiskcacheLongCallbackManager  # ok if unused
 from app import long_callback_limiter
 
 @app.long_callback(
-    Output("page-2bis-graph-heatmap-mz-selection", "figure"),
+    Output("page-2bis-figure-store", "data"),
     Output("page-2bis-badge-input", "children"),
     inputs=[
         Input("main-slider", "data"),
@@ -975,7 +981,6 @@ from app import long_callback_limiter
         Input("page-2bis-selected-program-3", "data"),
         Input("page-2bis-rgb-switch", "checked"),
         Input("main-brain", "value"),
-        Input("page-2bis-toggle-annotations", "checked"),
     ],
     state=[State("page-2bis-badge-input", "children")],
     prevent_initial_call=True,
@@ -987,13 +992,13 @@ def page_2bis_plot_graph_heatmap_mz_selection_long(
     program_3_index,
     rgb_mode,
     brain_id,
-    annotations_checked,
     graph_input,   # kept for signature parity; not used
 ):
     with long_callback_limiter:
         logging.info("Entering page_3_plot_heatmap_long (with semaphore)")
-        # ABA overlay (cyan)
-        overlay = cyan_aba_contours(program_data.get_aba_contours(slice_index)) if annotations_checked else None
+        # ABA overlay (cyan); the image is served (and cached by the browser) through its URL,
+        # and the annotations are a separate layer toggled client-side
+        overlay_color = "cyan"
 
         # Resolve selected program names from indices (ignore -1 / None)
         indices = [program_1_index, program_2_index, program_3_index]
@@ -1007,12 +1012,8 @@ def page_2bis_plot_graph_heatmap_mz_selection_long(
 
         # No selection → default single-program heatmap
         if not names:
-            fig = program_figures.compute_heatmap_per_lipid(
-                slice_index,
-                "mitochondrion",
-                cache_flask=cache_flask,
-                overlay=overlay,
-                colormap_type="PuOr",
+            fig = program_figures.build_lipid_heatmap_client_colormap(
+                slice_index, "mitochondrion", colormap_type="PuOr", overlay_color=overlay_color
             )
             return fig, "Now displaying:"
 
@@ -1020,31 +1021,34 @@ def page_2bis_plot_graph_heatmap_mz_selection_long(
         if rgb_mode or len(names) > 1:
             # pad/truncate to 3 entries as the RGB helper expects up to 3
             padded = [names[i] if i < len(names) else None for i in range(3)]
-            fig = program_figures.compute_rgb_image_per_lipid_selection(
-                slice_index,
-                ll_lipid_names=padded,
-                cache_flask=cache_flask,
-                overlay=overlay,
+            fig = program_figures.build_lipid_heatmap_client_rgb(
+                slice_index, padded, overlay_color=overlay_color
             )
             return fig, "Now displaying:"
 
         # Otherwise render single-program colormap
         first = names[0]
-        image = program_figures.compute_image_per_lipid(
-            slice_index,
-            RGB_format=False,
-            lipid_name=first,
-            cache_flask=cache_flask,
-        )
-        fig = program_figures.build_lipid_heatmap_from_image(
-            image,
-            return_base64_string=False,
-            overlay=overlay,
-            colormap_type="PuOr",
+        fig = program_figures.build_lipid_heatmap_client_colormap(
+            slice_index, first, colormap_type="PuOr", overlay_color=overlay_color
         )
         return fig, "Now displaying:"
 
 
+# Apply the colormap of single-channel images, or composite the channels of RGB images,
+# client-side (see assets/colormaps.js), and stack the annotations above them (see
+# assets/layers.js). Tiled mosaics are updated when zooming (see assets/tiles.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="lut", function_name="apply_colormap"),
+    Output("page-2bis-graph-heatmap-mz-selection", "figure"),
+    Input("page-2bis-figure-store", "data"),
+    Input("page-2bis-colormap", "data"),
+    Input("page-2bis-graph-heatmap-mz-selection", "relayoutData"),
+    Input("page-2bis-toggle-annotations", "checked"),
+    State("page-2bis-lut-palettes", "data"),
+    prevent_initial_call=True,
+)
+
+
 @app.callback(
     Output("page-2bis-badge-program-1", "children"),
     Output("page-2bis-badge-program-2", "children"),
@@ -15,7 +15,7 @@ import logging
 import dash
 import json
 import pandas as pd
-from dash.dependencies import Input, Output, State, ALL
+from dash.dependencies import Input, Output, State, ALL, ClientsideFunction
 import dash_mantine_components as dmc
 import numpy as np
 # import os
@@ -24,7 +24,8 @@ from dash.long_callback import DiskcacheLongCallbackManager  # ok if unused
 
 
 # LBAE imports
-from app import app, peak_figures, peak_data, cache_flask, atlas, grid_data
+from app import app, peak_figures, peak_data, atlas, grid_data
+from modules.tools.image import get_lut_palettes
 
 # ==================================================================================================
 # --- Layout
@@ -48,6 +49,12 @@ def return_layout(basic_config, slice_index):
                 dcc.Store(id="peak-tutorial-step", data=0),
                 dcc.Store(id="peak-tutorial-completed", storage_type="local", data=False),
 
+                # Figure computed server-side, and colormap applied client-side to single-channel
+                # images (see assets/colormaps.js)
+                dcc.Store(id="page-2tris-figure-store"),
+                dcc.Store(id="page-2tris-colormap", data="viridis"),
+                dcc.Store(id="page-2tris-lut-palettes", data=get_lut_palettes()),
+
                 # Add tutorial button under welcome text
                 html.Div(
                     id="peak-start-tutorial-target",
@@ -119,7 +126,6 @@ def return_layout(basic_config, slice_index):
                             figure=peak_figures.compute_heatmap_per_lipid(
                                 slice_index,
                                 '1000.169719',
-                                cache_flask=cache_flask,
                             ),
                         ),
                         # Allen Brain Atlas switch (independent)
@@ -1171,7 +1177,7 @@ def page_peak_hover(hoverData, slice_index):
 from app import long_callback_limiter
 
 @app.long_callback(
-    Output("page-2tris-graph-heatmap-mz-selection", "figure"),
+    Output("page-2tris-figure-store", "data"),
     Output("page-2tris-badge-input", "children"),
     inputs=[
         Input("main-slider", "data"),
@@ -1181,7 +1187,6 @@ from app import long_callback_limiter
         Input("page-2tris-rgb-switch", "checked"),
         # Input("page-2tris-sections-mode", "value"),  # keep commented until ready
         Input("main-brain", "value"),
-        Input("page-2tris-toggle-annotations", "checked"),
     ],
     state=[State("page-2tris-badge-input", "children")],
     prevent_initial_call=True,
@@ -1193,13 +1198,14 @@ def page_peak_plot_graph_heatmap_mz_selection_long(
     peak_3_index,
     rgb_mode,
     brain_id,
-    annotations_checked,
     _badge_children,  # not used; kept for signature parity
 ):  
     """Deterministic render of peak image (single or RGB) without callback_context."""
     with long_callback_limiter:
         logging.info("Entering page_3_plot_heatmap_long (with semaphore)")
-        overlay = peak_data.get_aba_contours(slice_index) if annotations_checked else None
+        # The image is served (and cached by the browser) through its URL, and the annotations
+        # are a separate layer toggled client-side
+        overlay_color = "orange"
 
         # Resolve selected peak names from indices (ignore -1/None)
         indices = [peak_1_index, peak_2_index, peak_3_index]
@@ -1213,41 +1219,41 @@ def page_peak_plot_graph_heatmap_mz_selection_long(
 
         # No selection → default single-peak heatmap
         if not names:
-            fig = peak_figures.compute_heatmap_per_lipid(
-                slice_index,
-                "1000.169719",
-                cache_flask=cache_flask,
-                overlay=overlay,
+            fig = peak_figures.build_lipid_heatmap_client_colormap(
+                slice_index, "1000.169719", overlay_color=overlay_color
             )
             return fig, "Now displaying:"
 
         # If RGB mode (or multiple peaks), render RGB
         if rgb_mode or len(names) > 1:
             padded = [names[i] if i < len(names) else None for i in range(3)]
-            fig = peak_figures.compute_rgb_image_per_lipid_selection(
-                slice_index,
-                ll_lipid_names=padded,
-                cache_flask=cache_flask,
-                overlay=overlay,
+            fig = peak_figures.build_lipid_heatmap_client_rgb(
+                slice_index, padded, overlay_color=overlay_color
             )
             return fig, "Now displaying:"
 
         # Otherwise render single-peak colormap
         first = names[0]
-        image = peak_figures.compute_image_per_lipid(
-            slice_index,
-            RGB_format=False,
-            lipid_name=first,
-            cache_flask=cache_flask,
-        )
-        fig = peak_figures.build_lipid_heatmap_from_image(
-            image,
-            return_base64_string=False,
-            overlay=overlay,
+        fig = peak_figures.build_lipid_heatmap_client_colormap(
+            slice_index, first, overlay_color=overlay_color
         )
         return fig, "Now displaying:"
 
 
+# Apply the colormap of single-channel images, or composite the channels of RGB images,
+# client-side (see assets/colormaps.js), and stack the annotations above them (see
+# assets/layers.js). Tiled mosaics are updated when zooming (see assets/tiles.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="lut", function_name="apply_colormap"),
+    Output("page-2tris-graph-heatmap-mz-selection", "figure"),
+    Input("page-2tris-figure-store", "data"),
+    Input("page-2tris-colormap", "data"),
+    Input("page-2tris-graph-heatmap-mz-selection", "relayoutData"),
+    Input("page-2tris-toggle-annotations", "checked"),
+    State("page-2tris-lut-palettes", "data"),
+    prevent_initial_call=True,
+)
+
 
 @app.callback(
     Output("page-2tris-badge-peak-1", "children"),
@@ -29,7 +29,7 @@ from skimage.draw import polygon
 from statsmodels.stats.multitest import multipletests
 from scipy.stats import mannwhitneyu, ttest_ind
 # LBAE imports
-from app import app, figures, data, atlas, cache_flask
+from app import app, figures, data, atlas
 import config
 from modules.tools.image import convert_image_to_base64
 from config import l_colors
@@ -274,7 +274,6 @@ def return_layout(basic_config, slice_index=1):
                             figure = figures.compute_rgb_image_per_lipid_selection(
                                         slice_index,
                                         ll_lipid_names=["HexCer 42:2;O2", None, None],
-                                        cache_flask=cache_flask,
                                     ).update_layout(
                                         dragmode="drawclosedpath",
                                         newshape=dict(
@@ -1361,7 +1360,6 @@ def page_3_plot_heatmap(
                 fig = figures.compute_rgb_image_per_lipid_selection(
                         slice_index,
                         ll_lipid_names=ll_lipid_names,
-                        cache_flask=cache_flask,
                         overlay=overlay,
                     )
                 fig.update_layout(
@@ -1381,7 +1379,6 @@ def page_3_plot_heatmap(
                 fig = figures.compute_rgb_image_per_lipid_selection(
                         slice_index,
                         ll_lipid_names=ll_lipid_names,
-                        cache_flask=cache_flask,
                         overlay=overlay,
                     )
                 fig.update_layout(
@@ -1401,7 +1398,6 @@ def page_3_plot_heatmap(
             fig = figures.compute_rgb_image_per_lipid_selection(
                     slice_index,
                     ll_lipid_names=["HexCer 42:2;O2", None, None],
-                    cache_flask=cache_flask,
                     overlay=overlay,
                 )
             fig.update_layout(
@@ -1420,7 +1416,6 @@ def page_3_plot_heatmap(
             fig = figures.compute_rgb_image_per_lipid_selection(
                     slice_index,
                     ll_lipid_names=["HexCer 42:2;O2", None, None],
-                    cache_flask=cache_flask,
                     overlay=overlay,
                 )
             fig.update_layout(
@@ -1461,7 +1456,6 @@ def page_3_plot_heatmap(
         fig = figures.compute_rgb_image_per_lipid_selection(
                 slice_index,
                 ll_lipid_names=ll_lipid_names, # ["HexCer 42:2;O2", None, None],
-                cache_flask=cache_flask,
                 overlay=overlay,
             )
         fig.update_layout(
@@ -1484,7 +1478,6 @@ def page_3_plot_heatmap(
         fig = figures.compute_rgb_image_per_lipid_selection(
             slice_index,
             ll_lipid_names=ll_lipid_names,
-            cache_flask=cache_flask,
             overlay=overlay,
         )
         
@@ -1523,7 +1516,6 @@ def page_3_plot_heatmap(
         fig = figures.compute_rgb_image_per_lipid_selection(
                 slice_index,
                 ll_lipid_names=ll_lipid_names, # ["HexCer 42:2;O2", None, None],
-                cache_flask=cache_flask,
                 overlay=overlay,
             )
         fig.update_layout(
@@ -1545,7 +1537,6 @@ def page_3_plot_heatmap(
             fig = figures.compute_rgb_image_per_lipid_selection(
                 slice_index,
                 ll_lipid_names=ll_lipid_names, # ["HexCer 42:2;O2", None, None],
-                cache_flask=cache_flask,
                 overlay=overlay,
             )
             color_idx = None
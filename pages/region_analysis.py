@@ -15,7 +15,7 @@ Updates:
 # Standard modules
 import dash_bootstrap_components as dbc
 from dash import dcc, html, clientside_callback
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 import dash
 import plotly.graph_objects as go
 import numpy as np
@@ -29,9 +29,8 @@ from skimage.draw import polygon
 from statsmodels.stats.multitest import multipletests
 from scipy.stats import mannwhitneyu, ttest_ind
 # LBAE imports
-from app import app, figures, data, atlas, cache_flask
+from app import app, figures, data, atlas
 import config
-from modules.tools.image import convert_image_to_base64
 from config import l_colors
 from dash.long_callback import DiskcacheLongCallbackManager  # ok if unused
 
@@ -42,6 +41,38 @@ from dash.long_callback import DiskcacheLongCallbackManager  # ok if unused
 # --- Helper functions
 # ==================================================================================================
 
+def build_region_figure(slice_index, ll_lipid_names):
+    """This function builds the figure of the selected lipids in the selected slice, without the
+    annotations, masks and shapes, which are stacked above it client-side (see assets/layers.js).
+
+    Args:
+        slice_index (int): Index of the selected slice.
+        ll_lipid_names (list(str)): The names of the lipids of the red, green and blue channels.
+
+    Returns:
+        (go.Figure): The figure, whose metadata references the annotations layer.
+    """
+    fig = figures.compute_rgb_image_per_lipid_selection(
+        slice_index,
+        ll_lipid_names=ll_lipid_names,
+    )
+    fig.update_layout(
+        dragmode="drawclosedpath",
+        newshape=dict(
+            fillcolor=l_colors[0],
+            opacity=0.7,
+            line=dict(color="white", width=1),
+        ),
+        autosize=True,
+        meta=dict(
+            overlay_source=figures.get_layer_url("contours", slice_index, color="orange"),
+            # Colors of the successive masks and shapes
+            shape_colors=l_colors[:7],
+        ),
+    )
+    return fig
+
+
 def global_store(
     slice_index, 
     l_shapes_and_masks,
@@ -208,6 +239,7 @@ def return_layout(basic_config, slice_index=1):
         children=[
             dcc.Store(id="analysis-tutorial-step", data=0),
             dcc.Store(id="analysis-tutorial-completed", storage_type="local", data=False),
+            dcc.Store(id="page-3-figure-store"),
 
             # Add tutorial button under welcome text
             html.Div(
@@ -274,7 +306,6 @@ def return_layout(basic_config, slice_index=1):
                             figure = figures.compute_rgb_image_per_lipid_selection(
                                         slice_index,
                                         ll_lipid_names=["HexCer 42:2;O2", None, None],
-                                        cache_flask=cache_flask,
                                     ).update_layout(
                                         dragmode="drawclosedpath",
                                         newshape=dict(
@@ -1310,7 +1341,7 @@ def page_3_reset_layout(cliked_reset, url):
 from app import long_callback_limiter
 @app.long_callback(
     output=[
-        Output("page-3-graph-heatmap-mz-selection", "figure"),
+        Output("page-3-figure-store", "data"),
         Output("page-3-badge-input", "children"),
         Output("dcc-store-color-mask", "data"),
         Output("dcc-store-reset", "data"),
@@ -1325,7 +1356,6 @@ from app import long_callback_limiter
         Input("page-3-selected-lipid-1", "data"),
         Input("page-3-selected-lipid-2", "data"),
         Input("page-3-selected-lipid-3", "data"),
-        Input("page-3-toggle-annotations", "checked"),
     ],
     state=[
         State("dcc-store-color-mask", "data"),
@@ -1348,131 +1378,22 @@ def page_3_plot_heatmap_long(
     lipid_1_index,
     lipid_2_index,
     lipid_3_index,
-    annotations_checked,
     l_color_mask,
     reset,
     l_shapes_and_masks,
     graph_input,
 ):
-    """This callback plots the heatmap of the selected lipid(s)."""
+    """This callback plots the heatmap of the selected lipid(s), and records the masks selected
+    and the shapes drawn by the user. The annotations, masks and shapes are separate layers,
+    stacked client-side (see assets/layers.js), such that toggling the annotations or adding a
+    mask only updates the corresponding layer, while the image is not sent again."""
     with long_callback_limiter:
         logging.info("Entering page_3_plot_heatmap (with semaphore)")
 
         # Find out which input triggered the function
         id_input = dash.callback_context.triggered[0]["prop_id"].split(".")[0]
         value_input = dash.callback_context.triggered[0]["prop_id"].split(".")[1]
-        
-        # Define overlay based on annotations toggle
-        overlay = data.get_aba_contours(slice_index) if annotations_checked else None
-
-        # If a lipid selection has been done
-        if (
-            id_input == "page-3-selected-lipid-1"
-            or id_input == "page-3-selected-lipid-2"
-            or id_input == "page-3-selected-lipid-3"
-            or id_input == "page-3-colormap-button"
-            or (
-                (id_input == "main-slider")
-                and graph_input == "Colors: "
-            )
-        ):
-            if lipid_1_index >= 0 or lipid_2_index >= 0 or lipid_3_index >= 0:
-                ll_lipid_names = [
-                    ' '.join([
-                        data.get_annotations().iloc[index]["name"].split('_')[i] + ' ' 
-                        + data.get_annotations().iloc[index]["structure"].split('_')[i] 
-                        for i in range(len(data.get_annotations().iloc[index]["name"].split('_')))
-                        ])
-                    if index != -1
-                    else None
-                    for index in [lipid_1_index, lipid_2_index, lipid_3_index]
-                ]
-                
-                # Or if the current plot must be an RGB image
-                if (
-                    id_input == "main-slider"
-                    and graph_input == "Colors: "
-                ):
-                    fig = figures.compute_rgb_image_per_lipid_selection(
-                            slice_index,
-                            ll_lipid_names=ll_lipid_names,
-                            cache_flask=cache_flask,
-                            overlay=overlay,
-                        )
-                    fig.update_layout(
-                        dragmode="drawclosedpath",
-                        newshape=dict(
-                            fillcolor=l_colors[0],
-                            opacity=0.7,
-                            line=dict(color="white", width=1),
-                        ),
-                        autosize=True,
-                    )
-                    return fig, "Colors: ", [], True, [],
 
-                # Plot RBG By default
-                else:
-                    logging.info("Right before calling the graphing function")
-                    fig = figures.compute_rgb_image_per_lipid_selection(
-                            slice_index,
-                            ll_lipid_names=ll_lipid_names,
-                            cache_flask=cache_flask,
-                            overlay=overlay,
-                        )
-                    fig.update_layout(
-                        dragmode="drawclosedpath",
-                        newshape=dict(
-                            fillcolor=l_colors[0],
-                            opacity=0.7,
-                            line=dict(color="white", width=1),
-                        ),
-                        autosize=True,
-                    )
-                    return fig, "Colors: ", [], True, []
-            
-            elif (
-                id_input == "main-slider" and graph_input == "Colors: "
-            ):
-                fig = figures.compute_rgb_image_per_lipid_selection(
-                        slice_index,
-                        ll_lipid_names=["HexCer 42:2;O2", None, None],
-                        cache_flask=cache_flask,
-                        overlay=overlay,
-                    )
-                fig.update_layout(
-                    dragmode="drawclosedpath",
-                    newshape=dict(
-                        fillcolor=l_colors[0],
-                        opacity=0.7,
-                        line=dict(color="white", width=1),
-                    ),
-                    autosize=True,
-                )
-                return fig, "Colors: " + "HexCer 42:2;O2", [], True, []
-
-            else:
-                # No lipid has been selected
-                fig = figures.compute_rgb_image_per_lipid_selection(
-                        slice_index,
-                        ll_lipid_names=["HexCer 42:2;O2", None, None],
-                        cache_flask=cache_flask,
-                        overlay=overlay,
-                    )
-                fig.update_layout(
-                    dragmode="drawclosedpath",
-                    newshape=dict(
-                        fillcolor=l_colors[0],
-                        opacity=0.7,
-                        line=dict(color="white", width=1),
-                    ),
-                    autosize=True,
-                )
-                return fig, "Colors: " + "HexCer 42:2;O2", [], True, []
-        
-        # ------------------------------------------------------------------------------------------------
-        # If a new slice is loaded or the page just got loaded
-        # do nothing because of automatic relayout of the heatmap which is automatically triggered when
-        # the page is loaded
         if lipid_1_index >= 0 or lipid_2_index >= 0 or lipid_3_index >= 0:
             ll_lipid_names = [
                 ' '.join([
@@ -1484,35 +1405,31 @@ def page_3_plot_heatmap_long(
                 else None
                 for index in [lipid_1_index, lipid_2_index, lipid_3_index]
             ]
+            badge = "Colors: "
         else:
             ll_lipid_names = ["HexCer 42:2;O2", None, None]
-        
-        # Drawing or selecting a brain region
+            badge = "Colors: " + "HexCer 42:2;O2"
+
+        # If a lipid selection has been done, the figure is rebuilt and the masks are reset
+        if (
+            id_input == "page-3-selected-lipid-1"
+            or id_input == "page-3-selected-lipid-2"
+            or id_input == "page-3-selected-lipid-3"
+            or ((id_input == "main-slider") and graph_input == "Colors: ")
+        ):
+            return build_region_figure(slice_index, ll_lipid_names), badge, [], True, []
+
+        # ------------------------------------------------------------------------------------------------
+        # If a new slice is loaded or the page just got loaded
         if (
             len(id_input) == 0
             or id_input == "page-3-reset-button"
             or id_input == "url"
         ):
-            fig = figures.compute_rgb_image_per_lipid_selection(
-                    slice_index,
-                    ll_lipid_names=ll_lipid_names, # ["HexCer 42:2;O2", None, None],
-                    cache_flask=cache_flask,
-                    overlay=overlay,
-                )
-            fig.update_layout(
-                dragmode="drawclosedpath",
-                newshape=dict(
-                    fillcolor=l_colors[0],
-                    opacity=0.7,
-                    line=dict(color="white", width=1),
-                ),
-                autosize=True,
-            )
-            return fig, "Colors: ", [], True, []
+            return build_region_figure(slice_index, ll_lipid_names), "Colors: ", [], True, []
 
         # Fix bug with automatic relayout
         if value_input == "relayoutData" and relayoutData == {"autosize": True}:
-        # ✅ THIS IS THE CORRECT FIX
             return (
                 dash.no_update,
                 dash.no_update,
@@ -1521,40 +1438,6 @@ def page_3_plot_heatmap_long(
                 dash.no_update,
             )
 
-        # Handle annotations toggle separately to preserve shapes
-        if id_input == "page-3-toggle-annotations":
-            fig = figures.compute_rgb_image_per_lipid_selection(
-                slice_index,
-                ll_lipid_names=ll_lipid_names,
-                cache_flask=cache_flask,
-                overlay=overlay,
-            )
-            
-            # Preserve existing shapes and layout settings
-            if relayoutData and "shapes" in relayoutData:
-                fig.update_layout(shapes=relayoutData["shapes"])
-            
-            # Preserve existing color masks
-            if l_shapes_and_masks:
-                for shape_or_mask in l_shapes_and_masks:
-                    if shape_or_mask[0] == "mask":
-                        mask_name = shape_or_mask[1]
-                        base64_string = shape_or_mask[2]
-                        fig.add_trace(
-                            go.Image(visible=True, source=base64_string, hoverinfo="skip")
-                        )
-            
-            fig.update_layout(
-                dragmode="drawclosedpath",
-                newshape=dict(
-                    fillcolor=l_colors[len(l_shapes_and_masks) % 7] if l_shapes_and_masks else l_colors[0],
-                    opacity=0.7,
-                    line=dict(color="white", width=1),
-                ),
-                autosize=True,
-            )
-            return fig, graph_input, l_color_mask, False, l_shapes_and_masks
-
         # Fix other bug with automatic dropdown selection
         if (
             id_input == "page-3-dropdown-brain-regions"
@@ -1562,84 +1445,47 @@ def page_3_plot_heatmap_long(
             and cliked_reset is None
             and (l_mask_name is None or len(l_mask_name) == 0)
         ):
-            fig = figures.compute_rgb_image_per_lipid_selection(
-                    slice_index,
-                    ll_lipid_names=ll_lipid_names, # ["HexCer 42:2;O2", None, None],
-                    cache_flask=cache_flask,
-                    overlay=overlay,
-                )
-            fig.update_layout(
-                dragmode="drawclosedpath",
-                newshape=dict(
-                    fillcolor=l_colors[0],
-                    opacity=0.7,
-                    line=dict(color="white", width=1),
-                ),
-                autosize=True,
-            )
-            return fig, "Colors: ", [], True, []
+            return build_region_figure(slice_index, ll_lipid_names), "Colors: ", [], True, []
 
-        # If the user selected a new mask or drew on the plot
+        # If the user selected a new mask or drew on the plot, only the corresponding layer is
+        # recorded, the figure itself being unchanged
         if id_input == "page-3-graph-heatmap-mz-selection" or id_input == "page-3-dropdown-brain-regions":
             # Check that a mask has actually been selected
             if l_mask_name is not None or relayoutData is not None:
-                # Rebuild figure
-                fig = figures.compute_rgb_image_per_lipid_selection(
-                    slice_index,
-                    ll_lipid_names=ll_lipid_names, # ["HexCer 42:2;O2", None, None],
-                    cache_flask=cache_flask,
-                    overlay=overlay,
-                )
-                color_idx = None
-                col_next = None
+                l_previous_layers = list(l_shapes_and_masks)
                 if l_mask_name is not None:
-                    # If a mask has been selected
-                    if len(l_mask_name) > 0:
-                        for idx_mask, mask_name in enumerate(l_mask_name):
-                            id_name = atlas.dic_name_acronym[mask_name]
-                            if id_name in atlas.dic_existing_masks[slice_index]:
-                                descendants = atlas.bg_atlas.get_structure_descendants(id_name)
-
-                                acronym_mask = data.acronyms_masks[slice_index]
-                                mask2D = np.isin(acronym_mask, descendants + [id_name])
-                            else:
-                                logging.warning("The mask " + str(mask_name) + " couldn't be found")
-
-                            if idx_mask < len(l_color_mask):
-                                color_rgb = l_color_mask[idx_mask]
-                            else:
-                                color_idx = len(l_color_mask)
-                                if relayoutData is not None:
-                                    if "shapes" in relayoutData:
-                                        color_idx += len(relayoutData["shapes"])
-                                color = config.l_colors[color_idx % 7][1:]
-                                color_rgb = [int(color[i : i + 2], 16) for i in (0, 2, 4)] + [255]
-                                l_color_mask.append(color_rgb)
-
-                            l_images = [
-                                mask2D * color
-                                # normalized_projected_mask * color
-                                for c, color in zip(["r", "g", "b", "a"], color_rgb)
-                            ]
-                            
-                            # Reoder axis to match plotly go.image requirements
-                            array_image = np.moveaxis(np.array(l_images, dtype=np.uint8), 0, 2)
-
-                            # Convert image to string to save space (new image as each mask must have a
-                            # different color)
-                            base64_string = convert_image_to_base64(
-                                array_image, optimize=True, format="webp", type="RGBA"
-                            )
-                            fig.add_trace(
-                                go.Image(visible=True, source=base64_string, hoverinfo="skip")
-                            )
-                            fig.update_layout(
-                                dragmode="drawclosedpath",
-                            )
-
-                            if id_input == "page-3-dropdown-brain-regions" and color_idx is not None:
-                                # Save in l_shapes_and_masks
-                                l_shapes_and_masks.append(["mask", mask_name, base64_string, color_idx])
+                    # Masks are recorded by region name: deselected regions are dropped (and their
+                    # layer removed client-side), while masks already recorded keep their color
+                    l_shapes_and_masks = [
+                        entry
+                        for entry in l_shapes_and_masks
+                        if entry[0] != "mask" or entry[1] in l_mask_name
+                    ]
+                    set_recorded_masks = {
+                        entry[1] for entry in l_shapes_and_masks if entry[0] == "mask"
+                    }
+                    for mask_name in l_mask_name:
+                        if mask_name in set_recorded_masks:
+                            continue
+
+                        id_name = atlas.dic_name_acronym[mask_name]
+                        if id_name not in atlas.dic_existing_masks[slice_index]:
+                            logging.warning("The mask " + str(mask_name) + " couldn't be found")
+                            continue
+
+                        color_idx = len(l_color_mask)
+                        if relayoutData is not None:
+                            if "shapes" in relayoutData:
+                                color_idx += len(relayoutData["shapes"])
+                        color = config.l_colors[color_idx % 7][1:]
+                        color_rgb = [int(color[i : i + 2], 16) for i in (0, 2, 4)] + [255]
+                        l_color_mask.append(color_rgb)
+
+                        # The mask is served as a layer (see Figures.get_layer_url)
+                        layer_url = figures.get_layer_url(
+                            "mask", slice_index, region=mask_name, color=color
+                        )
+                        l_shapes_and_masks.append(["mask", mask_name, layer_url, color_idx])
 
                 # If a region has been drawn by the user
                 if relayoutData is not None:
@@ -1647,19 +1493,11 @@ def page_3_plot_heatmap_long(
                         if len(relayoutData["shapes"]) > 0:
                             if not reset or value_input == "relayoutData":
                                 if "path" in relayoutData["shapes"][-1]:
-                                    fig["layout"]["shapes"] = relayoutData["shapes"]  #
-                                    col_next = config.l_colors[
-                                        (len(relayoutData["shapes"]) + len(l_color_mask)) % 7
-                                    ]
-
                                     # compute color and save in l_shapes_and_masks
                                     if id_input == "page-3-graph-heatmap-mz-selection":
-                                        color_idx_for_registration = len(l_color_mask)
-                                        if relayoutData is not None:
-                                            if "shapes" in relayoutData:
-                                                color_idx_for_registration += len(
-                                                    relayoutData["shapes"]
-                                                )
+                                        color_idx_for_registration = len(l_color_mask) + len(
+                                            relayoutData["shapes"]
+                                        )
                                         l_shapes_and_masks.append(
                                             [
                                                 "shape",
@@ -1668,30 +1506,10 @@ def page_3_plot_heatmap_long(
                                                 color_idx_for_registration - 1,
                                             ]
                                         )
-                # Update col_next
-                if color_idx is not None and col_next is None:
-                    col_next = config.l_colors[(color_idx + 1) % 7]
-                elif col_next is None:
-                    col_next = config.l_colors[0]
-                fig.update_layout(
-                    dragmode="drawclosedpath",
-                    newshape=dict(
-                        fillcolor=col_next,
-                        opacity=0.7,
-                        line=dict(color="white", width=1),
-                    ),
-                )
 
-                # Update drag mode
-                if relayoutData is not None:
-                    if "shapes" in relayoutData:
-                        if len(relayoutData["shapes"]) + len(l_color_mask) > 10:
-                            fig.update_layout(dragmode=False)
-                if len(l_color_mask) > 10:
-                    fig.update_layout(dragmode=False)
-
-                # Return figure and corresponding data
-                return fig, "Colors: ", l_color_mask, False, l_shapes_and_masks
+                # Return the recorded layers, if any has been added or removed
+                if l_shapes_and_masks != l_previous_layers:
+                    return dash.no_update, "Colors: ", l_color_mask, False, l_shapes_and_masks
 
         # either graph is already here
         return (
@@ -1702,6 +1520,17 @@ def page_3_plot_heatmap_long(
             dash.no_update,
         )
 
+
+# Stack the annotations, masks and shapes above the image client-side (see assets/layers.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="layers", function_name="compose_region"),
+    Output("page-3-graph-heatmap-mz-selection", "figure"),
+    Input("page-3-figure-store", "data"),
+    Input("page-3-toggle-annotations", "checked"),
+    Input("dcc-store-shapes-and-masks", "data"),
+    prevent_initial_call=True,
+)
+
 @app.callback(
     Output("page-3-badge-lipid-1", "children"),
     Output("page-3-badge-lipid-2", "children"),
@@ -19,7 +19,7 @@ import dash_bootstrap_components as dbc
 from dash import dcc, html, clientside_callback
 import logging
 import dash_draggable
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 import numpy as np
 import dash
 import dash_mantine_components as dmc
@@ -50,6 +50,7 @@ def return_layout(basic_config, slice_index):
         children=[
             # --- Needed state stores (were missing) ---
             dcc.Store(id="page-4-last-selected-regions", data=[]),
+            dcc.Store(id="page-4-figure-store"),
             dcc.Store(id="page-4-selected-region-1", data=""),
             dcc.Store(id="page-4-selected-region-2", data=""),
             dcc.Store(id="page-4-selected-region-3", data=""),
@@ -671,7 +672,7 @@ def page_4_add_toast_region_selection(
 from app import long_callback_limiter
 # Function to plot page-4-graph-volume when its state get updated
 @app.long_callback(
-    output=Output("page-4-graph-volume", "figure"),
+    output=Output("page-4-figure-store", "data"),
     inputs=[
         Input("page-4-display-button", "n_clicks"),
     ],
@@ -728,9 +729,19 @@ def page_4_plot_graph_volume(
             opacity=0.1,
             surface_count=40,
             colorscale="Inferno",
+            packed=True,
         )
 
 
+# Decode the binary data arrays of the 3D figure client-side (see assets/typed.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="typed", function_name="decode_figure"),
+    Output("page-4-graph-volume", "figure"),
+    Input("page-4-figure-store", "data"),
+    prevent_initial_call=True,
+)
+
+
 @app.callback(
     Output("page-4-dropdown-lipids", "data"),
     Output("page-4-dropdown-lipids", "value"),